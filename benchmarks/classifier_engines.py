@@ -0,0 +1,58 @@
+""" Throughput, allocations and agreement of predict_categories with each engine of classifier.ENGINES.
+
+Scores the headlines and bodies of json/news.json in batches of
+classifier.NLP_BATCH_SIZE. Agreement is with the pickled model.
+
+Run from the repository root: python benchmarks/classifier_engines.py
+"""
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'napp'))
+
+from classifier import Classifier, ENGINES, NLP_BATCH_SIZE
+
+ROUNDS = 20
+
+
+def load_texts():
+    with open('json/news.json') as f:
+        articles = json.load(f)['articles']['results']
+    return [('headlines', [article['title'] for article in articles]),
+            ('bodies', [article['body'] for article in articles])]
+
+
+def batches(texts):
+    return [texts[i:i + NLP_BATCH_SIZE] for i in range(0, len(texts), NLP_BATCH_SIZE)]
+
+
+def main():
+    classifiers = {engine: Classifier(engine=engine) for engine in ENGINES}
+    for name, texts in load_texts():
+        print(f'{len(texts)} {name}')
+        expected = classifiers['pickle'].predict_categories(texts)
+        for engine, classifier in classifiers.items():
+            predicted = [category for batch in batches(texts) for category in classifier.predict_categories(batch)]
+
+            started = time.perf_counter()
+            for _ in range(ROUNDS):
+                for batch in batches(texts):
+                    classifier.predict_categories(batch)
+            elapsed = (time.perf_counter() - started) / ROUNDS / len(texts)
+
+            tracemalloc.start()
+            for batch in batches(texts):
+                classifier.predict_categories(batch)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+            agreement = sum(1 for a, b in zip(expected, predicted) if a == b) / len(texts)
+            print(f'  {engine:<8} {elapsed * 1e6:8.1f}us per text  peak allocated {peak / 1024:8.1f}KB  '
+                  f'agreement {agreement:6.1%}')
+
+
+if __name__ == '__main__':
+    main()
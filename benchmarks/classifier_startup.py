@@ -0,0 +1,80 @@
+""" Cold start time and memory of a Classifier with each engine of classifier.ENGINES.
+
+Each measurement runs in new processes: one to time Classifier() and the
+first predict_category, then WORKERS at once holding the model, like the
+NLP worker processes of a loader. PSS counts shared pages once across
+them. Pass --spacy to also load the spaCy pipeline, as Classifier() used to.
+
+Run from the repository root: python benchmarks/classifier_startup.py [--spacy]
+"""
+import multiprocessing
+import os
+import sys
+import time
+import psutil
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'napp'))
+
+from classifier import Classifier, ENGINES
+
+WORKERS = 4
+HEADLINE = 'Apple arcade goes live for iOS 13 beta testers - The Verge'
+
+
+def start(engine, spacy):
+    started = time.perf_counter()
+    classifier = Classifier(engine=engine)
+    classifier.predict_category(HEADLINE)
+    if spacy:
+        classifier.get_named_entities(HEADLINE)
+    return classifier, time.perf_counter() - started
+
+
+def cold_start(engine, spacy, results):
+    _, elapsed = start(engine, spacy)
+    memory = psutil.Process().memory_full_info()
+    results.put((elapsed, memory.rss, memory.uss))
+
+
+def worker(engine, spacy, ready, done):
+    classifier, _ = start(engine, spacy)
+    ready.release()
+    done.wait()
+
+
+def measure(engine, spacy):
+    results = multiprocessing.Queue()
+    process = multiprocessing.Process(target=cold_start, args=(engine, spacy, results))
+    process.start()
+    elapsed, rss, uss = results.get()
+    process.join()
+
+    ready, done = multiprocessing.Semaphore(0), multiprocessing.Event()
+    workers = [multiprocessing.Process(target=worker, args=(engine, spacy, ready, done)) for _ in range(WORKERS)]
+    for process in workers:
+        process.start()
+    for _ in workers:
+        ready.acquire()
+    pss = sum(psutil.Process(process.pid).memory_full_info().pss for process in workers)
+    done.set()
+    for process in workers:
+        process.join()
+
+    mb = 1024 * 1024
+    print(f'{engine:<8} cold start {elapsed * 1000:8.1f}ms  rss {rss / mb:7.1f}MB  uss {uss / mb:7.1f}MB  '
+          f'pss of {WORKERS} workers {pss / mb:7.1f}MB')
+
+
+def main():
+    spacy = '--spacy' in sys.argv
+    # export once beforehand, as the first loader process would
+    for engine in ENGINES:
+        Classifier(engine=engine).model
+    multiprocessing.set_start_method('spawn')
+
+    for engine in ENGINES:
+        measure(engine, spacy)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+""" Time building a limit=1000 JSON payload: model objects + jsonable_encoder vs SQLite json_object.
+
+Run from the repository root: python benchmarks/json_encoding.py
+"""
+import json
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'napp'))
+
+from fastapi.encoders import jsonable_encoder
+from database import NappDatabase, connect, json_array
+from models import News, Event, Tweet
+
+LIMIT = 1000
+REPEAT = 10
+
+
+def seed(db):
+    with open('json/news.json') as f:
+        articles = json.load(f)['articles']['results']
+
+    events = db.save_events_many([Event(name=f'event {i}', keywords=set(articles[i % len(articles)]['title'].lower().split()))
+                                  for i in range(LIMIT)])
+    db.save_news_many([News(headline=f"{articles[i % len(articles)]['title']} {i}",
+                            source=articles[i % len(articles)]['source']['title'],
+                            url=articles[i % len(articles)]['url'], country_code='gb', category_id=i % 7,
+                            event_id=events[i].id, text=articles[i % len(articles)]['body'][:1000],
+                            published_at=datetime(2020, 1, 1)) for i in range(LIMIT)])
+    db.save_tweets_many([Tweet(id=i + 1, text=articles[i % len(articles)]['title'], hashtags='a,b', user='user',
+                               event_id=events[i].id, published_at=datetime(2020, 1, 1)) for i in range(LIMIT)])
+
+
+def timed(build):
+    start = time.perf_counter()
+    for _ in range(REPEAT):
+        body = build()
+    return (time.perf_counter() - start) / REPEAT * 1000, len(body)
+
+
+def main():
+    with tempfile.TemporaryDirectory() as directory:
+        db = NappDatabase(connect(os.path.join(directory, 'napp.db')))
+        seed(db)
+
+        print(f'{"endpoint":<8} {"models ms":>10} {"sqlite json ms":>15} {"bytes":>9}')
+        for name, find, find_json in [('news', db.find_news, db.find_news_json),
+                                      ('events', db.find_events, db.find_events_json),
+                                      ('tweets', db.find_tweets, db.find_tweets_json)]:
+            models_ms, _ = timed(lambda: json.dumps(jsonable_encoder(list(find(LIMIT)))).encode('utf-8'))
+            json_ms, size = timed(lambda: json_array(list(find_json(LIMIT))).encode('utf-8'))
+            print(f'{name:<8} {models_ms:>10.1f} {json_ms:>15.1f} {size:>9}')
+
+
+if __name__ == '__main__':
+    main()
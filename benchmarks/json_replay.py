@@ -0,0 +1,78 @@
+""" Peak memory of replaying a recorded EventRegistry response, whole against streamed.
+
+The articles of json/news.json are repeated, with distinct urls, into
+files of growing size. Each file is read into News objects, by json.load
+and a list as load_news_from_file used to, and by load_news_from_file's
+streaming reader, consuming the news in chunks as the pipeline does.
+
+Run from the repository root: python benchmarks/json_replay.py
+"""
+import itertools
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'napp'))
+
+from eventregistry_source import EventRegistrySource
+
+SIZES = [1000, 10000, 50000]
+CHUNK_SIZE = 64
+
+
+def write_articles(filename, count):
+    with open('json/news.json') as f:
+        articles = json.load(f)['articles']['results']
+    with open(filename, 'w') as f:
+        f.write('[')
+        for i in range(count):
+            article = dict(articles[i % len(articles)], url=f'https://example.com/{i}')
+            f.write((',' if i else '') + json.dumps(article))
+        f.write(']')
+
+
+def whole(source):
+    with open(source.record_response_file) as f:
+        articles = json.load(f)
+    news_list = [source.news_from_api(obj) for obj in articles]
+    return len(news_list)
+
+
+def streamed(source):
+    news = source.load_news_from_file()
+    count = 0
+    while True:
+        chunk = list(itertools.islice(news, CHUNK_SIZE))
+        if not chunk:
+            return count
+        count += len(chunk)
+
+
+def measure(name, function, source):
+    tracemalloc.start()
+    started = time.perf_counter()
+    count = function(source)
+    elapsed = time.perf_counter() - started
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print(f'  {name:<9} {count:>6} news {elapsed:6.2f}s  peak {peak / 1024 / 1024:8.1f}MB')
+
+
+def main():
+    directory = tempfile.mkdtemp()
+    for size in SIZES:
+        filename = os.path.join(directory, f'articles_{size}.json')
+        write_articles(filename, size)
+        print(f'{size} articles, {os.path.getsize(filename) / 1024 / 1024:.1f}MB')
+        source = EventRegistrySource(api_key=None, record_response_file=filename)
+        measure('json.load', whole, source)
+        measure('streamed', streamed, source)
+        os.remove(filename)
+    os.rmdir(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+""" Minimal HTTP load generator for api_server.
+
+Start the server first (python napp/api_server.py, API_WORKERS=4 for
+several processes), then run from the repository root:
+
+    python benchmarks/load_test.py --path /news --path /events --clients 200 --seconds 20
+"""
+import argparse
+import asyncio
+import random
+import time
+
+
+async def client(host, port, paths, deadline, latencies, errors):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        while time.perf_counter() < deadline:
+            path = random.choice(paths)
+            request = f'GET {path} HTTP/1.1\r\nHost: {host}\r\nConnection: keep-alive\r\n\r\n'
+            start = time.perf_counter()
+            writer.write(request.encode('ascii'))
+
+            status_line = await reader.readline()
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b''):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+            await reader.readexactly(int(headers.get('content-length', 0)))
+
+            latencies.append(time.perf_counter() - start)
+            if not status_line.split()[1:2] or status_line.split()[1] not in (b'200', b'304'):
+                errors.append(status_line)
+    finally:
+        writer.close()
+
+
+async def run(args):
+    deadline = time.perf_counter() + args.seconds
+    latencies, errors = [], []
+    await asyncio.gather(*(client(args.host, args.port, args.path or ['/news'], deadline, latencies, errors)
+                           for _ in range(args.clients)))
+
+    latencies.sort()
+    count = len(latencies)
+    print(f'requests: {count} errors: {len(errors)} rate: {count / args.seconds:.0f} req/s')
+    if count:
+        for percentile in [50, 90, 99]:
+            print(f'p{percentile}: {latencies[min(count - 1, count * percentile // 100)] * 1000:.1f} ms')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--path', action='append')
+    parser.add_argument('--clients', type=int, default=100)
+    parser.add_argument('--seconds', type=int, default=10)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
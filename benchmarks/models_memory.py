@@ -0,0 +1,102 @@
+""" Memory per record of Event and Tweet, as plain dataclasses and as the slotted models.
+
+Builds N records of each with the same field values, as the loaders and
+NappDatabase do, and reports the bytes allocated per record. Each event
+has keywords drawn from a vocabulary shared by all events, split from a
+new string per event as they are from database rows.
+
+Run from the repository root: python benchmarks/models_memory.py [N]
+"""
+import gc
+import os
+import sys
+import tracemalloc
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Set, Union
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'napp'))
+
+import models
+from database import KEYWORD_SEPARATOR
+
+N = 1000000
+VOCABULARY = [f'keyword{i}' for i in range(5000)]
+KEYWORDS_PER_EVENT = 6
+
+
+# the models before they were slotted
+@dataclass
+class Event:
+    id: Union[int, None] = None
+    name: str = ""
+    summary: str = ""
+    keywords: Set[str] = None
+    created_at: datetime = datetime.utcnow()
+    updated_at: datetime = datetime.utcnow()
+
+
+@dataclass
+class Tweet:
+    id: Union[int, None] = None
+    text: str = ""
+    hashtags: str = ""
+    url: str = ""
+    user: str = ""
+    category_id: Union[int, None] = None
+    event_id: Union[int, None] = None
+    published_at: datetime = datetime.utcnow()
+    created_at: datetime = datetime.utcnow()
+
+
+NOW = datetime(2020, 2, 20, 12)
+
+
+def event_rows(n):
+    for i in range(n):
+        keywords = KEYWORD_SEPARATOR.join(VOCABULARY[(i * 7 + j * 13) % len(VOCABULARY)]
+                                          for j in range(KEYWORDS_PER_EVENT))
+        yield i, f'Event {i}', '', keywords, NOW, NOW
+
+
+def tweet_rows(n):
+    for i in range(n):
+        yield i, f'Tweet {i}', '#news', 'user', f'https://t.co/{i}', 1, i // 10, NOW, NOW
+
+
+def plain_event(row):
+    return Event(id=row[0], name=row[1], summary=row[2], keywords=set(row[3].split(KEYWORD_SEPARATOR)),
+                 created_at=row[4], updated_at=row[5])
+
+
+def slotted_event(row):
+    return models.Event(row[0], row[1], row[2], row[3].split(KEYWORD_SEPARATOR), row[4], row[5])
+
+
+def plain_tweet(row):
+    return Tweet(id=row[0], text=row[1], hashtags=row[2], user=row[3], url=row[4], category_id=row[5],
+                 event_id=row[6], published_at=row[7], created_at=row[8])
+
+
+def per_record(build, rows, n):
+    gc.collect()
+    tracemalloc.start()
+    records = [build(row) for row in rows(n)]
+    allocated = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del records
+    return allocated / n
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else N
+    for name, rows, plain, slotted in [('events', event_rows, plain_event, slotted_event),
+                                       ('tweets', tweet_rows, plain_tweet, lambda row: models.Tweet(*row))]:
+        before = per_record(plain, rows, n)
+        after = per_record(slotted, rows, n)
+        print(f'{n} {name}: dataclass {before:6.0f} bytes  slotted {after:6.0f} bytes per record  '
+              f'{(before - after) * n / 2**20:7.1f}MB saved')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+""" Precision and latency of MinHash LSH story matching against keyword overlap matching.
+
+json/news.json has no story labels, so each article is rewritten a few
+times the way other sources report the same story: another " - Source"
+suffix, sentences dropped and a few words changed. A rewrite should match
+the story of its original article, and nothing else.
+
+Run from the repository root: python benchmarks/story_clustering.py
+"""
+import json
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'napp'))
+
+from event_index import EventIndex
+from models import Event
+from story_clustering import StoryClusters, similarity
+
+REWRITES = 3
+SOURCES = ['BBC News', 'Sky News', 'The Guardian', 'Reuters']
+
+
+def load_articles():
+    with open('json/news.json') as f:
+        articles = json.load(f)['articles']['results']
+    return [(article['title'], article['body']) for article in articles]
+
+
+def rewrite(headline, body, vocabulary):
+    sentences = re.split(r'(?<=[.!?])\s+', body)
+    kept = [sentence for sentence in sentences if random.random() < 0.7] or sentences[:1]
+    words = ' '.join(kept).split(' ')
+    for _ in range(len(words) // 20):
+        words[random.randrange(len(words))] = random.choice(vocabulary)
+    return f'{headline} - {random.choice(SOURCES)}', ' '.join(words)
+
+
+def keywords(headline):
+    # stands in for named entities
+    return set(word for word in re.findall(r'\w+', headline) if word[:1].isupper())
+
+
+def score(name, matches, elapsed):
+    answered = [(expected, found) for expected, found in matches if found is not None]
+    correct = sum(1 for expected, found in answered if expected == found)
+    precision = correct / len(answered) if answered else 0
+    recall = correct / len(matches)
+    print(f'{name:<20} precision {precision:6.1%} recall {recall:6.1%} '
+          f'latency {elapsed / len(matches) * 1e6:8.1f}us per query')
+
+
+def match_quality(articles, queries, thresholds):
+    for threshold in thresholds:
+        stories = StoryClusters(threshold=threshold)
+        for story_id, (headline, body) in enumerate(articles, start=1):
+            stories.add(story_id, story_id, stories.signature(headline + ' ' + body))
+
+        started = time.perf_counter()
+        matches = [(expected, stories.match(stories.signature(headline + ' ' + body))[0])
+                   for expected, headline, body in queries]
+        score(f'minhash lsh {threshold}', matches, time.perf_counter() - started)
+
+    events = EventIndex()
+    for story_id, (headline, body) in enumerate(articles, start=1):
+        events.add(Event(id=story_id, keywords=keywords(headline)))
+
+    started = time.perf_counter()
+    matches = []
+    for expected, headline, body in queries:
+        candidates = events.candidates(keywords(headline))
+        matches.append((expected, candidates[0][0].id if candidates else None))
+    score('keyword overlap', matches, time.perf_counter() - started)
+
+
+def lookup_latency(articles, vocabulary, sizes):
+    """ Time match() against a linear scan of every signature as the number of documents grows. """
+    for size in sizes:
+        stories = StoryClusters()
+        for i in range(size):
+            headline, body = articles[i % len(articles)]
+            headline, body = rewrite(headline, body, vocabulary)
+            stories.add(i, i, stories.signature(headline + ' ' + body))
+
+        signatures = [stories.signature(' '.join(rewrite(*article, vocabulary))) for article in articles]
+
+        started = time.perf_counter()
+        for signature in signatures:
+            stories.match(signature)
+        lsh = (time.perf_counter() - started) / len(signatures)
+
+        started = time.perf_counter()
+        for signature in signatures:
+            max(stories.signatures, key=lambda key: similarity(signature, stories.signatures[key]))
+        scan = (time.perf_counter() - started) / len(signatures)
+
+        print(f'{size:>6} documents  lsh {lsh * 1e3:8.3f}ms  linear scan {scan * 1e3:8.3f}ms per query')
+
+
+def main():
+    random.seed(1)
+    articles = load_articles()
+    vocabulary = ' '.join(body for _, body in articles).split(' ')
+
+    queries = [(story_id, *rewrite(headline, body, vocabulary))
+               for story_id, (headline, body) in enumerate(articles, start=1) for _ in range(REWRITES)]
+    print(f'{len(articles)} stories, {len(queries)} rewrites')
+    match_quality(articles, queries, [0.2, 0.3, 0.5])
+
+    print()
+    lookup_latency(articles, vocabulary, [100, 1000, 5000])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+""" Compare the previous word deleting make_summary with the batched sentence summariser.
+
+Uses the article bodies of tests/data and json/news.json. Run from the
+repository root: python benchmarks/summariser.py
+"""
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'napp'))
+
+from classifier import Classifier, PARSE_DISABLED
+from summariser import doc_sentences, summarise, SUMMARY_CHARS
+
+
+def load_bodies():
+    bodies = []
+    for filename in ['tests/data/event_registry_org.json', 'tests/data/event_registry_org2.json',
+                     'tests/data/event_registry_org3.json']:
+        with open(filename) as f:
+            bodies.extend(article['body'] for article in json.load(f))
+    with open('tests/data/newsapi.json') as f:
+        bodies.extend(article['content'] or article['description'] or '' for article in json.load(f))
+    with open('json/news.json') as f:
+        bodies.extend(article['body'] for article in json.load(f)['articles']['results'])
+    return [body for body in bodies if body]
+
+
+def timed(name, function, count):
+    started = time.perf_counter()
+    result = function()
+    elapsed = time.perf_counter() - started
+    print(f'{name:<36} {elapsed:8.2f}s {elapsed / count * 1000:8.2f}ms per body')
+    return result
+
+
+def main():
+    bodies = load_bodies()
+    words = sum(len(body.split()) for body in bodies)
+    print(f'{len(bodies)} bodies, {words / len(bodies):.0f} words on average')
+
+    classifier = Classifier()
+    classifier.make_summaries(bodies[:5])
+
+    old = timed('make_frequency_summary, one by one',
+        lambda: [classifier.make_frequency_summary(body)[:SUMMARY_CHARS] for body in bodies], len(bodies))
+    new = timed('make_summaries, one batch', lambda: classifier.make_summaries(bodies), len(bodies))
+
+    # the summariser alone, without tagging
+    docs = list(classifier.nlp.pipe(bodies, disable=PARSE_DISABLED))
+    documents = [doc_sentences(doc) for doc in docs]
+    timed('summarise, tagged already', lambda: summarise(documents), len(bodies))
+
+    print()
+    for name, summaries in [('old', old), ('new', new)]:
+        lengths = [len(summary) for summary in summaries]
+        # the old summary is cut mid sentence when it is longer than the budget
+        cut = sum(1 for summary in summaries if summary and summary[-1] not in '.!?"\'')
+        print(f'{name}: mean length {sum(lengths) / len(lengths):.0f} chars, {cut} not ending a sentence')
+
+
+if __name__ == '__main__':
+    main()
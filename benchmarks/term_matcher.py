@@ -0,0 +1,68 @@
+""" Compare Classifier.match (three n-gram scans) with the compiled TermMatcher.
+
+Run from the repository root: python benchmarks/term_matcher.py
+"""
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'napp'))
+
+from classifier import Classifier, clean_text
+
+
+def load_headlines():
+    with open('json/news.json') as f:
+        articles = json.load(f)['articles']['results']
+    return [article['title'] for article in articles]
+
+
+def grow_terms(terms, size, vocabulary):
+    """ Pad a term set with random 1-4 word phrases to simulate a bigger list. """
+    terms = set(terms)
+    while len(terms) < size:
+        terms.add(' '.join(random.choice(vocabulary) for _ in range(random.randint(1, 4))))
+    return terms
+
+
+def timed(func, texts, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for text in texts:
+            func(text)
+    return (time.perf_counter() - start) / (repeat * len(texts)) * 1e6
+
+
+def main():
+    random.seed(0)
+    classifier = Classifier.__new__(Classifier)
+    classifier.env_terms = classifier.load_terms('model/env_terms.csv', lambda row: row[1])
+    classifier.lgbt_terms = classifier.load_terms('model/lgbt_terms.csv', lambda row: row[0])
+    classifier.youth_terms = classifier.load_terms('model/youth_terms.csv', lambda row: row[0])
+
+    headlines = load_headlines()
+    vocabulary = sorted({word for text in headlines for word in clean_text(text).split(' ') if word})
+
+    def old_match(text):
+        if classifier.match(text, classifier.env_terms):
+            return 4
+        if classifier.match(text, classifier.lgbt_terms):
+            return 5
+        if classifier.match(text, classifier.youth_terms):
+            return 6
+
+    print(f'{"terms":>8} {"match() us":>12} {"TermMatcher us":>15}')
+    for size in [0, 1000, 5000, 20000]:
+        if size:
+            classifier.env_terms = grow_terms(classifier.env_terms, size, vocabulary)
+        classifier.compile_terms()
+        old_us = timed(old_match, headlines, 20)
+        new_us = timed(classifier.match_category, headlines, 20)
+        total = len(classifier.env_terms) + len(classifier.lgbt_terms) + len(classifier.youth_terms)
+        print(f'{total:>8} {old_us:>12.1f} {new_us:>15.1f}')
+
+
+if __name__ == '__main__':
+    main()
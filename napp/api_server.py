@@ -1,16 +1,30 @@
+import os
+import asyncio
 import uvicorn
-from fastapi import FastAPI, Depends
+from fastapi import FastAPI, Depends, HTTPException
+from starlette.concurrency import run_in_threadpool
 from starlette.middleware.cors import CORSMiddleware
-import sqlite3
-from database import NappDatabase
+from starlette.requests import Request
+from starlette.responses import Response, StreamingResponse
+from database import json_array, next_json_cursor
+from db_pool import ReadPool
+from response_cache import ResponseCache
+from live_feed import FeedBroker
 from datetime import datetime
 
+# largest page a client can ask for, the since= queries are bounded by it too
+MAX_LIMIT = 100
+# live feed clients get a comment line at least this often, to notice disconnects
+KEEPALIVE_SEC = 15
+DATABASE_FILE = 'database/napp.db'
+
 app = FastAPI()
 
-conn = sqlite3.connect('database/napp.db', 
-            detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES)
+# opened on startup, so each uvicorn worker process gets its own connections
+pool = None
 
-db = NappDatabase(conn)
+# responses are served from memory until a loader commits new data
+cache = ResponseCache(version_ttl_sec=1.0)
 
 app.add_middleware(
     CORSMiddleware,
@@ -18,41 +32,166 @@ app.add_middleware(
     # allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "ETag"],
 )
 
+async def query(find):
+    """ Run find(db) with a pooled connection in a worker thread, off the event loop. """
+    return await run_in_threadpool(lambda: find(pool.database()))
+
+
+# one poll of the database per interval serves every live feed client of this worker
+broker = FeedBroker(query)
+
+
+@app.on_event("startup")
+async def open_pool():
+    global pool
+    pool = ReadPool(DATABASE_FILE)
+    await broker.start()
+
+
+@app.on_event("shutdown")
+async def close_pool():
+    await broker.stop()
+    pool.close()
+
+
 @app.get("/")
 def root():
     return {"message": "Hello World"}
 
 
+async def cached(request, build):
+    """ Serve the body and headers returned by build() through the response cache.
+
+    Answers 304 Not Modified when the client already has the current ETag.
+    """
+    if cache.version_expired():
+        cache.set_version(await query(lambda db: db.find_data_version()))
+
+    key = (request.url.path, tuple(sorted(request.query_params.multi_items())))
+    entry = cache.get(key)
+    if entry is None:
+        # another request may read a newer version while this one is built
+        version = cache.version
+        body, headers = await build()
+        entry = cache.put(key, body, headers, version)
+
+    headers = dict(entry.headers)
+    headers['ETag'] = entry.etag
+    # clients may keep the response but must revalidate it
+    headers['Cache-Control'] = 'no-cache'
+
+    if_none_match = request.headers.get('if-none-match', '')
+    if entry.etag in [tag.strip() for tag in if_none_match.split(',')] or if_none_match.strip() == '*':
+        return Response(status_code=304, headers=headers)
+    return Response(entry.body, media_type='application/json', headers=headers)
+
+
 @app.get("/news/{news_id}")
-async def get_news_by_id(news_id):
-    return db.find_news_by_id(news_id)
+async def get_news_by_id(request: Request, news_id: int):
+    async def build():
+        body = await query(lambda db: db.find_news_json_by_id(news_id))
+        return body.encode('utf-8'), {}
+    return await cached(request, build)
+
+
+def page(find, limit):
+    """ Build for a paged *_json query, passing the cursor of the next page in the X-Next-Cursor header.
+
+    SQLite renders every row as JSON, so the response body is made by joining
+    strings rather than encoding model objects field by field.
+    """
+    limit = max(1, min(limit, MAX_LIMIT))
+
+    async def build():
+        try:
+            rows = await query(lambda db: list(find(db, limit)))
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+        cursor = next_json_cursor(rows, limit)
+        return json_array(rows).encode('utf-8'), {'X-Next-Cursor': cursor} if cursor else {}
+
+    return build
+
+
+def parse_since(since):
+    try:
+        return datetime.fromisoformat(since)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
 
 @app.get("/news")
-async def get_news(limit: int = 10, offset: int = 0, since = None):
+async def get_news(request: Request, limit: int = 10, cursor: str = None, since: str = None):
     if since:
-        since_dt = datetime.fromisoformat(since)
-        return db.find_news_since(since_dt)
-    return db.find_news(limit, offset)
+        since_dt = parse_since(since)
+        build = page(lambda db, limit: db.find_news_since_json(since_dt, limit, cursor), limit)
+    else:
+        build = page(lambda db, limit: db.find_news_json(limit, cursor), limit)
+    return await cached(request, build)
 
 
 @app.get("/events")
-async def get_events(limit: int = 10, offset: int = 0, since = None):
+async def get_events(request: Request, limit: int = 10, cursor: str = None, since: str = None):
     if since:
-        since_dt = datetime.fromisoformat(since)
-        return db.find_events_since(since_dt)
-    return db.find_events(limit, offset)
+        since_dt = parse_since(since)
+        build = page(lambda db, limit: db.find_events_since_json(since_dt, limit, cursor), limit)
+    else:
+        build = page(lambda db, limit: db.find_events_json(limit, cursor), limit)
+    return await cached(request, build)
 
 
 @app.get("/tweets")
-async def get_tweets(limit: int = 10, offset: int = 0, event_id = None):
+async def get_tweets(request: Request, limit: int = 10, cursor: str = None, event_id: int = None):
     if event_id:
-        evnt_id = int(event_id)
-        return db.find_tweets_by_event_id(event_id)
-    return db.find_tweets(limit, offset)
+        build = page(lambda db, limit: db.find_tweets_by_event_id_json(event_id, limit, cursor), limit)
+    else:
+        build = page(lambda db, limit: db.find_tweets_json(limit, cursor), limit)
+    return await cached(request, build)
+
+
+@app.get("/feed")
+async def get_feed(request: Request, last_id: int = None):
+    """ Server-Sent Events stream of news, events and tweets as the loaders save them.
+
+    Clients resume after the last message they received with the Last-Event-ID
+    header (sent automatically by EventSource) or the last_id parameter.
+    """
+    last_event_id = request.headers.get('last-event-id')
+    if last_event_id:
+        try:
+            last_id = int(last_event_id)
+        except ValueError:
+            raise HTTPException(status_code=400, detail=f'Invalid Last-Event-ID: {last_event_id}')
+
+    subscription = broker.subscribe()
+
+    async def stream():
+        try:
+            if last_id is not None:
+                async for message in broker.replay(last_id, subscription):
+                    yield message
+
+            while not (subscription.dropped and subscription.queue.empty()):
+                try:
+                    message = await asyncio.wait_for(subscription.queue.get(), KEEPALIVE_SEC)
+                except asyncio.TimeoutError:
+                    if await request.is_disconnected():
+                        break
+                    yield ': keepalive\n\n'
+                    continue
+                if message is None:
+                    break
+                yield message
+        finally:
+            broker.unsubscribe(subscription)
+
+    return StreamingResponse(stream(), media_type='text/event-stream', headers={'Cache-Control': 'no-cache'})
 
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # each worker process opens its own read pool on startup
+    uvicorn.run("api_server:app", host="0.0.0.0", port=8000, workers=int(os.getenv('API_WORKERS', 1)))
@@ -1,13 +1,39 @@
 import os
-import pickle
+import hashlib
 import csv
 import re
 import json
+import threading
+import time
 import spacy
+import model_export
+import hashing_model
+import online_training
 from newsapi import NewsApiClient
+from term_matcher import TermMatcher
+from summariser import doc_sentences, summarise, SUMMARY_CHARS
 
 Categories = ['business', 'entertainment', 'health', 'tech & science', 'environment', 'lgbt', 'youth']
 
+IGNORED_ENTITY_LABELS = {'DATE','TIME','PERCENT','MONEY', 'QUANTITY', 'ORDINAL', 'CARDINAL'}
+
+# spaCy components not needed for named entities or for part of speech parsing
+NER_DISABLED = ['tagger', 'parser']
+PARSE_DISABLED = ['parser', 'ner']
+
+NLP_BATCH_SIZE = 64
+
+# how predict_category featurises and scores texts:
+#   pickle  - the pickled CountVectorizer and MultinomialNB
+#   mmap    - the same, exported to memory mapped arrays (model_export)
+#   hashing - hashed token counts, converted from the pickled model (hashing_model)
+#   online  - hashed token counts, the current checkpoint of online_training, swapped when it changes
+ENGINES = ['pickle', 'mmap', 'hashing', 'online']
+ENGINE = os.environ.get('CLASSIFIER_ENGINE', 'mmap')
+
+# how often the online engine looks for a new checkpoint
+MODEL_CHECK_SEC = 60
+
 def clean_text(s):
     return(remove_extra_space(s.lower()))
 
@@ -16,14 +42,132 @@ def remove_extra_space(s):
     s = re.sub(r'\W\s',' ',s)
     return re.sub(r'\s+',' ',s)
 
+def file_digest(*filenames):
+    digest = hashlib.md5()
+    for filename in filenames:
+        with open(filename, 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+class lazy:
+    """ Attribute computed by the decorated method on first use, then stored on the instance. """
+
+    lock = threading.RLock()
+
+    def __init__(self, function):
+        self.function = function
+        self.name = function.__name__
+        self.__doc__ = function.__doc__
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        # pipeline stages of several threads can ask for the same component at once
+        with self.lock:
+            if self.name not in instance.__dict__:
+                instance.__dict__[self.name] = self.function(instance)
+        return instance.__dict__[self.name]
+
+
 class Classifier:
-    def __init__(self, model_filename='model/nb.model', vectoriser_filename='model/nb.vectorizer'):
-        self.model = pickle.load(open(model_filename, 'rb'))
-        self.vectoriser = pickle.load(open(vectoriser_filename, 'rb'))
+    """ Category model, keyword lists and spaCy pipeline, each loaded on first use.
+
+    Only predict_category needs the category model and its vectoriser, read
+    from memory mapped arrays exported from the pickled files (see
+    model_export), which the loader processes share. spaCy is loaded by the
+    first named entity or summary call. See ENGINES for the other engines.
+    """
+
+    # checkpoint version of the online engine's model, once loaded
+    model_version = None
+    model_checked_at = 0
+
+    def __init__(self, model_filename='model/nb.model', vectoriser_filename='model/nb.vectorizer',
+                 export_directory=None, engine=ENGINE):
+        if engine not in ENGINES:
+            raise ValueError(f'unknown classifier engine {engine}')
+        self.model_filename = model_filename
+        self.vectoriser_filename = vectoriser_filename
+        self.export_directory = export_directory
+        self.engine = engine
         self.env_terms = self.load_terms('model/env_terms.csv', lambda row: row[1])
         self.lgbt_terms = self.load_terms('model/lgbt_terms.csv', lambda row: row[0])
         self.youth_terms = self.load_terms('model/youth_terms.csv', lambda row: row[0])
-        self.nlp = spacy.load("en_core_web_md")
+        self.compile_terms()
+
+    @lazy
+    def digest(self):
+        return file_digest(self.model_filename, self.vectoriser_filename)
+
+    @lazy
+    def version(self):
+        # identifies the models, so cached results are dropped when any of them changes
+        digest = self.digest
+        if self.engine == 'hashing':
+            digest += '-hashing'
+        elif self.engine == 'online':
+            # loads the current checkpoint, and so its version, if not loaded yet
+            self.model_and_vectoriser
+            digest += '-online-' + self.model_version
+        # None when the spaCy model is not an installed package, then its own meta has the version
+        spacy_version = spacy.util.get_package_version('en_core_web_md') or self.nlp.meta.get('version', '')
+        return digest + '-' + spacy_version
+
+    @lazy
+    def model_and_vectoriser(self):
+        if self.engine == 'pickle':
+            return model_export.load_pickles(self.model_filename, self.vectoriser_filename)
+
+        if self.engine == 'mmap':
+            vectoriser, model = model_export.load_or_export(self.model_filename, self.vectoriser_filename,
+                self.digest, self.export_directory or model_export.EXPORT_DIRECTORY)
+        elif self.engine == 'hashing':
+            vectoriser, model = hashing_model.load_or_convert(self.model_filename, self.vectoriser_filename,
+                self.digest, self.export_directory or hashing_model.CONVERT_DIRECTORY)
+        else:
+            self.model_version, vectoriser, model = online_training.load_or_start(
+                self.model_filename, self.vectoriser_filename, self.digest, list(range(len(Categories))),
+                self.checkpoint_directory)
+            self.model_checked_at = time.monotonic()
+        return model, vectoriser
+
+    @property
+    def checkpoint_directory(self):
+        return self.export_directory or online_training.CHECKPOINT_DIRECTORY
+
+    def refresh_model(self):
+        """ Swap to the current checkpoint of the online engine if it changed, at most every MODEL_CHECK_SEC. """
+        if self.model_version is None or time.monotonic() - self.model_checked_at < MODEL_CHECK_SEC:
+            return False
+        self.model_checked_at = time.monotonic()
+
+        version = online_training.current_version(self.checkpoint_directory)
+        if not version or version == self.model_version:
+            return False
+        vectoriser, model = online_training.load(self.checkpoint_directory, version)
+        # batches already started finish with the previous pair, read once per batch
+        with lazy.lock:
+            self.__dict__.update(model=model, vectoriser=vectoriser, model_and_vectoriser=(model, vectoriser))
+            self.model_version = version
+            # cached results of the previous model are not reused
+            self.__dict__.pop('version', None)
+        print(f'Classifier swapped to model {version}')
+        return True
+
+    @lazy
+    def model(self):
+        return self.model_and_vectoriser[0]
+
+    @lazy
+    def vectoriser(self):
+        return self.model_and_vectoriser[1]
+
+    @lazy
+    def nlp(self):
+        nlp = spacy.load("en_core_web_md")
+        # sentence boundaries for summaries without running the dependency parser
+        nlp.add_pipe(nlp.create_pipe('sentencizer'))
+        return nlp
 
     def load_terms(self, filename, extract):
         terms = set()
@@ -34,38 +178,58 @@ class Classifier:
         
         return terms 
 
+    def compile_terms(self):
+        # keyword overrides in priority order: environment, lgbt, youth
+        self.term_matcher = TermMatcher([(4, self.env_terms), (5, self.lgbt_terms), (6, self.youth_terms)])
+
     def predict_category(self, text):
-        normalised = [clean_text(text)]
-        x = self.vectoriser.transform(normalised)
-        y = self.model.predict(x)
-        if self.match(text, self.env_terms):
-            return 4 
-        if self.match(text, self.lgbt_terms):
-            return 5 
-        if self.match(text, self.youth_terms):
-            return 6
-
-        return int(y[0])
+        return self.predict_categories([text])[0]
 
-    def match(self, text, terms):
+    def predict_categories(self, texts):
+        """ Predict categories for many texts with one vectoriser and one model call. """
+        texts = list(texts)
+        if not texts:
+            return []
+        self.refresh_model()
+        # one read, so a swap from another thread cannot pair the new vectoriser with the old model
+        model, vectoriser = self.model_and_vectoriser
+
+        # every vectoriser lowercases and splits on non word characters, as clean_text would
+        x = vectoriser.transform(texts)
+        y = model.predict(x)
+
+        categories = []
+        for text, predicted in zip(texts, y):
+            override = self.match_category(text)
+            categories.append(override if override is not None else int(predicted))
+        return categories
+
+    def match_category(self, text):
+        """ Return the category forced by the keyword lists, or None. """
+        return self.term_matcher.match(clean_text(text).split(' '))
+
+    def ngrams(self, text):
         words = clean_text(text).split(' ')
         twograms = [words[i] + ' ' + words[i+1] for i in range(len(words)-1)]
         threegrams = [words[i] + ' ' + words[i+1] + ' ' + words[i+2] for i in range(len(words)-2)]
         words.extend(twograms)
         words.extend(threegrams)
-    
-        for word in words:
-            if word in terms:
-                return True
-        return False 
+        return words
+
+    def match(self, text, terms):
+        return not terms.isdisjoint(self.ngrams(text))
     
     def get_named_entities(self, text):
-        doc = self.nlp(text)
-        keywords = set(ent.text.lower() for ent in doc.ents 
-            if ent.label_ not in ['DATE','TIME','PERCENT','MONEY', 'QUANTITY', 'ORDINAL', 'CARDINAL'])
-        if "coronavirus" in text.lower(): 
-            keywords.add('coronavirus') 
-        return keywords
+        return next(self.get_named_entities_many([text]))
+
+    def get_named_entities_many(self, texts, batch_size=NLP_BATCH_SIZE, n_process=1):
+        """ Stream texts through the NER pipeline, yielding one keyword set per text. """
+        docs = self.nlp.pipe(texts, batch_size=batch_size, n_process=n_process, disable=NER_DISABLED)
+        for doc in docs:
+            keywords = set(ent.text.lower() for ent in doc.ents if ent.label_ not in IGNORED_ENTITY_LABELS)
+            if "coronavirus" in doc.text.lower(): 
+                keywords.add('coronavirus') 
+            yield keywords
     
     def get_keywords(self, text):
         text = remove_extra_space(text)
@@ -110,19 +274,28 @@ class Classifier:
         return new_wordlist
 
     def parse(self, body):
-        nlp_body = self.nlp(body)
-        word_list = []
-        for word in nlp_body:
-            word_list.append(word)
+        return next(self.parse_many([body]))
 
-        return word_list
+    def parse_many(self, bodies, batch_size=NLP_BATCH_SIZE, n_process=1):
+        """ Stream bodies through the tagger, yielding one token list per body. """
+        docs = self.nlp.pipe(bodies, batch_size=batch_size, n_process=n_process, disable=PARSE_DISABLED)
+        for doc in docs:
+            yield list(doc)
+
+    def make_summary(self, body, budget=SUMMARY_CHARS):
+        return self.make_summaries([body], budget)[0]
+
+    def make_summaries(self, bodies, budget=SUMMARY_CHARS, batch_size=NLP_BATCH_SIZE, n_process=1):
+        """ Extractive summaries of at most budget characters, tagging all bodies in one pipe. """
+        docs = self.nlp.pipe(bodies, batch_size=batch_size, n_process=n_process, disable=PARSE_DISABLED)
+        return summarise([doc_sentences(doc) for doc in docs], budget)
 
-    def make_summary(self, body):
+    def make_frequency_summary(self, body):
+        """ Previous word deleting summary, kept for benchmarks/summariser.py. """
         word_list = self.parse(body)
         new_list = self.remove_adjectives(self.remove_subdescription(word_list))
         key_word_dict = self.key_words(self.freq_dict(word_list))
         summary_list = self.remove_less_freq(key_word_dict, new_list)
-        print("Initial word count:", len(word_list), "Summary word count:", len(summary_list))
         return " ".join(str(token) for token in summary_list)
 
     def freq_dict(self, word_list):
@@ -0,0 +1,192 @@
+import hashlib
+import json
+import multiprocessing
+import sqlite3
+from collections import OrderedDict
+from summariser import SUMMARY_CHARS
+
+CATEGORY = 'category'
+NAMED_ENTITIES = 'ner'
+# sentence summaries replaced the word deleting ones, under a new kind so old entries are not reused
+SUMMARY = 'sentence-summary'
+# rows kept in the SQLite file, the oldest are deleted first
+MAX_ROWS = 200000
+# new rows written between two prunes of the SQLite file
+PRUNE_EVERY = 1000
+
+
+def normalise(text):
+    return ' '.join(text.split())
+
+
+class SharedCounts:
+    """ Hits and misses of the CachedClassifiers of several processes, such as NLP workers, in shared memory.
+
+    Create it in the parent process and pass it to the CachedClassifier of
+    each worker, through the initializer arguments of the process pool.
+    """
+
+    def __init__(self):
+        self.values = multiprocessing.Array('q', 2)
+
+    @property
+    def hits(self):
+        return self.values[0]
+
+    @property
+    def misses(self):
+        return self.values[1]
+
+    def add(self, hits, misses):
+        with self.values.get_lock():
+            self.values[0] += hits
+            self.values[1] += misses
+
+    def __str__(self):
+        hits, misses = self.values[:]
+        ratio = hits / (hits + misses) if hits + misses else 0
+        return f'CachedClassifier hits: {hits} misses: {misses} ({ratio:.0%}) in all processes'
+
+
+class CachedClassifier:
+    """ Memoises category, named entity and summary results of a Classifier.
+
+    Results are keyed by a hash of the model version, the kind of result and
+    the normalised text. Recent results are kept in an in-memory LRU; when a
+    filename is given they are also stored in a SQLite file, so a restarted
+    loader starts with a warm cache. The file keeps the results of the current
+    model version only, at most max_rows of them. Other Classifier methods
+    pass through. Hits and misses are also added to shared_counts, if given.
+    """
+
+    def __init__(self, classifier, max_items=10000, filename=None, shared_counts=None, max_rows=MAX_ROWS):
+        self.classifier = classifier
+        self.max_items = max_items
+        self.max_rows = max_rows
+        # prune on the first write
+        self.written_since_prune = PRUNE_EVERY
+        self.memory = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.shared_counts = shared_counts
+
+        self.conn = None
+        if filename:
+            # shared by the NLP worker processes of the loaders
+            self.conn = sqlite3.connect(filename, timeout=30)
+            with self.conn:
+                columns = [row[1] for row in self.conn.execute("PRAGMA table_info(ClassifierCache)")]
+                if columns and 'Version' not in columns:
+                    # rows of files written before they had a version could never be pruned
+                    self.conn.execute("DROP TABLE IF EXISTS ClassifierCache")
+                self.conn.execute("""
+                    CREATE TABLE IF NOT EXISTS ClassifierCache(
+                        Key TEXT PRIMARY KEY,
+                        Version TEXT NOT NULL,
+                        Value TEXT NOT NULL
+                    );
+                """)
+                self.conn.execute("CREATE INDEX IF NOT EXISTS ClassifierCacheVersion ON ClassifierCache(Version)")
+
+    def __getattr__(self, name):
+        return getattr(self.classifier, name)
+
+    def __str__(self):
+        total = self.hits + self.misses
+        ratio = self.hits / total if total else 0
+        return f'CachedClassifier hits: {self.hits} misses: {self.misses} ({ratio:.0%}) items: {len(self.memory)}'
+
+    def key(self, version, kind, text):
+        value = f'{version}\0{kind}\0{normalise(text)}'
+        return hashlib.sha1(value.encode('utf-8')).hexdigest()
+
+    def current_version(self):
+        """ Version of the classifier, once swapped to a new checkpoint of the online engine if there is one. """
+        self.classifier.refresh_model()
+        return self.classifier.version
+
+    def get(self, key):
+        """ Return the JSON encoded value for key, or None if it is not cached. """
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            return self.memory[key]
+
+        if self.conn:
+            row = self.conn.execute("SELECT Value FROM ClassifierCache WHERE Key=?", (key,)).fetchone()
+            if row:
+                self.remember(key, row[0])
+                return row[0]
+
+    def remember(self, key, value):
+        self.memory[key] = value
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_items:
+            self.memory.popitem(last=False)
+
+    def cached_many(self, kind, texts, compute_many):
+        """ Return decoded results for texts, computing all misses with one compute_many call. """
+        texts = list(texts)
+        # hits and computed results all come from, and are stored under, this version
+        version = self.current_version()
+        keys = [self.key(version, kind, text) for text in texts]
+        values = [self.get(key) for key in keys]
+
+        missing = [i for i, value in enumerate(values) if value is None]
+        self.hits += len(texts) - len(missing)
+        self.misses += len(missing)
+        if self.shared_counts:
+            self.shared_counts.add(len(texts) - len(missing), len(missing))
+
+        if missing:
+            computed = compute_many([texts[i] for i in missing])
+            new_rows = []
+            for i, result in zip(missing, computed):
+                values[i] = json.dumps(sorted(result) if isinstance(result, set) else result)
+                self.remember(keys[i], values[i])
+                new_rows.append((keys[i], values[i]))
+
+            if self.conn:
+                with self.conn:
+                    self.conn.executemany("INSERT OR REPLACE INTO ClassifierCache(Key, Version, Value) VALUES (?, ?, ?)",
+                                          ((key, version, value) for key, value in new_rows))
+                self.written_since_prune += len(new_rows)
+                if self.written_since_prune >= PRUNE_EVERY:
+                    self.prune(version)
+
+        return [json.loads(value) for value in values]
+
+    def prune(self, version):
+        """ Delete the rows of versions other than version, then the oldest rows over max_rows. """
+        with self.conn:
+            self.conn.execute("DELETE FROM ClassifierCache WHERE Version != ?", (version,))
+            # rows are replaced rather than updated, so the rowid order is the order they were written in
+            self.conn.execute("""
+                DELETE FROM ClassifierCache
+                WHERE rowid <= (SELECT rowid FROM ClassifierCache ORDER BY rowid DESC LIMIT 1 OFFSET ?)
+            """, (self.max_rows,))
+        self.written_since_prune = 0
+
+    def predict_category(self, text):
+        return self.predict_categories([text])[0]
+
+    def predict_categories(self, texts):
+        return self.cached_many(CATEGORY, texts, self.classifier.predict_categories)
+
+    def get_named_entities(self, text):
+        return next(self.get_named_entities_many([text]))
+
+    def get_named_entities_many(self, texts, **kwargs):
+        compute = lambda missing: self.classifier.get_named_entities_many(missing, **kwargs)
+        for keywords in self.cached_many(NAMED_ENTITIES, texts, compute):
+            yield set(keywords)
+
+    def make_summary(self, body, budget=SUMMARY_CHARS):
+        return self.make_summaries([body], budget)[0]
+
+    def make_summaries(self, bodies, budget=SUMMARY_CHARS, **kwargs):
+        compute = lambda missing: self.classifier.make_summaries(missing, budget, **kwargs)
+        return self.cached_many(f'{SUMMARY}:{budget}', bodies, compute)
+
+    def close(self):
+        if self.conn:
+            self.conn.close()
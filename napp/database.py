@@ -1,22 +1,158 @@
+import base64
+import json
 import sqlite3
+from pathlib import Path
 from classifier import Categories
 from models import *
+from dedup import news_keys
 from dateutil import parser
 
+# let the loaders and api_server read and write the same file without "database is locked"
+BUSY_TIMEOUT_SEC = 30
+CACHE_SIZE_KB = 64 * 1024
+MMAP_SIZE = 256 * 1024 * 1024
+
+# event keywords are read back as one column joined by this separator
+KEYWORD_SEPARATOR = '\x1f'
+
+SELECT_EVENT = """
+    SELECT EventID, Name, Summary,
+        (SELECT group_concat(Keyword, char(31)) FROM EventKeyword WHERE EventKeyword.EventID = Event.EventID),
+        CreatedAt, UpdatedAt
+    FROM Event """
+
+# rows rendered as JSON by SQLite itself, in the same shape as the models
+NEWS_JSON = """json_object(
+        'id', NewsID, 'headline', Headline, 'source', Source, 'url', URL, 'image_url', ImageURL,
+        'country_code', CountryCode, 'category_id', CategoryID, 'event_id', EventID,
+        'text', Text, 'summary', Summary,
+        'published_at', replace(PublishedAt, ' ', 'T'), 'created_at', replace(CreatedAt, ' ', 'T'))"""
+
+TWEET_JSON = """json_object(
+        'id', TweetID, 'text', Text, 'hashtags', Hashtags, 'url', URL, 'user', User,
+        'category_id', CategoryID, 'event_id', EventID,
+        'published_at', replace(PublishedAt, ' ', 'T'), 'created_at', replace(CreatedAt, ' ', 'T'))"""
+
+EVENT_JSON = """json_object(
+        'id', EventID, 'name', Name, 'summary', coalesce(Summary, ''),
+        'keywords', json((SELECT json_group_array(Keyword) FROM EventKeyword WHERE EventKeyword.EventID = Event.EventID)),
+        'created_at', replace(CreatedAt, ' ', 'T'), 'updated_at', replace(UpdatedAt, ' ', 'T'))"""
+
+# followed by the raw sort column and id for pagination cursors
+SELECT_NEWS_JSON = f"SELECT {NEWS_JSON}, CAST(CreatedAt AS TEXT), NewsID FROM News "
+SELECT_TWEET_JSON = f"SELECT {TWEET_JSON}, CAST(PublishedAt AS TEXT), TweetID FROM Tweet "
+SELECT_EVENT_JSON = f"SELECT {EVENT_JSON}, CAST(CreatedAt AS TEXT), EventID FROM Event "
+
+# (change id, kind, json) of saved rows, in the order they were saved
+SELECT_FEED_CHANGES_JSON = f"""
+    SELECT ChangeID, Kind,
+        CASE Kind
+            WHEN 'news' THEN (SELECT {NEWS_JSON} FROM News WHERE NewsID = FeedChange.RowID)
+            WHEN 'event' THEN (SELECT {EVENT_JSON} FROM Event WHERE EventID = FeedChange.RowID)
+            WHEN 'tweet' THEN (SELECT {TWEET_JSON} FROM Tweet WHERE TweetID = FeedChange.RowID)
+        END
+    FROM FeedChange
+    WHERE ChangeID > ?
+    ORDER BY ChangeID
+    LIMIT ? """
+
 def _sqlite_convert_timestamp(val):
     return parser.isoparse(val)
 
 sqlite3.register_converter("timestamp", _sqlite_convert_timestamp)
 
+def connect(filename, read_only=False, check_same_thread=True):
+    """ Open a connection tuned for several processes sharing the database.
+
+    Pass check_same_thread=False for a writable connection handed over to
+    another thread, such as the writer stage of a pipeline.
+    """
+    if read_only:
+        # read only connections may be closed by another thread than the one using them
+        conn = sqlite3.connect(Path(filename).absolute().as_uri() + '?mode=ro', uri=True,
+                timeout=BUSY_TIMEOUT_SEC, check_same_thread=False,
+                detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES)
+    else:
+        conn = sqlite3.connect(filename, timeout=BUSY_TIMEOUT_SEC, check_same_thread=check_same_thread,
+                detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES)
+        # readers do not block the writer and vice versa
+        conn.execute("PRAGMA journal_mode=WAL")
+        # in WAL mode only checkpoints need a full fsync
+        conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA cache_size=-{CACHE_SIZE_KB}")
+    conn.execute(f"PRAGMA mmap_size={MMAP_SIZE}")
+    return conn
+
+def encode_cursor(sort_value, row_id):
+    """ Opaque pagination cursor for the row after which the next page starts. """
+    data = json.dumps([str(sort_value), row_id]).encode('utf-8')
+    return base64.urlsafe_b64encode(data).decode('ascii')
+
+def decode_cursor(cursor):
+    """ Return (sort_value, row_id) of a cursor, raise ValueError if it is not valid. """
+    try:
+        sort_value, row_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except Exception:
+        raise ValueError(f'Invalid cursor: {cursor}')
+    if not isinstance(sort_value, str) or not isinstance(row_id, int):
+        raise ValueError(f'Invalid cursor: {cursor}')
+    return sort_value, row_id
+
+def json_array(rows):
+    """ Join rows of a *_json query into one JSON array. """
+    return '[' + ','.join(row[0] for row in rows) + ']'
+
+def next_json_cursor(rows, limit):
+    """ Cursor of the page after rows of a *_json query, or None on the last page. """
+    if limit is None or len(rows) < limit:
+        return None
+    return encode_cursor(rows[-1][1], rows[-1][2])
+
+def next_cursor(items, limit, sort_field):
+    """ Cursor of the page after items, or None when items was the last page. """
+    if limit is None or len(items) < limit:
+        return None
+    return encode_cursor(getattr(items[-1], sort_field), items[-1].id)
+
 class NappDatabase:
 
-    def __init__(self, conn):
+    def __init__(self, conn, create=True):
         self.conn = conn
-        # create database if does not exist
-        with self.conn:
-            self.create_database()
+        # callables notified with every saved event, e.g. EventIndex.add
+        self.event_listeners = []
+        # create database if does not exist, or upgrade it
+        if create:
+            with self.conn:
+                self.create_database()
 
     def create_database(self):
+        """ Apply the migrations newer than the version recorded in the database file.
+
+        Each migration and its version bump run in one immediate transaction,
+        which takes the write lock before the version is read again, so
+        loaders starting together never apply a migration twice.
+        """
+        version = self.conn.execute("PRAGMA user_version").fetchone()[0]
+        for number, migration in enumerate(MIGRATIONS, start=1):
+            if number <= version:
+                continue
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                if self.conn.execute("PRAGMA user_version").fetchone()[0] < number:
+                    migration(self)
+                    self.conn.execute(f"PRAGMA user_version={number}")
+                self.conn.commit()
+            except BaseException:
+                self.conn.rollback()
+                raise
+
+        # seed categories
+        self.conn.executemany(
+            "INSERT INTO Category(CategoryID, Name) values (?, ?) ON CONFLICT DO NOTHING", enumerate(Categories))
+
+    # migrations must also work on databases created before versions were recorded
+
+    def create_tables(self):
         create_category_table = """
         CREATE TABLE IF NOT EXISTS Category(
             CategoryID INTEGER PRIMARY KEY,
@@ -72,37 +208,187 @@ class NappDatabase:
         self.conn.execute(create_news_table)
         self.conn.execute(create_tweet_table)
 
-        # seed categories
-        self.conn.executemany(
-            "INSERT INTO Category(CategoryID, Name) values (?, ?) ON CONFLICT DO NOTHING", enumerate(Categories))
+
+    def add_event_updated_at(self):
+        event_columns = [row[1] for row in self.conn.execute("PRAGMA table_info(Event)")]
+        if 'UpdatedAt' not in event_columns:
+            self.conn.execute("ALTER TABLE Event ADD COLUMN UpdatedAt TIMESTAMP")
+            self.conn.execute("UPDATE Event SET UpdatedAt = CreatedAt")
+
+
+    def create_indexes(self):
+        # columns the find_* queries filter and sort by
+        self.conn.execute("CREATE INDEX IF NOT EXISTS NewsCreatedAt ON News(CreatedAt)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS NewsPublishedAt ON News(PublishedAt)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS EventCreatedAt ON Event(CreatedAt)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS EventUpdatedAt ON Event(UpdatedAt)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS TweetPublishedAt ON Tweet(PublishedAt)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS TweetEventID ON Tweet(EventID, PublishedAt)")
+
+
+    def create_event_keyword_table(self):
+        self.conn.execute("""
+        CREATE TABLE IF NOT EXISTS EventKeyword(
+            EventID INTEGER NOT NULL,
+            Keyword TEXT NOT NULL,
+            PRIMARY KEY(EventID, Keyword),
+            FOREIGN KEY(EventID) REFERENCES Event(EventID)
+        ) WITHOUT ROWID;
+        """)
+        self.conn.execute("CREATE INDEX IF NOT EXISTS EventKeywordKeyword ON EventKeyword(Keyword)")
+
+        event_columns = [row[1] for row in self.conn.execute("PRAGMA table_info(Event)")]
+        if 'Keywords' not in event_columns:
+            return
+
+        # move the comma joined keywords across, then rebuild Event without the column
+        rows = self.conn.execute("SELECT EventID, Keywords FROM Event WHERE Keywords IS NOT NULL AND Keywords != ''")
+        self.conn.executemany("INSERT OR IGNORE INTO EventKeyword(EventID, Keyword) VALUES (?, ?)",
+            ((event_id, keyword) for event_id, keywords in rows.fetchall() for keyword in keywords.split(',')))
+
+        self.conn.execute("""
+        CREATE TABLE EventWithoutKeywords(
+            EventID INTEGER PRIMARY KEY AUTOINCREMENT,
+            Name TEXT NOT NULL UNIQUE,
+            Summary TEXT,
+            CreatedAt TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            UpdatedAt TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        """)
+        self.conn.execute("""
+            INSERT INTO EventWithoutKeywords(EventID, Name, Summary, CreatedAt, UpdatedAt)
+            SELECT EventID, Name, Summary, CreatedAt, UpdatedAt FROM Event
+        """)
+        # keep AUTOINCREMENT from reusing ids of deleted events
+        self.conn.execute("""
+            UPDATE sqlite_sequence SET seq = (SELECT seq FROM sqlite_sequence WHERE name = 'Event')
+            WHERE name = 'EventWithoutKeywords'
+        """)
+        self.conn.execute("DROP TABLE Event")
+        self.conn.execute("ALTER TABLE EventWithoutKeywords RENAME TO Event")
+        self.create_indexes()
+
+
+    def create_data_version_table(self):
+        # single row counter, bumped by every write so readers can tell when cached results are stale
+        self.conn.execute("CREATE TABLE IF NOT EXISTS DataVersion(Version INTEGER NOT NULL)")
+        self.conn.execute("INSERT INTO DataVersion(Version) SELECT 0 WHERE NOT EXISTS (SELECT * FROM DataVersion)")
+
+
+    def create_feed_change_table(self):
+        # log of saved rows for the live feed, written by triggers so every writer is covered
+        self.conn.execute("""
+        CREATE TABLE IF NOT EXISTS FeedChange(
+            ChangeID INTEGER PRIMARY KEY AUTOINCREMENT,
+            Kind TEXT NOT NULL,
+            RowID INTEGER NOT NULL,
+            CreatedAt TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        """)
+        self.conn.execute("CREATE INDEX IF NOT EXISTS FeedChangeCreatedAt ON FeedChange(CreatedAt)")
+        for kind, table, id_column in [('news', 'News', 'NewsID'), ('event', 'Event', 'EventID'), ('tweet', 'Tweet', 'TweetID')]:
+            for operation in ['INSERT', 'UPDATE']:
+                self.conn.execute(f"""
+                    CREATE TRIGGER IF NOT EXISTS {table}{operation.title()}Feed AFTER {operation} ON {table}
+                    BEGIN
+                        INSERT INTO FeedChange(Kind, RowID) VALUES ('{kind}', NEW.{id_column});
+                    END
+                """)
+
+
+    def create_news_url_index(self):
+        # duplicate checks look news up by url as well as by headline
+        self.conn.execute("CREATE INDEX IF NOT EXISTS NewsURL ON News(URL)")
+
+
+    def create_news_key_table(self):
+        # normalised url and headline of news, see dedup.news_keys, so duplicates are found with another
+        # source suffix or tracking parameters
+        self.conn.execute("""
+        CREATE TABLE IF NOT EXISTS NewsKey(
+            Key TEXT PRIMARY KEY,
+            NewsID INTEGER NOT NULL,
+            FOREIGN KEY(NewsID) REFERENCES News(NewsID)
+        ) WITHOUT ROWID;
+        """)
+        self.conn.execute("CREATE INDEX IF NOT EXISTS NewsKeyNewsID ON NewsKey(NewsID)")
+
+        rows = self.conn.execute("SELECT NewsID, URL, Headline FROM News ORDER BY NewsID").fetchall()
+        self.conn.executemany("INSERT OR REPLACE INTO NewsKey(Key, NewsID) VALUES (?, ?)",
+            ((key, news_id) for news_id, url, headline in rows for key in news_keys(url, headline)))
+
+
+    def find_last_change_id(self):
+        return self.conn.execute("SELECT coalesce(max(ChangeID), 0) FROM FeedChange").fetchone()[0]
+
+
+    def find_feed_changes_json(self, after_change_id, limit=500):
+        """ Return (change id, kind, json) of rows saved after a change, json is None for rows since replaced. """
+        c = self.conn.cursor()
+        c.execute(SELECT_FEED_CHANGES_JSON, (after_change_id, limit))
+        return c.fetchall()
+
+
+    def prune_feed_changes(self, start_date):
+        """ Forget changes logged before start_date, live feed clients cannot resume from before it. """
+        with self.conn:
+            self.conn.execute("DELETE FROM FeedChange WHERE CreatedAt < ?", (start_date,))
+
+
+    def _bump_data_version(self):
+        self.conn.execute("UPDATE DataVersion SET Version = Version + 1")
+
+
+    def find_data_version(self):
+        return self.conn.execute("SELECT Version FROM DataVersion").fetchone()[0]
 
 
     def save_news(self, news):
+        return self.save_news_many([news])[0]
+
+
+    def save_news_many(self, news_list):
+        """ Save news in one transaction and set their ids. """
+        # as with INSERT OR REPLACE, the last news with a headline wins
+        news_list = list({news.headline: news for news in news_list}.values())
+        if not news_list:
+            return []
+
         sql = """ INSERT OR REPLACE INTO News(Headline, Source, URL, ImageURL, CountryCode, CategoryID, EventID, Text, Summary, PublishedAt)
                 VALUES(?,?,?,?,?,?,?,?,?,?); """
         
-        cur = self.conn.cursor()
-        cur.execute(sql, (news.headline, news.source, news.url, news.image_url, news.country_code, 
-                            news.category_id, news.event_id, news.text, news.summary, news.published_at))
-        
-        return self.find_news_headline(news.headline)
+        with self.conn:
+            # the keys of news about to be replaced, whose old url may not be among the new keys
+            self.conn.executemany("DELETE FROM NewsKey WHERE NewsID IN (SELECT NewsID FROM News WHERE Headline=?)",
+                ((news.headline,) for news in news_list))
+            self.conn.executemany(sql, ((news.headline, news.source, news.url, news.image_url, news.country_code, 
+                            news.category_id, news.event_id, news.text, news.summary, news.published_at)
+                            for news in news_list))
+            last_id = self._last_insert_id()
+            first_id = last_id - len(news_list) + 1
+            self.conn.executemany("INSERT OR REPLACE INTO NewsKey(Key, NewsID) VALUES (?, ?)",
+                ((key, first_id + i) for i, news in enumerate(news_list) for key in news_keys(news.url, news.headline)))
+            self._bump_data_version()
+
+        self._set_inserted_ids(news_list, last_id)
+        return news_list
+
+
+    def _last_insert_id(self):
+        return self.conn.execute("SELECT last_insert_rowid()").fetchone()[0]
+
+
+    def _set_inserted_ids(self, items, last_id):
+        # AUTOINCREMENT ids of rows inserted by one transaction are consecutive,
+        # since the transaction holds the write lock
+        first_id = last_id - len(items) + 1
+        for i, item in enumerate(items):
+            item.id = first_id + i
 
 
     def _news_from_row(self, row):
-        return News(
-            id = row[0],
-            headline = row[1],
-            source = row[2],
-            url = row[3],
-            image_url = row[4],
-            country_code = row[5],
-            category_id = row[6],
-            event_id = row[7],
-            text = row[8],
-            summary = row[9],
-            published_at = row[10],
-            created_at = row[11],
-        )
+        # the fields of News are the columns of News, in order
+        return News(*row)
 
 
     def find_news_headline(self, headline):
@@ -113,6 +399,31 @@ class NappDatabase:
             return self._news_from_row(row)
 
 
+    def news_key_exists(self, keys):
+        """ Whether news were saved with any of keys, see dedup.news_keys. """
+        keys = list(keys)
+        if not keys:
+            return False
+        cur = self.conn.cursor()
+        cur.execute(f"SELECT 1 FROM NewsKey WHERE Key IN ({','.join('?' * len(keys))}) LIMIT 1", keys)
+        return cur.fetchone() is not None
+
+
+    def count_news(self):
+        return self.conn.execute("SELECT COUNT(*) FROM News").fetchone()[0]
+
+
+    def find_news_keys(self):
+        """ Yield (key, created at) of the keys of all news, oldest news first. """
+        cur = self.conn.cursor()
+        cur.execute("""
+            SELECT NewsKey.Key, News.CreatedAt FROM News
+            JOIN NewsKey ON NewsKey.NewsID = News.NewsID
+            ORDER BY News.NewsID
+        """)
+        yield from cur
+
+
     def find_news_by_id(self, news_id):
         cur = self.conn.cursor()
         cur.execute("SELECT * FROM News WHERE NewsID=?", (news_id,))
@@ -121,100 +432,246 @@ class NappDatabase:
             return self._news_from_row(row)
 
 
-    def find_news(self, limit=10, offset=0):
+    def find_news(self, limit=10, cursor=None):
+        """ Newest news first, continuing after cursor. """
+        return self._find_page("SELECT * FROM News", 'CreatedAt', 'NewsID', self._news_from_row,
+            limit, cursor, descending=True)
+
+
+    def find_news_since(self, start_date, limit=None, cursor=None):
+        """ News created from start_date on, oldest first, continuing after cursor. """
+        return self._find_page("SELECT * FROM News", 'CreatedAt', 'NewsID', self._news_from_row,
+            limit, cursor, start_date=start_date)
+
+
+    def find_news_added_since(self, news_id):
+        """ News saved after the one with news_id, in the order they were saved. """
         c = self.conn.cursor()
-        c.execute("SELECT * FROM News ORDER BY CreatedAt DESC LIMIT ? OFFSET ?", (limit, offset))
+        c.execute("SELECT * FROM News WHERE NewsID > ? ORDER BY NewsID", (news_id,))
         for row in c.fetchall():
             yield self._news_from_row(row)
 
 
-    def find_news_since(self, start_date):
+    def find_news_categories(self, news_id=0):
+        """ Yield (news id, headline, category id) of categorised news saved after news_id, oldest first. """
+        cur = self.conn.cursor()
+        cur.execute("SELECT NewsID, Headline, CategoryID FROM News WHERE NewsID > ? AND CategoryID IS NOT NULL "
+                    "ORDER BY NewsID", (news_id,))
+        yield from cur
+
+
+    def find_news_json_by_id(self, news_id):
+        row = self.conn.execute(SELECT_NEWS_JSON + "WHERE NewsID=?", (news_id,)).fetchone()
+        return row[0] if row else 'null'
+
+
+    def find_news_json(self, limit=10, cursor=None):
+        """ Like find_news, as (json, sort value, id) rows. """
+        return self._find_page(SELECT_NEWS_JSON, 'CreatedAt', 'NewsID', tuple,
+            limit, cursor, descending=True)
+
+
+    def find_news_since_json(self, start_date, limit=None, cursor=None):
+        return self._find_page(SELECT_NEWS_JSON, 'CreatedAt', 'NewsID', tuple,
+            limit, cursor, start_date=start_date)
+
+
+    def _find_page(self, select, sort_column, id_column, from_row, limit, cursor,
+            start_date=None, descending=False, where=None, params=()):
+        """ Keyset pagination ordered by (sort_column, id_column), unbounded if limit is None. """
+        conditions = [where] if where else []
+        params = list(params)
+        if start_date is not None:
+            conditions.append(f"{sort_column} >= ?")
+            params.append(start_date)
+        if cursor:
+            conditions.append(f"({sort_column}, {id_column}) {'<' if descending else '>'} (?, ?)")
+            params.extend(decode_cursor(cursor))
+
+        order = 'DESC' if descending else 'ASC'
+        sql = select
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += f" ORDER BY {sort_column} {order}, {id_column} {order} LIMIT ?"
+        params.append(limit if limit is not None else -1)
+
         c = self.conn.cursor()
-        c.execute("SELECT * FROM News WHERE CreatedAt >= ?", (start_date,))
+        c.execute(sql, params)
         for row in c.fetchall():
-            yield self._news_from_row(row)
+            yield from_row(row)
 
 
     def save_tweet(self, tweet):
+        return self.save_tweets_many([tweet])[0]
+
+
+    def save_tweets_many(self, tweets):
+        """ Save tweets in one transaction. """
         sql = """ INSERT OR REPLACE INTO Tweet(TweetID, Text, Hashtags, User, URL, CategoryID, EventID, PublishedAt)
                 VALUES(?,?,?,?,?,?,?,?); """
         with self.conn:
-            cur = self.conn.cursor()
-            cur.execute(sql, (tweet.id, tweet.text, tweet.hashtags, tweet.user, tweet.url, 
-                                tweet.category_id, tweet.event_id, tweet.published_at))
-            return tweet
+            self.conn.executemany(sql, ((tweet.id, tweet.text, tweet.hashtags, tweet.user, tweet.url, 
+                                tweet.category_id, tweet.event_id, tweet.published_at)
+                                for tweet in tweets))
+            self._bump_data_version()
+        return tweets
 
 
     def _tweet_from_row(self, row):
-        return Tweet(
-            id = row[0],
-            text = row[1],
-            hashtags = row[2],
-            user = row[3],
-            url = row[4],
-            category_id = row[5], 
-            event_id = row[6],
-            published_at = row[7],
-            created_at = row[8]
-        )
-
-
-    def find_tweets(self, limit=10, offset=0):
-        c = self.conn.cursor()
-        c.execute("SELECT * FROM Tweet ORDER BY PublishedAt DESC LIMIT ? OFFSET ?", (limit, offset))
-        for row in c.fetchall():
-            yield self._tweet_from_row(row)
+        # the fields of Tweet are the columns of Tweet, in order
+        return Tweet(*row)
 
 
-    def find_tweets_by_event_id(self, event_id):
-        c = self.conn.cursor()
-        c.execute("SELECT * FROM Tweet WHERE EventID = ? ORDER BY PublishedAt DESC", (event_id,))
-        for row in c.fetchall():
-            yield self._tweet_from_row(row)
+    def find_tweets(self, limit=10, cursor=None):
+        """ Latest published tweets first, continuing after cursor. """
+        return self._find_page("SELECT * FROM Tweet", 'PublishedAt', 'TweetID', self._tweet_from_row,
+            limit, cursor, descending=True)
+
+
+    def find_tweets_by_event_id(self, event_id, limit=None, cursor=None):
+        return self._find_page("SELECT * FROM Tweet", 'PublishedAt', 'TweetID', self._tweet_from_row,
+            limit, cursor, descending=True, where="EventID = ?", params=(event_id,))
+
+
+    def find_tweets_json(self, limit=10, cursor=None):
+        """ Like find_tweets, as (json, sort value, id) rows. """
+        return self._find_page(SELECT_TWEET_JSON, 'PublishedAt', 'TweetID', tuple,
+            limit, cursor, descending=True)
+
+
+    def find_tweets_by_event_id_json(self, event_id, limit=None, cursor=None):
+        return self._find_page(SELECT_TWEET_JSON, 'PublishedAt', 'TweetID', tuple,
+            limit, cursor, descending=True, where="EventID = ?", params=(event_id,))
 
 
     def save_event(self, event):
-        keywords_text = ','.join(event.keywords)
+        return self.save_events_many([event])[0]
 
-        sql = "INSERT INTO Event(Name, Summary, Keywords) VALUES(?,?,?)"
-        params = (event.name, event.summary, keywords_text)
-        
-        if event.id:
-            sql = "UPDATE Event SET Name=?, Summary=?, Keywords=? WHERE EventID=?"
-            params = (event.name, event.summary, keywords_text, event.id)
 
-        with self.conn:
-            cur = self.conn.cursor()
-            cur.execute(sql, params)
+    def save_events_many(self, events):
+        """ Insert new and update existing events in one transaction, setting ids of new ones. """
+        new_events = [event for event in events if not event.id]
+        old_events = [event for event in events if event.id]
+
+        try:
+            self._write_events(new_events, old_events)
+        except Exception:
+            # nothing was saved
+            for event in new_events:
+                event.id = None
+            raise
 
-            # if not event.id and cur.rowcount == 1:
-            #     event.id = cur.lastrowid
-            for row in self.conn.execute("SELECT * FROM Event WHERE Name=?", (event.name,)):
-                event.id = row[0]
-                break
+        for event in events:
+            for listener in self.event_listeners:
+                listener(event)
 
-        return event
+        return events
+
+
+    def _write_events(self, new_events, old_events):
+        with self.conn:
+            # names are unique, a new event named like a saved one is merged into it
+            merged = [event for event in new_events if self._merge_named_event(event)]
+            new_events = [event for event in new_events if not event.id]
+            old_events = old_events + merged
+
+            if new_events:
+                self.conn.executemany(
+                    "INSERT INTO Event(Name, Summary, UpdatedAt) VALUES(?,?,CURRENT_TIMESTAMP)",
+                    ((event.name, event.summary) for event in new_events))
+                self._set_inserted_ids(new_events, self._last_insert_id())
+
+            if old_events:
+                self.conn.executemany(
+                    "UPDATE Event SET Name=?, Summary=?, UpdatedAt=CURRENT_TIMESTAMP WHERE EventID=?",
+                    ((event.name, event.summary, event.id) for event in old_events))
+                self.conn.executemany("DELETE FROM EventKeyword WHERE EventID=?",
+                    ((event.id,) for event in old_events))
+
+            self.conn.executemany("INSERT OR IGNORE INTO EventKeyword(EventID, Keyword) VALUES (?, ?)",
+                ((event.id, keyword) for event in new_events + old_events for keyword in event.keywords))
+            self._bump_data_version()
+
+
+    def _merge_named_event(self, event):
+        """ Give event the id, creation time and keywords of the saved event of the same name, if any. """
+        row = self.conn.execute(SELECT_EVENT + "WHERE Name = ?", (event.name,)).fetchone()
+        if not row:
+            return False
+        saved = self._event_from_row(row)
+        event.id = saved.id
+        event.summary = event.summary or saved.summary
+        event.keywords = intern_keywords(event.keywords | saved.keywords)
+        event.created_at = saved.created_at
+        return True
 
 
     def _event_from_row(self, row):
-        return Event(
-            id = row[0],
-            name = row[1],
-            summary = row[2] if row[2] else '',
-            keywords = set(row[3].split(',')) if row[3] else set(),
-            created_at = row[4]
-        )
+        # rows of SELECT_EVENT, Event interns the keywords
+        return Event(row[0], row[1], row[2] or '', row[3].split(KEYWORD_SEPARATOR) if row[3] else (), row[4], row[5])
+
+
+    def find_events(self, limit=10, cursor=None):
+        """ Newest events first, continuing after cursor. """
+        return self._find_page(SELECT_EVENT, 'CreatedAt', 'EventID', self._event_from_row,
+            limit, cursor, descending=True)
+
+
+    def find_events_since(self, start_date, limit=None, cursor=None):
+        """ Events created from start_date on, oldest first, continuing after cursor. """
+        return self._find_page(SELECT_EVENT, 'CreatedAt', 'EventID', self._event_from_row,
+            limit, cursor, start_date=start_date)
 
 
-    def find_events(self, limit=10, offset=0):
+    def find_events_json(self, limit=10, cursor=None):
+        """ Like find_events, as (json, sort value, id) rows. """
+        return self._find_page(SELECT_EVENT_JSON, 'CreatedAt', 'EventID', tuple,
+            limit, cursor, descending=True)
+
+
+    def find_events_since_json(self, start_date, limit=None, cursor=None):
+        return self._find_page(SELECT_EVENT_JSON, 'CreatedAt', 'EventID', tuple,
+            limit, cursor, start_date=start_date)
+
+
+    def find_events_updated_since(self, start_date):
         c = self.conn.cursor()
-        c.execute("SELECT * FROM Event ORDER BY CreatedAt DESC LIMIT ? OFFSET ?", (limit, offset))
+        c.execute(SELECT_EVENT + "WHERE UpdatedAt >= ?", (start_date,))
         for row in c.fetchall():
             yield self._event_from_row(row)
 
 
-    def find_events_since(self, start_date):
+    def find_events_by_keywords(self, keywords, start_date=None, limit=10):
+        """ Return (event, overlap) pairs of events sharing any of keywords, most overlapping first. """
+        sql = """
+            WITH Matches AS (
+                SELECT EventID, COUNT(*) AS Overlap FROM EventKeyword
+                WHERE Keyword IN (SELECT value FROM json_each(?))
+                GROUP BY EventID
+            )
+            SELECT Event.EventID, Name, Summary,
+                (SELECT group_concat(Keyword, char(31)) FROM EventKeyword WHERE EventKeyword.EventID = Event.EventID),
+                CreatedAt, UpdatedAt, Overlap
+            FROM Event
+            JOIN Matches ON Matches.EventID = Event.EventID
+            WHERE Event.CreatedAt >= ?
+            ORDER BY Matches.Overlap DESC, Event.EventID
+            LIMIT ?
+        """
         c = self.conn.cursor()
-        c.execute("SELECT * FROM Event WHERE CreatedAt >= ?", (start_date,))
+        c.execute(sql, (json.dumps(list(keywords)), start_date or '', limit))
         for row in c.fetchall():
-            yield self._event_from_row(row)
+            yield self._event_from_row(row), row[6]
+
+
+# schema changes in order, the version of a database is the number of migrations applied
+MIGRATIONS = [
+    NappDatabase.create_tables,
+    NappDatabase.add_event_updated_at,
+    NappDatabase.create_indexes,
+    NappDatabase.create_event_keyword_table,
+    NappDatabase.create_data_version_table,
+    NappDatabase.create_feed_change_table,
+    NappDatabase.create_news_url_index,
+    NappDatabase.create_news_key_table,
+]
@@ -0,0 +1,39 @@
+import threading
+from database import NappDatabase, connect
+
+
+class ReadPool:
+    """ Read only NappDatabase connections, one per worker thread.
+
+    sqlite3 connections must not be shared between threads running queries
+    at the same time, so every thread lazily opens its own. The schema is
+    created or upgraded once with a writable connection when the pool opens.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.connections = []
+
+        # make sure the schema exists before opening read only connections
+        conn = connect(filename)
+        NappDatabase(conn)
+        conn.close()
+
+    def database(self):
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            conn = connect(self.filename, read_only=True)
+            db = NappDatabase(conn, create=False)
+            self.local.db = db
+            with self.lock:
+                self.connections.append(conn)
+        return db
+
+    def close(self):
+        with self.lock:
+            for conn in self.connections:
+                conn.close()
+            self.connections = []
+        self.local = threading.local()
@@ -0,0 +1,138 @@
+import hashlib
+import math
+import re
+import threading
+from collections import deque
+from datetime import datetime, timedelta
+from urllib.parse import urlsplit, parse_qsl, urlencode
+
+WINDOW_DAYS = 3
+MIN_CAPACITY = 100000
+ERROR_RATE = 0.01
+
+
+def strip_source(headline):
+    # headlines usually end with " - Source Name"
+    position = headline.rfind(" - ")
+    return headline[:position] if position > 0 else headline
+
+
+def normalise_url(url):
+    """ URL without scheme, www., fragment, trailing slash and utm_ tracking parameters. """
+    parts = urlsplit(url.strip())
+    host = parts.netloc.lower()
+    if host.startswith('www.'):
+        host = host[4:]
+    query = urlencode(sorted((key, value) for key, value in parse_qsl(parts.query) if not key.startswith('utm_')))
+    return host + parts.path.rstrip('/') + ('?' + query if query else '')
+
+
+def normalise_headline(headline):
+    """ Lower case words of a headline without its source suffix. """
+    return ' '.join(re.findall(r'\w+', strip_source(headline).casefold()))
+
+
+def news_keys(url, headline):
+    keys = []
+    url = normalise_url(url or '')
+    if url:
+        keys.append('url:' + url)
+    headline = normalise_headline(headline or '')
+    if headline:
+        keys.append('headline:' + headline)
+    return keys
+
+
+class BloomFilter:
+    """ Set membership with no false negatives and about error_rate false positives up to capacity keys. """
+
+    def __init__(self, capacity, error_rate=ERROR_RATE):
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def positions(self, key):
+        # double hashing, h1 + i * h2, from one digest
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hash_count)]
+
+    def add(self, key):
+        for position in self.positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self.positions(key))
+
+    def __len__(self):
+        return self.count
+
+
+class NewsDeduplicator:
+    """ Tells whether news were already saved, mostly without querying the database.
+
+    News are keyed by normalised URL and by normalised headline, so the same
+    article from another source, with another " - Source" suffix, counts as
+    a duplicate too. Keys of the last window_days are kept exactly; older keys
+    are only in a Bloom filter, whose hits are confirmed with the keys stored
+    in the database. seed() loads the keys of the saved news.
+    """
+
+    def __init__(self, db, window_days=WINDOW_DAYS, capacity=MIN_CAPACITY, error_rate=ERROR_RATE):
+        self.db = db
+        self.window = timedelta(days=window_days)
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.bloom = BloomFilter(capacity, error_rate)
+        # key -> when it was last seen
+        self.recent = {}
+        # (seen at, key) in the order keys were added, to expire the recent set
+        self.recent_order = deque()
+        self.lock = threading.Lock()
+        self.database_checks = 0
+
+    def seed(self):
+        start_date = datetime.utcnow() - self.window
+        count = self.db.count_news()
+        # two keys per news, with room for as many news again
+        self.bloom = BloomFilter(max(self.capacity, 4 * count), self.error_rate)
+        self.recent = {}
+        self.recent_order = deque()
+        # streamed, the keys of every news are never all in memory
+        for key, created_at in self.db.find_news_keys():
+            self.add_keys([key], created_at if created_at and created_at > start_date else None)
+        return count
+
+    def add_keys(self, keys, seen_at=None):
+        with self.lock:
+            for key in keys:
+                self.bloom.add(key)
+                if seen_at:
+                    self.recent[key] = seen_at
+                    self.recent_order.append((seen_at, key))
+
+    def add(self, news):
+        self.add_keys(news_keys(news.url, news.headline), datetime.utcnow())
+
+    def expire(self):
+        start_date = datetime.utcnow() - self.window
+        with self.lock:
+            while self.recent_order and self.recent_order[0][0] < start_date:
+                seen_at, key = self.recent_order.popleft()
+                # unless it was seen again since
+                if self.recent.get(key) == seen_at:
+                    del self.recent[key]
+
+    def is_duplicate(self, news):
+        keys = news_keys(news.url, news.headline)
+        with self.lock:
+            if any(key in self.recent for key in keys):
+                return True
+            if not any(key in self.bloom for key in keys):
+                return False
+        # older news or a false positive
+        self.database_checks += 1
+        return self.db.news_key_exists(keys)
@@ -0,0 +1,179 @@
+import heapq
+from datetime import datetime, date, time, timedelta
+
+# re-read rows updated slightly before the watermark, in case their transaction committed late
+REFRESH_OVERLAP = timedelta(minutes=1)
+
+
+class EventIndex:
+    """ Inverted index from keywords to recent events.
+
+    Candidate lookups only touch the events sharing a keyword with the query,
+    instead of scanning every event. Events are re-indexed by calling add()
+    again after their keywords change, and dropped by expire() once they are
+    older than the matching window.
+    """
+
+    def __init__(self, events=()):
+        self.events = {}
+        # keywords each event was indexed with, to remove stale entries on update
+        self.indexed_keywords = {}
+        self.event_ids = {}
+        # event ids by name, and the name each event was indexed with
+        self.named_ids = {}
+        self.indexed_names = {}
+        # (created_at, event id) heap used to expire the oldest events first
+        self.by_age = []
+        for event in events:
+            self.add(event)
+
+    def __len__(self):
+        return len(self.events)
+
+    def __iter__(self):
+        return iter(self.events.values())
+
+    def __contains__(self, event_id):
+        return event_id in self.events
+
+    def get(self, event_id):
+        return self.events.get(event_id)
+
+    def find_name(self, name):
+        """ Return the event named name, event names are unique. """
+        return self.events.get(self.named_ids.get(name))
+
+    def add(self, event):
+        """ Add a saved event or re-index it after its keywords changed. """
+        assert event.id
+        old_keywords = self.indexed_keywords.get(event.id, frozenset())
+        new_keywords = frozenset(event.keywords)
+
+        for keyword in old_keywords - new_keywords:
+            ids = self.event_ids[keyword]
+            ids.discard(event.id)
+            if not ids:
+                del self.event_ids[keyword]
+
+        for keyword in new_keywords - old_keywords:
+            self.event_ids.setdefault(keyword, set()).add(event.id)
+
+        if event.id not in self.events:
+            heapq.heappush(self.by_age, (event.created_at, event.id))
+
+        old_name = self.indexed_names.get(event.id)
+        if old_name != event.name:
+            if self.named_ids.get(old_name) == event.id:
+                del self.named_ids[old_name]
+            self.named_ids[event.name] = event.id
+
+        self.events[event.id] = event
+        self.indexed_keywords[event.id] = new_keywords
+        self.indexed_names[event.id] = event.name
+
+    def remove(self, event_id):
+        event = self.events.pop(event_id, None)
+        if not event:
+            return
+        for keyword in self.indexed_keywords.pop(event_id):
+            ids = self.event_ids[keyword]
+            ids.discard(event_id)
+            if not ids:
+                del self.event_ids[keyword]
+        name = self.indexed_names.pop(event_id)
+        if self.named_ids.get(name) == event_id:
+            del self.named_ids[name]
+
+    def expire(self, start_date):
+        """ Remove events created before start_date. """
+        if not isinstance(start_date, datetime):
+            start_date = datetime.combine(start_date, time())
+
+        while self.by_age and self.by_age[0][0] < start_date:
+            _, event_id = heapq.heappop(self.by_age)
+            self.remove(event_id)
+
+    def candidates(self, keywords):
+        """ Return (event, overlap) pairs sharing keywords, most overlapping (then oldest) first. """
+        overlap = {}
+        for keyword in set(keywords):
+            for event_id in self.event_ids.get(keyword, ()):
+                overlap[event_id] = overlap.get(event_id, 0) + 1
+
+        ranked = sorted(overlap.items(), key=lambda item: (-item[1], item[0]))
+        return [(self.events[event_id], count) for event_id, count in ranked]
+
+
+class EventWorkingSet(EventIndex):
+    """ EventIndex of the last few days of events, kept in sync with the database.
+
+    The first refresh() loads every recent event. Later refreshes only read
+    rows updated since the newest UpdatedAt seen so far, so other loader
+    processes' writes are picked up without decoding every row again. Events
+    saved through db are applied directly.
+    """
+
+    def __init__(self, db, days=3):
+        super().__init__()
+        self.db = db
+        self.days = days
+        self.watermark = None
+        db.event_listeners.append(self.add)
+
+    def refresh(self):
+        start_date = date.today() - timedelta(days=self.days)
+
+        if self.watermark is None:
+            events = self.db.find_events_since(start_date)
+        else:
+            events = self.db.find_events_updated_since(self.watermark - REFRESH_OVERLAP)
+
+        count = 0
+        for event in events:
+            self.add(event)
+            if self.watermark is None or event.updated_at > self.watermark:
+                self.watermark = event.updated_at
+            count += 1
+
+        self.expire(start_date)
+        return count
+
+
+class EventBatch:
+    """ Events of an EventIndex and the events matched for a batch of news, before the batch is saved.
+
+    Matched events are looked up with their current keywords and names, so a
+    news can match the event an earlier news of the batch created or
+    changed, and the whole batch is then saved with one save_events_many.
+    """
+
+    def __init__(self, events):
+        self.events = events
+        self.matched = []
+
+    def get(self, event_id):
+        return self.events.get(event_id)
+
+    def add(self, event):
+        if all(event is not matched for matched in self.matched):
+            self.matched.append(event)
+
+    def find_name(self, name):
+        for event in self.matched:
+            if event.name == name:
+                return event
+        event = self.events.find_name(name)
+        # renamed by this batch, not indexed under its new name yet
+        return event if event is not None and event.name == name else None
+
+    def candidates(self, keywords):
+        keywords = set(keywords)
+        overlap = {id(event): (event, count) for event, count in self.events.candidates(keywords)}
+        for event in self.matched:
+            count = len(keywords.intersection(event.keywords))
+            if count:
+                overlap[id(event)] = (event, count)
+            else:
+                overlap.pop(id(event), None)
+        # new events after saved ones of the same overlap, as they are the newest
+        return sorted(overlap.values(), key=lambda item: (-item[1], item[0].id is None, item[0].id or 0))
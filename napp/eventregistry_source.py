@@ -2,6 +2,10 @@ import json
 from dateutil import parser
 from eventregistry import EventRegistry, QueryArticlesIter
 from models import News
+from json_stream import iter_array
+
+# where the articles are in a whole API response, such as json/news.json
+RESULTS_PATH = ('articles', 'results')
 
 class EventRegistrySource:
     def __init__(self, api_key, record_response_file=None, max_items=10):
@@ -40,7 +44,8 @@ class EventRegistrySource:
         return [self.news_from_api(obj) for obj in articles]
     
     def load_news_from_file(self):
+        """ Yield the news of the recorded articles, or of a whole API response, reading the file as they are used. """
         with open(self.record_response_file) as f:
-            articles = json.load(f)
-        return [self.news_from_api(obj) for obj in articles]
+            for obj in iter_array(f, RESULTS_PATH):
+                yield self.news_from_api(obj)
 
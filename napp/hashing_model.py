@@ -0,0 +1,217 @@
+""" Stateless hashing featurisation of the category model, scored with NumPy.
+
+HashingVectoriser tokenises like the CountVectorizer (lowercase, words of
+two or more \\w characters) but needs no vocabulary: each token is hashed
+to one of n_features buckets. A batch is joined into strings of about
+CHUNK_CHARS characters, each tokenised and hashed as arrays of code points,
+so no Python object is made per token and memory does not grow with the
+batch.
+
+convert() folds the vocabulary of the pickled model into those buckets:
+the probability of a bucket is the sum of those of its terms, and tokens
+outside the vocabulary, whose buckets are empty, still count for nothing.
+Terms sharing a bucket, and unknown tokens landing in a used bucket, make
+predictions differ slightly from the pickled model's.
+
+Run from the repository root to convert: python napp/hashing_model.py
+"""
+import itertools
+import re
+import sys
+from functools import lru_cache
+import numpy as np
+from scipy import sparse
+import model_export
+
+CONVERT_DIRECTORY = 'model/nb-hashing'
+N_FEATURES = 1 << 20
+
+ARRAYS = ['feature_log_prob', 'class_log_prior', 'classes']
+
+# polynomial string hash modulo 2^64, mixed by the splitmix64 finaliser, whose top bits are the bucket
+BASE = 0x100000001B3
+MIX1 = np.uint64(0xBF58476D1CE4E5B9)
+MIX2 = np.uint64(0x94D049BB133111EB)
+# characters hashed at a time, the arrays of a chunk take about 40 bytes per character
+CHUNK_CHARS = 1 << 14
+# chunks are cut at white space, which no token or lower casing context crosses
+SPACE = re.compile(r'\s')
+
+
+@lru_cache(maxsize=None)
+def word_table():
+    """ Which code points of the Basic Multilingual Plane re's \\w matches. """
+    return np.array([chr(c).isalnum() or c == 95 for c in range(1 << 16)])
+
+
+@lru_cache(maxsize=4)
+def powers(length):
+    """ BASE^0 .. BASE^(length - 1) modulo 2^64. """
+    base = np.full(length, BASE, dtype=np.uint64)
+    base[0] = 1
+    return np.cumprod(base)
+
+
+def power_array(length):
+    # cached by powers of two, tokens are short so one or two sizes are used
+    return powers(1 << max(length, 1).bit_length())[:length]
+
+
+def pieces(texts, size):
+    """ Yield (row, piece) of texts, cutting those longer than size at white space, so no token is cut. """
+    for row, text in enumerate(texts):
+        start = 0
+        while len(text) - start > size:
+            separator = SPACE.search(text, start + size)
+            if not separator:
+                break
+            yield row, text[start:separator.start()]
+            start = separator.start()
+        yield row, text[start:] if start else text
+
+
+def chunks(texts, size=CHUNK_CHARS):
+    """ Yield (rows, starts, chunk) of pieces of texts joined by new lines, about size characters at a time. """
+    batch, length = [], 0
+    for row, piece in itertools.chain(pieces(texts, size), [(None, None)]):
+        if batch and (piece is None or length + len(piece) > size):
+            lengths = np.fromiter((len(piece) for _, piece in batch), dtype=np.int64, count=len(batch))
+            rows = np.fromiter((row for row, _ in batch), dtype=np.int32, count=len(batch))
+            yield rows, np.cumsum(lengths + 1) - lengths - 1, '\n'.join(piece for _, piece in batch)
+            batch, length = [], 0
+        if piece is not None:
+            batch.append((row, piece))
+            length += len(piece) + 1
+
+
+class HashingVectoriser:
+    """ Token counts of texts in n_features hashed columns, with no vocabulary. """
+
+    def __init__(self, n_features=N_FEATURES):
+        if n_features & (n_features - 1) or n_features > 1 << 31:
+            raise ValueError('n_features must be a power of two up to 2^31')
+        self.n_features = n_features
+        self.shift = np.uint64(64 - n_features.bit_length() + 1)
+
+    def tokens(self, texts):
+        """ Return (document rows, buckets) of every token of texts, and the number of texts. """
+        texts = texts if isinstance(texts, list) else list(texts)
+        # int32 like the indices of a csr matrix, which would otherwise copy them
+        rows, buckets = [np.zeros(0, dtype=np.int32)], [np.zeros(0, dtype=np.int32)]
+        # arrays, and the buffers of str.lower, are made per chunk, so their size does not grow with the batch
+        for piece_rows, piece_starts, chunk in chunks(texts, CHUNK_CHARS):
+            lowered = chunk.lower()
+            starts, hashes = self.hash_tokens(lowered)
+            if len(lowered) != len(chunk):
+                # a few characters lower case to more than one, find where their tokens start in chunk
+                ends = np.cumsum(np.fromiter((len(c.lower()) for c in chunk), dtype=np.int64, count=len(chunk)))
+                starts = np.searchsorted(ends, starts, side='right')
+            rows.append(piece_rows[np.searchsorted(piece_starts, starts, side='right') - 1])
+            buckets.append((hashes >> self.shift).astype(np.int32))
+        return np.concatenate(rows), np.concatenate(buckets), len(texts)
+
+    def hash_tokens(self, text):
+        """ Return the start and the mixed hash of every token of text. """
+        codes = np.frombuffer(text.encode('utf-32-le'), dtype=np.uint32)
+        # outside the Basic Multilingual Plane everything counts as a separator
+        word = np.zeros(len(codes) + 2, dtype=np.int8)
+        word[1:-1] = word_table()[np.minimum(codes, 0xFFFF)] & (codes <= 0xFFFF)
+        edges = np.flatnonzero(np.diff(word))
+        starts, ends = edges[0::2], edges[1::2]
+        long_enough = ends - starts >= 2
+        starts, lengths = starts[long_enough], (ends - starts)[long_enough]
+        if not len(starts):
+            return starts, np.zeros(0, dtype=np.uint64)
+
+        # hash of a token = sum of code * BASE^(its offset in the token)
+        firsts = np.cumsum(lengths) - lengths
+        offsets = np.arange(firsts[-1] + lengths[-1]) - np.repeat(firsts, lengths)
+        terms = codes[np.repeat(starts, lengths) + offsets].astype(np.uint64)
+        terms *= power_array(int(lengths.max()))[offsets]
+        hashes = np.add.reduceat(terms, firsts)
+        hashes ^= hashes >> np.uint64(30)
+        hashes *= MIX1
+        hashes ^= hashes >> np.uint64(27)
+        hashes *= MIX2
+        hashes ^= hashes >> np.uint64(31)
+        return starts, hashes
+
+    def transform(self, texts):
+        rows, buckets, row_count = self.tokens(texts)
+        # float32 like the model's log probabilities, which would otherwise be copied to float64 to multiply
+        x = sparse.csr_matrix((np.ones(len(rows), dtype=np.float32), (rows, buckets)),
+                              shape=(row_count, self.n_features))
+        x.sum_duplicates()
+        return x
+
+
+class HashingNB:
+    """ MultinomialNB.predict over hashed columns, a sparse product with the bucket log probabilities. """
+
+    def __init__(self, feature_log_prob, class_log_prior, classes):
+        # n_features x classes, so each token reads one contiguous row
+        self.feature_log_prob = feature_log_prob
+        self.class_log_prior = class_log_prior
+        self.classes = classes
+
+    def predict(self, x):
+        jll = x @ self.feature_log_prob + self.class_log_prior
+        return self.classes[np.argmax(jll, axis=1)]
+
+
+def vocabulary_buckets(vectoriser, n_features=N_FEATURES):
+    """ Bucket of each column of a fitted CountVectorizer. """
+    model_export.check_word_analysis(vectoriser)
+    if vectoriser.token_pattern != r'(?u)\b\w\w+\b' or not vectoriser.lowercase:
+        raise ValueError('only the default CountVectorizer tokenisation can be hashed')
+
+    terms = sorted(vectoriser.vocabulary_, key=vectoriser.vocabulary_.get)
+    rows, buckets, _ = HashingVectoriser(n_features).tokens(terms)
+    if not np.array_equal(rows, np.arange(len(terms))):
+        raise ValueError('vocabulary terms are not single tokens')
+    return buckets
+
+
+def convert(model, vectoriser, n_features=N_FEATURES):
+    """ Return the HashingNB of a fitted MultinomialNB and its CountVectorizer. """
+    buckets = vocabulary_buckets(vectoriser, n_features)
+
+    # probability of a bucket is the sum of those of its terms
+    probabilities = np.zeros((n_features, len(model.classes_)))
+    np.add.at(probabilities, buckets, np.exp(model.feature_log_prob_.T))
+    feature_log_prob = np.zeros_like(probabilities)
+    used = probabilities > 0
+    feature_log_prob[used] = np.log(probabilities[used])
+
+    return HashingNB(feature_log_prob.astype(np.float32), model.class_log_prior_, model.classes_)
+
+
+def load(directory):
+    """ Return (vectoriser, model) memory mapped from a converted directory. """
+    meta, arrays = model_export.read_arrays(directory, ARRAYS)
+    return HashingVectoriser(meta['n_features']), HashingNB(**arrays)
+
+
+def load_or_convert(model_filename, vectoriser_filename, digest, directory=CONVERT_DIRECTORY,
+                    n_features=N_FEATURES):
+    """ Load the conversion of the pickled files with this digest, converting them first if needed. """
+    if model_export.read_digest(directory) != digest:
+        model = convert(*model_export.load_pickles(model_filename, vectoriser_filename), n_features)
+        arrays = {name: getattr(model, name) for name in ARRAYS}
+        model_export.write_arrays(directory, arrays, {'digest': digest, 'n_features': n_features})
+    return load(directory)
+
+
+def main():
+    from classifier import file_digest
+
+    model_filename, vectoriser_filename = 'model/nb.model', 'model/nb.vectorizer'
+    directory = sys.argv[1] if len(sys.argv) > 1 else CONVERT_DIRECTORY
+    vectoriser, model = load_or_convert(model_filename, vectoriser_filename,
+                                        file_digest(model_filename, vectoriser_filename), directory)
+    used = np.count_nonzero(model.feature_log_prob.any(axis=1))
+    print(f'{directory}: {vectoriser.n_features} buckets, {used} used, {len(model.classes)} classes')
+
+
+if __name__ == '__main__':
+    main()
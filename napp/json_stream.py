@@ -0,0 +1,93 @@
+""" Incremental reading of large JSON arrays.
+
+iter_array yields the items of a JSON array one at a time, reading the
+file in chunks and decoding each item with json.JSONDecoder.raw_decode, so
+memory holds one chunk and one item instead of the whole document.
+"""
+import json
+
+CHUNK_SIZE = 64 * 1024
+
+decoder = json.JSONDecoder()
+
+
+class Reader:
+    """ A text file read in chunks, parsed from pos on. """
+
+    def __init__(self, f, chunk_size=CHUNK_SIZE):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def read_more(self):
+        # drop what was parsed, then at least double what is buffered, so long items are not re-read often
+        self.buffer = self.buffer[self.pos:]
+        self.pos = 0
+        chunk = self.f.read(max(self.chunk_size, len(self.buffer)))
+        if not chunk:
+            self.eof = True
+        self.buffer += chunk
+
+    def peek(self):
+        """ Return the next character that is not white space, '' at the end of the file. """
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in ' \t\n\r':
+                self.pos += 1
+            if self.pos < len(self.buffer) or self.eof:
+                return self.buffer[self.pos:self.pos + 1]
+            self.read_more()
+
+    def expect(self, characters):
+        c = self.peek()
+        if not c or c not in characters:
+            raise ValueError(f'expected one of {characters!r} at {c!r}')
+        self.pos += 1
+        return c
+
+    def value(self):
+        """ Decode the next JSON value. """
+        self.peek()
+        while True:
+            try:
+                value, end = decoder.raw_decode(self.buffer, self.pos)
+                # a number at the end of the buffer may continue in the next chunk
+                if end < len(self.buffer) or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self.read_more()
+
+
+def iter_array(f, path=(), chunk_size=CHUNK_SIZE):
+    """ Yield the items of the JSON array in text file f.
+
+    When the document is an object, path is the keys leading to the array,
+    and the values of other keys on the way are decoded and skipped.
+    """
+    reader = Reader(f, chunk_size)
+    keys = list(path)
+    while reader.peek() == '{':
+        if not keys:
+            raise ValueError('expected an array, found an object')
+        reader.expect('{')
+        while True:
+            key = reader.value()
+            reader.expect(':')
+            if key == keys[0]:
+                keys.pop(0)
+                break
+            reader.value()
+            if reader.expect(',}') == '}':
+                raise ValueError(f'no {keys[0]!r} key in object')
+
+    reader.expect('[')
+    if reader.peek() == ']':
+        return
+    while True:
+        yield reader.value()
+        if reader.expect(',]') == ']':
+            return
@@ -0,0 +1,104 @@
+import asyncio
+
+POLL_INTERVAL_SEC = 1.0
+BATCH_SIZE = 500
+QUEUE_SIZE = 1000
+
+
+def sse_message(change_id, kind, data):
+    # the JSON from SQLite never contains raw newlines, so it fits one data line
+    return f'id: {change_id}\nevent: {kind}\ndata: {data}\n\n'
+
+
+class Subscription:
+    def __init__(self, last_change_id):
+        # changes after this id are delivered through the queue
+        self.last_change_id = last_change_id
+        self.queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+        self.dropped = False
+
+
+class FeedBroker:
+    """ Fans out newly saved news, events and tweets to live feed subscribers.
+
+    One poll of the FeedChange log per interval serves every subscriber, so
+    the database cost does not grow with the number of connected clients.
+    query is an async callable running find(db) off the event loop.
+    """
+
+    def __init__(self, query, poll_interval_sec=POLL_INTERVAL_SEC):
+        self.query = query
+        self.poll_interval_sec = poll_interval_sec
+        self.subscriptions = set()
+        self.last_change_id = None
+        self.task = None
+
+    async def start(self):
+        self.last_change_id = await self.query(lambda db: db.find_last_change_id())
+        self.task = asyncio.ensure_future(self.run())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+        for subscription in list(self.subscriptions):
+            self.drop(subscription)
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.poll_interval_sec)
+            try:
+                while await self.poll() == BATCH_SIZE:
+                    pass
+            except Exception as e:
+                print(f'Error polling live feed changes: {e}')
+
+    async def poll(self):
+        """ Read changes after the last one seen and send them to every subscriber. """
+        after = self.last_change_id
+        changes = await self.query(lambda db: db.find_feed_changes_json(after, BATCH_SIZE))
+        if not changes:
+            return 0
+
+        self.publish(changes)
+        self.last_change_id = changes[-1][0]
+        return len(changes)
+
+    def publish(self, changes):
+        messages = [sse_message(*change) for change in changes if change[2] is not None]
+        for subscription in list(self.subscriptions):
+            for message in messages:
+                try:
+                    subscription.queue.put_nowait(message)
+                except asyncio.QueueFull:
+                    # too slow, the client reconnects and resumes with Last-Event-ID
+                    self.drop(subscription)
+                    break
+
+    def subscribe(self):
+        subscription = Subscription(self.last_change_id)
+        self.subscriptions.add(subscription)
+        return subscription
+
+    def drop(self, subscription):
+        subscription.dropped = True
+        self.subscriptions.discard(subscription)
+        # wake the stream up so it notices
+        try:
+            subscription.queue.put_nowait(None)
+        except asyncio.QueueFull:
+            pass
+
+    def unsubscribe(self, subscription):
+        self.subscriptions.discard(subscription)
+
+    async def replay(self, after_change_id, subscription):
+        """ Yield messages missed between after_change_id and the start of the subscription. """
+        while after_change_id < subscription.last_change_id:
+            changes = await self.query(lambda db: db.find_feed_changes_json(after_change_id, BATCH_SIZE))
+            changes = [change for change in changes if change[0] <= subscription.last_change_id]
+            if not changes:
+                break
+            for change in changes:
+                if change[2] is not None:
+                    yield sse_message(*change)
+            after_change_id = changes[-1][0]
@@ -0,0 +1,213 @@
+""" Compact, memory-mapped copies of the pickled category model and vectoriser.
+
+The pickled CountVectorizer keeps its vocabulary in a Python dict and the
+MultinomialNB its coefficients in private arrays, so every loader process
+unpickles and holds its own copy. export() writes them as .npy arrays
+instead: the vocabulary as sorted 64 bit term hashes with their columns,
+and the model as its log probabilities. load() memory maps those files, so
+the worker processes share one physical copy through the page cache.
+
+Run from the repository root to export: python napp/model_export.py
+"""
+import hashlib
+import json
+import os
+import pickle
+import re
+import shutil
+import sys
+import tempfile
+import numpy as np
+from scipy import sparse
+
+EXPORT_DIRECTORY = 'model/nb'
+
+ARRAYS = ['hashes', 'columns', 'feature_log_prob', 'class_log_prior', 'classes']
+
+# CountVectorizer settings reproduced by the compact and hashing vectorisers, which only tokenise and count
+WORD_ANALYSIS = {
+    'input': 'content',
+    'analyzer': 'word',
+    'ngram_range': (1, 1),
+    'stop_words': None,
+    'strip_accents': None,
+    'preprocessor': None,
+    'tokenizer': None,
+    'binary': False,
+}
+
+
+def term_hash(term):
+    return int.from_bytes(hashlib.blake2b(term.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+class CompactVectoriser:
+    """ CountVectorizer.transform over a sorted array of term hashes. """
+
+    def __init__(self, hashes, columns, token_pattern, lowercase, feature_count):
+        self.hashes = hashes
+        self.columns = columns
+        self.token_pattern = re.compile(token_pattern)
+        self.lowercase = lowercase
+        self.feature_count = feature_count
+
+    def transform(self, texts):
+        rows, hashes = [], []
+        # hash each distinct token of the batch once
+        seen = {}
+        row_count = 0
+        for row, text in enumerate(texts):
+            row_count += 1
+            if self.lowercase:
+                text = text.lower()
+            for token in self.token_pattern.findall(text):
+                value = seen.get(token)
+                if value is None:
+                    value = seen[token] = term_hash(token)
+                rows.append(row)
+                hashes.append(value)
+
+        hashes = np.array(hashes, dtype=np.uint64)
+        rows = np.array(rows, dtype=np.int32)
+        positions = np.searchsorted(self.hashes, hashes)
+        positions[positions == len(self.hashes)] = 0
+        # tokens outside the vocabulary are dropped, as CountVectorizer does
+        known = self.hashes[positions] == hashes
+
+        x = sparse.csr_matrix((np.ones(known.sum()), (rows[known], self.columns[positions[known]])),
+                              shape=(row_count, self.feature_count))
+        x.sum_duplicates()
+        return x
+
+
+class CompactNB:
+    """ MultinomialNB.predict from its log probabilities. """
+
+    def __init__(self, feature_log_prob, class_log_prior, classes):
+        self.feature_log_prob = feature_log_prob
+        self.class_log_prior = class_log_prior
+        self.classes = classes
+
+    def predict(self, x):
+        jll = x @ self.feature_log_prob.T + self.class_log_prior
+        return self.classes[np.argmax(jll, axis=1)]
+
+
+def check_word_analysis(vectoriser):
+    """ Raise ValueError if vectoriser analyses text in a way the exported vectorisers do not. """
+    unsupported = [f'{name}={getattr(vectoriser, name)!r}' for name, value in WORD_ANALYSIS.items()
+                   if getattr(vectoriser, name, value) != value]
+    if unsupported:
+        raise ValueError('unsupported CountVectorizer settings: ' + ', '.join(unsupported))
+
+
+def export(model, vectoriser, directory, digest):
+    """ Write model and vectoriser to directory. """
+    check_word_analysis(vectoriser)
+    terms = sorted(vectoriser.vocabulary_.items(), key=lambda item: term_hash(item[0]))
+    hashes = np.array([term_hash(term) for term, _ in terms], dtype=np.uint64)
+    if len(np.unique(hashes)) != len(hashes):
+        raise ValueError('vocabulary term hashes collide')
+
+    arrays = {
+        'hashes': hashes,
+        'columns': np.array([column for _, column in terms], dtype=np.int32),
+        'feature_log_prob': model.feature_log_prob_,
+        'class_log_prior': model.class_log_prior_,
+        'classes': model.classes_,
+    }
+    meta = {
+        'digest': digest,
+        'token_pattern': vectoriser.token_pattern,
+        'lowercase': vectoriser.lowercase,
+        'feature_count': model.feature_log_prob_.shape[1],
+    }
+    write_arrays(directory, arrays, meta)
+
+
+def write_arrays(directory, arrays, meta):
+    """ Save arrays as .npy files and meta as meta.json, replacing directory once every file is written.
+
+    Nothing is written if directory already has the digest of meta, as when
+    every worker process exports on first start. An old directory is renamed
+    out of the way before the new one takes its place, never deleted while
+    it is still at directory.
+    """
+    if read_digest(directory) == meta['digest']:
+        return
+
+    parent = os.path.dirname(os.path.abspath(directory))
+    temp = tempfile.mkdtemp(dir=parent)
+    try:
+        for name, array in arrays.items():
+            np.save(os.path.join(temp, name + '.npy'), array)
+        with open(os.path.join(temp, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+
+        # another process may have written the same files meanwhile
+        if read_digest(directory) == meta['digest']:
+            shutil.rmtree(temp, ignore_errors=True)
+            return
+        old = None
+        if os.path.exists(directory):
+            old = tempfile.mkdtemp(dir=parent)
+            os.replace(directory, old)
+        os.replace(temp, directory)
+        if old:
+            shutil.rmtree(old, ignore_errors=True)
+    except OSError:
+        shutil.rmtree(temp, ignore_errors=True)
+        if read_digest(directory) != meta['digest']:
+            raise
+
+
+def read_digest(directory):
+    try:
+        with open(os.path.join(directory, 'meta.json')) as f:
+            return json.load(f)['digest']
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def read_arrays(directory, names):
+    """ Return (meta, {name: memory mapped array}) of a directory written by write_arrays. """
+    with open(os.path.join(directory, 'meta.json')) as f:
+        meta = json.load(f)
+    return meta, {name: np.load(os.path.join(directory, name + '.npy'), mmap_mode='r') for name in names}
+
+
+def load_pickles(model_filename, vectoriser_filename):
+    with open(model_filename, 'rb') as f:
+        model = pickle.load(f)
+    with open(vectoriser_filename, 'rb') as f:
+        return model, pickle.load(f)
+
+
+def load(directory):
+    """ Return (vectoriser, model) memory mapped from an exported directory. """
+    meta, arrays = read_arrays(directory, ARRAYS)
+    vectoriser = CompactVectoriser(arrays['hashes'], arrays['columns'],
+                                   meta['token_pattern'], meta['lowercase'], meta['feature_count'])
+    model = CompactNB(arrays['feature_log_prob'], arrays['class_log_prior'], arrays['classes'])
+    return vectoriser, model
+
+
+def load_or_export(model_filename, vectoriser_filename, digest, directory=EXPORT_DIRECTORY):
+    """ Load the export of the pickled files with this digest, exporting them first if needed. """
+    if read_digest(directory) != digest:
+        export(*load_pickles(model_filename, vectoriser_filename), directory, digest)
+    return load(directory)
+
+
+def main():
+    from classifier import file_digest
+
+    model_filename, vectoriser_filename = 'model/nb.model', 'model/nb.vectorizer'
+    directory = sys.argv[1] if len(sys.argv) > 1 else EXPORT_DIRECTORY
+    vectoriser, model = load_or_export(model_filename, vectoriser_filename,
+                                       file_digest(model_filename, vectoriser_filename), directory)
+    print(f'{directory}: {len(vectoriser.hashes)} terms, {len(model.classes)} classes')
+
+
+if __name__ == '__main__':
+    main()
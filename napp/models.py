@@ -1,28 +1,53 @@
-from dataclasses import dataclass, field
+import sys
+from dataclasses import dataclass, field, fields
 from typing import Set, Union
 from datetime import datetime
 
+
+def slotted(cls):
+    """ Rebuild a dataclass with __slots__ for its fields, so its instances have no __dict__. """
+    names = tuple(f.name for f in fields(cls))
+    namespace = {key: value for key, value in cls.__dict__.items()
+                 if key not in names and key not in ('__dict__', '__weakref__')}
+    namespace['__slots__'] = names
+    return type(cls.__name__, cls.__bases__, namespace)
+
+
+def intern_keywords(keywords):
+    """ Set of keywords sharing one string object per distinct keyword across all events. """
+    return {sys.intern(keyword) for keyword in keywords}
+
+
+# Fields are in the order of their table's columns, so rows are turned into records positionally
+
+@slotted
 @dataclass
 class Event:
     id: Union[int, None] = None
     name: str = ""
     summary: str = ""
     keywords: Set[str] = field(default_factory=set)
-    created_at: datetime = datetime.utcnow()
+    created_at: datetime = field(default_factory=datetime.utcnow)
+    updated_at: datetime = field(default_factory=datetime.utcnow)
+
+    def __post_init__(self):
+        self.keywords = intern_keywords(self.keywords)
 
+@slotted
 @dataclass
 class Tweet:
     id: Union[int, None] = None
     text: str = ""
     hashtags: str = ""
-    url: str = ""
     user: str = ""
+    url: str = ""
     category_id: Union[int, None] = None
     event_id: Union[int, None] = None
-    published_at: datetime = datetime.utcnow()
-    created_at: datetime = datetime.utcnow()
+    published_at: datetime = field(default_factory=datetime.utcnow)
+    created_at: datetime = field(default_factory=datetime.utcnow)
 
 
+@slotted
 @dataclass
 class News:
     id: Union[int, None] = None
@@ -35,6 +60,5 @@ class News:
     event_id: Union[int, None] = None
     text: str = ""
     summary: str = ""
-    published_at: datetime = datetime.utcnow()
-    created_at: datetime = datetime.utcnow()
-
+    published_at: datetime = field(default_factory=datetime.utcnow)
+    created_at: datetime = field(default_factory=datetime.utcnow)
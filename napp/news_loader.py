@@ -1,38 +1,75 @@
 import os
-import sqlite3
+import sys
 import time
+import asyncio
+import functools
+import traceback
+import nlp_worker
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, date, timedelta
-from database import NappDatabase
-from models import News, Event
-from classifier import Classifier, Categories
+from database import NappDatabase, connect
+from models import News, Event, intern_keywords
+from event_index import EventWorkingSet, EventBatch
+from classifier import Classifier, Categories, NLP_BATCH_SIZE
+from classifier_cache import CachedClassifier, SharedCounts
 from newsapi_source import NewsApiSource
 from eventregistry_source import EventRegistrySource
+from source_fetcher import fetch_all, MAX_CONCURRENCY
+from pipeline import Pipeline, Stage
+from dedup import NewsDeduplicator, news_keys, strip_source
+from summariser import SUMMARY_CHARS
+from story_clustering import NewsStories, news_text, signature as story_signature, THRESHOLD
 
 COUNTRY_CODE = 'gb'
 PAUSE_SEC = 30
+DATABASE_FILE = 'database/napp.db'
+CACHE_FILE = 'database/classifier_cache.db'
+FEED_HISTORY_DAYS = 3
+NLP_PROCESSES = int(os.getenv('NLP_PROCESSES', os.cpu_count()))
+# estimated Jaccard similarity of news shingles for them to be the same story
+STORY_SIMILARITY = float(os.getenv('STORY_SIMILARITY', THRESHOLD))
 
 
-def match_event(news, events, classifier):
+def match_event(news, events, classifier, keywords=None, stories=None, signature=None):
+    """ Return the event of news, updated or new.
+
+    With stories, the event is the one of the most similar recent news
+    according to their MinHash signatures. Otherwise, or if no news is
+    similar enough, it is the one sharing most keywords, then the one named
+    like the new event would be.
+    """
     event = None
 
-    position = news.headline.find(" - ")
-    headline = news.headline[:position if position else len(news.headline)]
+    headline = strip_source(news.headline)
 
-    keywords = classifier.get_named_entities(headline)
+    if keywords is None:
+        keywords = classifier.get_named_entities(headline)
     if not keywords:
         keywords = set(headline.split(" "))
+    keywords = set(keywords)
+
+    if stories is not None:
+        if signature is None:
+            signature = stories.signature(news_text(news))
+        event_id, similarity = stories.match(signature)
+        event = events.get(event_id) if event_id else None
 
-    event = next((ev for ev in events if any(keyword in ev.keywords for keyword in keywords)), None)
+    if event is None:
+        # the event sharing most keywords wins
+        candidates = events.candidates(keywords)
+        event = candidates[0][0] if candidates else None
+
+    generated_name = ' '.join(list(keywords)[:10])
+    if event is None:
+        event = events.find_name(generated_name)
 
     if event:
         print(f'{datetime.now()} Exisitng event {event.name} matches news keywords: {keywords}')
         new_keywords = keywords.difference(event.keywords)
         if new_keywords:
             event.name = event.name + ' ' + ' '.join(list(new_keywords)[:3])       
-        new_keywords = keywords.union(event.keywords)
-        event.keywords = new_keywords
+        event.keywords = intern_keywords(keywords.union(event.keywords))
     else:
-        generated_name = ' '.join(list(keywords)[:10])
         keywords = set(k.lower() for k in keywords) # convert to lowercase
         event = Event(name=generated_name, keywords=keywords)
         print(f'Create event: {event.name}, keywords: {event.keywords}')
@@ -40,55 +77,195 @@ def match_event(news, events, classifier):
     return event
 
 
-def process_news(db, news_list, classifier):
-    # load recent events from database (added in the lase 3 days)
-    start_date = date.today() - timedelta(days=3)   
+def classify_news(news_batch):
+    categories = nlp_worker.classifier.predict_categories(news.headline for news in news_batch)
+    for news, category_id in zip(news_batch, categories):
+        news.country_code = COUNTRY_CODE
+        news.category_id = category_id
+    return news_batch
 
-    for news in news_list:
-        # skip duplicates
-        if db.find_news_headline(news.headline):
-            print(f'{datetime.now()} Not saved. Duplicate news found in the database: {news.headline}')
-            continue
 
-        news.country_code = COUNTRY_CODE
-        news.category_id = classifier.predict_category(news.headline)
+def find_news_keywords(news_batch):
+    stripped = (strip_source(news.headline) for news in news_batch)
+    return list(zip(news_batch, nlp_worker.classifier.get_named_entities_many(stripped)))
+
+
+def summarise_news(news_keywords):
+    with_text = [news for news, _ in news_keywords if news.text]
+    summaries = nlp_worker.classifier.make_summaries([news.text for news in with_text], SUMMARY_CHARS)
+    for news, summary in zip(with_text, summaries):
+        news.summary = summary
+    return news_keywords
+
+
+def sign_news(news_keywords, **kwargs):
+    news, keywords = news_keywords
+    return news, keywords, story_signature(news_text(news), **kwargs)
+
+
+def news_pipeline(db, deduplicator, events, action, executor=None, nlp_workers=1, stories=None):
+    """ Pipeline loading the news of its input sources into db.
+
+    fetch:     sources are loaded by action concurrently, one thread each
+    dedupe:    news already seen in this run or saved before, according to
+               deduplicator, are dropped before any NLP work
+    classify, ner, summarise:
+               NLP in executor, normally a process pool initialised with
+               nlp_worker.init, or in the current process with the nlp_worker
+               classifier
+    minhash:   with stories, MinHash signatures of the news, in executor
+    persist:   events of a batch are matched, then saved with one transaction
+               and its news with another, on one thread, an error only
+               drops the news it happened on
+    """
+    # keys of the news on their way through this run, not saved yet
+    pending = set()
+
+    def fetch(source):
+        return load_news([source], action)
 
-        # load latest events
-        events = list(db.find_events_since(start_date))
-        print(f'{datetime.now()} Loaded {len(events)} existing recent events')
+    def dedupe(news):
+        keys = news_keys(news.url, news.headline)
+        if pending.intersection(keys) or deduplicator.is_duplicate(news):
+            print(f'{datetime.now()} Not saved. Duplicate news found: {news.headline}')
+            return None
+        pending.update(keys)
+        return news
 
-        event = match_event(news, events, classifier)
-        assert event
-        event = db.save_event(event)
-        assert event.id
-        print(f'Saved event id: {event.id} name: {event.name} , keywords: {event.keywords}')
+    def save_events(event_batch):
+        # all events of the batch in one transaction, one at a time if that fails, like save_news
+        try:
+            return db.save_events_many(event_batch)
+        except Exception as e:
+            print(f'{datetime.now()} Error saving {len(event_batch)} events, saving them one at a time: {e}')
+        saved = []
+        for event in event_batch:
+            try:
+                saved.extend(db.save_events_many([event]))
+            except Exception as e:
+                print(f'{datetime.now()} Not saved. Error saving event {event.name}: {e}')
+                traceback.print_exc()
+        return saved
 
-        news.event_id = event.id
+    def save_news(news_batch):
+        # all news of the batch in one transaction, one at a time if that fails, so one news cannot lose the others
+        try:
+            return db.save_news_many(news_batch)
+        except Exception as e:
+            print(f'{datetime.now()} Error saving {len(news_batch)} news, saving them one at a time: {e}')
+        saved = []
+        for news in news_batch:
+            try:
+                saved.extend(db.save_news_many([news]))
+            except Exception as e:
+                print(f'{datetime.now()} Not saved. Error saving news {news.headline}: {e}')
+                traceback.print_exc()
+        return saved
 
-        # TODO: summary here
-        if news.text:
-            news.summary = classifier.make_summary(news.text)[:500]
+    def persist(signed_news):
+        # events are matched for the whole batch first, then saved together
+        event_batch = EventBatch(events)
+        matched = []
+        for news, keywords, news_signature in signed_news:
+            try:
+                event = match_event(news, event_batch, None, keywords, stories, news_signature)
+                assert event
+            except Exception as e:
+                print(f'{datetime.now()} Not saved. Error matching event of news {news.headline}: {e}')
+                traceback.print_exc()
+                continue
+            event_batch.add(event)
+            matched.append((news, event, news_signature))
 
-        news = db.save_news(news)
-        print(f'{datetime.now()} {Categories[news.category_id]:<14} {news.id:>4} {news.headline}')
+        for event in save_events(event_batch.matched):
+            print(f'Saved event id: {event.id} name: {event.name} , keywords: {event.keywords}')
 
+        news_batch = []
+        signatures = {}
+        for news, event, news_signature in matched:
+            if not event.id:
+                print(f'{datetime.now()} Not saved. Event of news {news.headline} was not saved')
+                continue
+            news.event_id = event.id
+            news_batch.append(news)
+            signatures[news.url] = news_signature
 
-def load_news(sources, action):
-    # dictionary maps url to news to avoid duplicates from different sources
-    news_list = {}
-    for source in sources:
-        news = action(source)
-        print(f'{datetime.now()} Loaded {len(news)} news from {source}')
-        news_list.update({n.url:n for n in news})
+        saved = save_news(news_batch)
+        for news in saved:
+            # only news in the database join stories
+            if stories is not None:
+                stories.add(news.url, news.event_id, signatures[news.url])
+            deduplicator.add(news)
+            # the deduplicator has them now, so pending only holds the news on their way
+            pending.difference_update(news_keys(news.url, news.headline))
+            print(f'{datetime.now()} {Categories[news.category_id]:<14} {news.id:>4} {news.headline}')
+        return saved
 
-    return news_list.values()
+    if stories is not None:
+        sign = functools.partial(sign_news,
+            num_perm=stories.num_perm, shingle_size=stories.shingle_size, seed=stories.seed)
+    else:
+        sign = lambda news_keywords: news_keywords + (None,)
+
+    return Pipeline([
+        Stage('fetch', fetch, workers=MAX_CONCURRENCY, many=True),
+        Stage('dedupe', dedupe),
+        Stage('classify', classify_news, workers=nlp_workers, executor=executor, batch_size=NLP_BATCH_SIZE),
+        Stage('ner', find_news_keywords, workers=nlp_workers, executor=executor, batch_size=NLP_BATCH_SIZE),
+        Stage('summarise', summarise_news, workers=nlp_workers, executor=executor, batch_size=NLP_BATCH_SIZE),
+        Stage('minhash', sign, workers=nlp_workers, executor=executor if stories is not None else None),
+        Stage('persist', persist, batch_size=NLP_BATCH_SIZE),
+    ])
+
+
+def load_news(sources, action, **kwargs):
+    """ Yield the news of sources, fetched concurrently, see source_fetcher.fetch_all for kwargs.
+
+    A source may return a generator, such as load_news_from_file, which is
+    read as the news are used, so a large file is never held in memory. Only
+    its first read is timed and retried, an error in a later one ends that
+    source with the news read so far. News of several sources with the same
+    url are all yielded, the dedupe stage of news_pipeline keeps the first.
+    """
+    results = asyncio.run(fetch_all(sources, action, **kwargs))
+    for source, news in zip(sources, results):
+        count = 0
+        try:
+            for count, item in enumerate(news, start=1):
+                yield item
+        except Exception as e:
+            print(f'{datetime.now()} Error reading news from {source} after {count} news: {e}')
+        print(f'{datetime.now()} Loaded {count} news from {source}')
+
+
+def load_classifier(shared_counts=None):
+    # called once in every NLP worker process
+    return CachedClassifier(Classifier(), filename=CACHE_FILE, shared_counts=shared_counts)
 
 
 def main():
-    conn = sqlite3.connect('database/napp.db', detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES)
+    # python napp/news_loader.py --backfill FILE loads a recorded or archived EventRegistry response once
+    backfill_file = sys.argv[2] if sys.argv[1:2] == ['--backfill'] else None
+
+    # only the persist stage uses the connection while news are processed
+    conn = connect(DATABASE_FILE, check_same_thread=False)
     db = NappDatabase(conn)
+    reader = NappDatabase(connect(DATABASE_FILE, read_only=True), create=False)
+
+    # keys of all saved news, duplicates are mostly rejected without a query
+    deduplicator = NewsDeduplicator(reader, window_days=FEED_HISTORY_DAYS)
+    seeded = deduplicator.seed()
+    print(f'{datetime.now()} Seeded duplicate filter with {seeded} news')
+
+    # NLP runs in worker processes, each loading its own classifier and adding up cache hits in shared memory
+    classifier_counts = SharedCounts()
+    nlp_pool = ProcessPoolExecutor(max_workers=NLP_PROCESSES, initializer=nlp_worker.init,
+                                   initargs=(functools.partial(load_classifier, classifier_counts),))
 
-    classifier = Classifier()
+    # recent events (added in the last 3 days), saved events are applied as they are written
+    events = EventWorkingSet(db, days=3)
+    # recent news clustered into events by similarity
+    stories = NewsStories(db, days=3, threshold=STORY_SIMILARITY)
 
     newsapi_org = NewsApiSource(
                 api_key=os.getenv('NEWSAPI_KEY'), 
@@ -96,24 +273,45 @@ def main():
     )
     event_registry_api = EventRegistrySource(
                 api_key=os.getenv('EVENT_REGISTRY_KEY'),
-                record_response_file='tests/data/event_registry_org3.json',
+                record_response_file=backfill_file or 'tests/data/event_registry_org3.json',
                 max_items=30
     )
 
     while True:
-        news_list = load_news(
-            sources=[
-                # newsapi_org,
-                event_registry_api
-            ],
+        # pick up events changed by other loaders since the last cycle
+        changed = events.refresh()
+        print(f'{datetime.now()} Refreshed {changed} events, {len(events)} recent events in memory')
+        added = stories.refresh()
+        print(f'{datetime.now()} Added {added} news to stories, {len(stories)} recent news in memory')
+
+        pipeline = news_pipeline(
+            db, deduplicator, events,
             # action=lambda source: source.load_news(language='en', country=COUNTRY_CODE)
-            action=lambda source: source.load_news_from_file()
+            action=lambda source: source.load_news_from_file(),
+            executor=nlp_pool,
+            nlp_workers=NLP_PROCESSES,
+            stories=stories
         )
-        process_news(db, news_list, classifier)
+        # news are streamed from the sources and the saved ones are not kept
+        saved = pipeline.run([
+            # newsapi_org,
+            event_registry_api
+        ], collect=False)
+        print(f'{datetime.now()} Saved {saved} news')
+        pipeline.print_metrics()
+        print(f'{datetime.now()} {classifier_counts}')
+
+        deduplicator.expire()
+        if backfill_file:
+            break
+
+        # live feed clients can resume from up to FEED_HISTORY_DAYS ago
+        db.prune_feed_changes(date.today() - timedelta(days=FEED_HISTORY_DAYS))
 
         print('Pausing...')
         time.sleep(PAUSE_SEC)
 
+    nlp_pool.shutdown()
     if conn:
         conn.close()
 
@@ -2,6 +2,10 @@ import json
 from dateutil import parser
 from newsapi import NewsApiClient
 from models import News
+from json_stream import iter_array
+
+# where the articles are in a whole API response
+RESULTS_PATH = ('articles',)
 
 class NewsApiSource:
     def __init__(self, api_key, record_response_file=None):
@@ -32,6 +36,7 @@ class NewsApiSource:
         return [self.news_from_api(obj) for obj in articles]
     
     def load_news_from_file(self):
+        """ Yield the news of the recorded articles, or of a whole API response, reading the file as they are used. """
         with open(self.record_response_file) as f:
-            articles = json.load(f)
-        return [self.news_from_api(obj) for obj in articles]
+            for obj in iter_array(f, RESULTS_PATH):
+                yield self.news_from_api(obj)
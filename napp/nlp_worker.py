@@ -0,0 +1,13 @@
+""" Classifier of the current process, for pipeline stages run in worker processes.
+
+Pass init as the initializer of a ProcessPoolExecutor so that each worker
+loads the models once. Call init directly to run the same stage functions in
+the current process.
+"""
+
+classifier = None
+
+
+def init(classifier_factory):
+    global classifier
+    classifier = classifier_factory()
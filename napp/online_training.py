@@ -0,0 +1,251 @@
+""" Incremental training of the category model from newly saved, labelled news.
+
+The model is a multinomial naive Bayes over the hashed token counts of
+hashing_model, so new words need no new vocabulary. OnlineNB keeps its
+counts and learns chunks of examples with partial_fit, as sklearn's
+MultinomialNB does. It starts from the counts of the pickled model, with
+the keyword categories (environment, lgbt, youth) as extra classes.
+
+The examples are the headlines of the News table with their category,
+and the articles of json files whose headline matches a keyword list.
+Both are streamed and learnt CHUNK_SIZE at a time, so memory does not
+grow with the corpus.
+
+Every training run saves a checkpoint as the next version directory,
+then points CURRENT at it. Classifiers with the 'online' engine check
+CURRENT every MODEL_CHECK_SEC and swap to the new version between batches.
+
+Run from the repository root: python napp/online_training.py [--watch]
+"""
+import itertools
+import os
+import re
+import shutil
+import sys
+import time
+from datetime import datetime
+import numpy as np
+from scipy import sparse
+import hashing_model
+import model_export
+from json_stream import iter_array
+
+CHECKPOINT_DIRECTORY = 'model/nb-online'
+DATABASE_FILE = 'database/napp.db'
+JSON_FILES = ['json/news.json']
+# where the articles are in a whole EventRegistry response, as in eventregistry_source
+RESULTS_PATH = ('articles', 'results')
+CHUNK_SIZE = 1000
+KEEP_VERSIONS = 3
+ALPHA = 1.0
+TRAIN_INTERVAL_SEC = 3600
+
+ARRAYS = hashing_model.ARRAYS + ['feature_count', 'class_count']
+
+
+class OnlineNB:
+    """ Counts of a multinomial naive Bayes over hashed columns, updated with partial_fit. """
+
+    def __init__(self, feature_count, class_count, classes, alpha=ALPHA):
+        # n_features x classes, like HashingNB.feature_log_prob
+        self.feature_count = feature_count
+        self.class_count = class_count
+        self.classes = classes
+        self.alpha = alpha
+
+    @classmethod
+    def from_pickled(cls, model, vectoriser, classes, n_features=hashing_model.N_FEATURES, alpha=ALPHA):
+        """ Counts of a fitted MultinomialNB folded into hashed columns, with zero counts for new classes. """
+        classes = np.asarray(classes)
+        columns = np.searchsorted(classes, model.classes_)
+        buckets = hashing_model.vocabulary_buckets(vectoriser, n_features)
+
+        feature_count = np.zeros((n_features, len(classes)), dtype=np.float32)
+        np.add.at(feature_count, (buckets[:, None], columns[None, :]), model.feature_count_.T)
+        class_count = np.zeros(len(classes))
+        class_count[columns] = model.class_count_
+        return cls(feature_count, class_count, classes, alpha)
+
+    def partial_fit(self, x, y):
+        """ Add the hashed token counts x of documents of categories y. """
+        columns = np.searchsorted(self.classes, y)
+        if np.any(self.classes[np.minimum(columns, len(self.classes) - 1)] != y):
+            raise ValueError('labels outside the classes of the model')
+
+        labels = sparse.csr_matrix((np.ones(len(columns)), (np.arange(len(columns)), columns)),
+                                   shape=(len(columns), len(self.classes)))
+        # only the buckets used by the chunk, a dense product would be n_features x classes
+        counts = (x.T @ labels).tocoo()
+        np.add.at(self.feature_count, (counts.row, counts.col), counts.data)
+        self.class_count += np.bincount(columns, minlength=len(self.classes))
+
+    def feature_log_prob(self):
+        # smoothed over the buckets seen in training only, so other tokens count for nothing,
+        # as words outside the vocabulary of a CountVectorizer do
+        used = self.feature_count.any(axis=1)
+        smoothed = self.feature_count[used].astype(np.float64) + self.alpha
+        feature_log_prob = np.zeros(self.feature_count.shape, dtype=np.float32)
+        feature_log_prob[used] = np.log(smoothed) - np.log(smoothed.sum(axis=0))
+        return feature_log_prob
+
+    def class_log_prior(self):
+        with np.errstate(divide='ignore'):
+            # classes never seen are never predicted
+            return np.log(self.class_count) - np.log(self.class_count.sum())
+
+    def arrays(self):
+        return {
+            'feature_log_prob': self.feature_log_prob(),
+            'class_log_prior': self.class_log_prior(),
+            'classes': self.classes,
+            'feature_count': self.feature_count,
+            'class_count': self.class_count,
+        }
+
+
+def list_versions(directory):
+    try:
+        return sorted(name for name in os.listdir(directory) if re.fullmatch(r'v\d+', name))
+    except OSError:
+        return []
+
+
+def current_version(directory):
+    try:
+        with open(os.path.join(directory, 'CURRENT')) as f:
+            return f.read().strip() or None
+    except OSError:
+        return None
+
+
+def save_checkpoint(directory, model, meta):
+    """ Save model as the next version of directory and make it current. Return the version. """
+    os.makedirs(directory, exist_ok=True)
+    versions = list_versions(directory)
+    version = 'v{:04d}'.format(int(versions[-1][1:]) + 1 if versions else 1)
+    model_export.write_arrays(os.path.join(directory, version), model.arrays(), meta)
+
+    temp = os.path.join(directory, 'CURRENT.tmp')
+    with open(temp, 'w') as f:
+        f.write(version)
+    os.replace(temp, os.path.join(directory, 'CURRENT'))
+
+    # processes still using an older version keep their memory map of the deleted files
+    for old in versions[:max(len(versions) + 1 - KEEP_VERSIONS, 0)]:
+        shutil.rmtree(os.path.join(directory, old), ignore_errors=True)
+    return version
+
+
+def read_checkpoint(directory, version, names):
+    return model_export.read_arrays(os.path.join(directory, version), names)
+
+
+def load(directory, version):
+    """ Return (vectoriser, model) memory mapped from a checkpoint. """
+    meta, arrays = read_checkpoint(directory, version, hashing_model.ARRAYS)
+    return hashing_model.HashingVectoriser(meta['n_features']), hashing_model.HashingNB(**arrays)
+
+
+def start(directory, model_filename, vectoriser_filename, digest, classes):
+    """ Return (OnlineNB, meta) of the current checkpoint, or of the pickled model if there is none. """
+    version = current_version(directory)
+    if version:
+        meta, arrays = read_checkpoint(directory, version, ARRAYS)
+        # copies, learning must not write to the memory mapped files
+        model = OnlineNB(np.array(arrays['feature_count']), np.array(arrays['class_count']),
+                         np.array(arrays['classes']), meta['alpha'])
+        return model, meta
+
+    model = OnlineNB.from_pickled(*model_export.load_pickles(model_filename, vectoriser_filename), classes)
+    meta = {'digest': digest, 'n_features': hashing_model.N_FEATURES, 'alpha': ALPHA,
+            'examples': 0, 'last_news_id': 0, 'files': []}
+    return model, meta
+
+
+def load_or_start(model_filename, vectoriser_filename, digest, classes, directory=CHECKPOINT_DIRECTORY):
+    """ Return (version, vectoriser, model) of the current checkpoint, saving the pickled model as the first. """
+    version = current_version(directory)
+    if not version:
+        model, meta = start(directory, model_filename, vectoriser_filename, digest, classes)
+        version = save_checkpoint(directory, model, meta)
+    return (version, *load(directory, version))
+
+
+def news_examples(db, news_id, classes):
+    """ Yield (news id, headline, category id) of the news saved after news_id with a category of the model. """
+    for example in db.find_news_categories(news_id):
+        if example[2] in classes:
+            yield example
+
+
+def json_examples(filename, classifier):
+    """ Yield (None, headline, category id) of the articles of a json file matching a keyword list. """
+    with open(filename) as f:
+        # recorded articles, or a whole EventRegistry response
+        for article in iter_array(f, RESULTS_PATH):
+            category_id = classifier.match_category(article['title'])
+            if category_id is not None:
+                yield None, article['title'], category_id
+
+
+def chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def train(db, classifier, directory=CHECKPOINT_DIRECTORY, json_filenames=JSON_FILES, chunk_size=CHUNK_SIZE):
+    """ Learn the news saved since the current checkpoint and the json files not learnt yet.
+
+    Starts from classifier's pickled model if there is no checkpoint, and
+    labels json articles with its keyword lists. Returns the new version,
+    or None if there was nothing to learn.
+    """
+    from classifier import Categories, file_digest
+
+    classes = np.arange(len(Categories))
+    model, meta = start(directory, classifier.model_filename, classifier.vectoriser_filename,
+                        classifier.digest, classes)
+    vectoriser = hashing_model.HashingVectoriser(meta['n_features'])
+
+    files = [(filename, file_digest(filename)) for filename in json_filenames]
+    files = [(filename, digest) for filename, digest in files if digest not in meta['files']]
+    examples = itertools.chain(
+        news_examples(db, meta['last_news_id'], classes),
+        *(json_examples(filename, classifier) for filename, _ in files))
+
+    learnt = 0
+    for chunk in chunks(examples, chunk_size):
+        news_ids, texts, labels = zip(*chunk)
+        model.partial_fit(vectoriser.transform(list(texts)), np.array(labels))
+        meta['last_news_id'] = max([meta['last_news_id']] + [i for i in news_ids if i is not None])
+        learnt += len(chunk)
+
+    meta['files'] = meta['files'] + [digest for _, digest in files]
+    if not learnt:
+        return None
+
+    meta['examples'] += learnt
+    return save_checkpoint(directory, model, meta)
+
+
+def main():
+    from classifier import Classifier
+    from database import NappDatabase, connect
+
+    classifier = Classifier(engine='online')
+    db = NappDatabase(connect(DATABASE_FILE, read_only=True), create=False)
+    while True:
+        started = time.perf_counter()
+        version = train(db, classifier)
+        print(f'{datetime.now()} Trained {version or "nothing new"} in {time.perf_counter() - started:.1f}s')
+        if '--watch' not in sys.argv:
+            break
+        time.sleep(TRAIN_INTERVAL_SEC)
+
+
+if __name__ == '__main__':
+    main()
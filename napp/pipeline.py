@@ -0,0 +1,221 @@
+import queue
+import threading
+import time
+import traceback
+from datetime import datetime
+
+QUEUE_SIZE = 100
+
+# marks the end of a stage's input, one per worker thread
+END = object()
+
+
+class StageMetrics:
+    def __init__(self, name):
+        self.name = name
+        self.items_in = 0
+        self.items_out = 0
+        self.errors = 0
+        self.busy_sec = 0
+        self.max_latency_sec = 0
+        self.max_queue_depth = 0
+        self.lock = threading.Lock()
+
+    def add(self, items_in, items_out, seconds, queue_depth):
+        with self.lock:
+            self.items_in += items_in
+            self.items_out += items_out
+            self.busy_sec += seconds
+            # a batch shares its latency between its items
+            self.max_latency_sec = max(self.max_latency_sec, seconds / max(items_in, 1))
+            self.max_queue_depth = max(self.max_queue_depth, queue_depth)
+
+    def add_error(self):
+        with self.lock:
+            self.errors += 1
+
+    @property
+    def mean_latency_sec(self):
+        return self.busy_sec / self.items_in if self.items_in else 0
+
+    def __str__(self):
+        return (f'{self.name:<10} in {self.items_in:>5} out {self.items_out:>5} errors {self.errors:>3} '
+                f'latency mean {self.mean_latency_sec * 1000:8.1f}ms max {self.max_latency_sec * 1000:8.1f}ms '
+                f'busy {self.busy_sec:7.2f}s max queue {self.max_queue_depth:>4}')
+
+
+class Stage:
+    """ One step of a Pipeline, run by its own worker threads.
+
+    function takes an item and returns the item for the next stage, or None
+    to drop it. With many=True it returns an iterable of items instead, which
+    may be a generator producing them while the next stages run. With
+    batch_size it takes a list of up to batch_size queued items and returns a
+    list of results, so models can process them in one call; if that fails,
+    it is called again with each item on its own.
+
+    I/O stages call function in their worker threads. CPU stages pass an
+    executor, usually a ProcessPoolExecutor, and their threads only wait for
+    it; function and items must then be picklable.
+    """
+
+    def __init__(self, name, function, workers=1, executor=None, many=False, batch_size=None, queue_size=QUEUE_SIZE):
+        assert not (many and batch_size)
+        self.name = name
+        self.function = function
+        self.workers = workers
+        self.executor = executor
+        self.many = many
+        self.batch_size = batch_size
+        self.queue_size = queue_size
+        self.metrics = StageMetrics(name)
+
+    def call(self, argument):
+        if self.executor:
+            return self.executor.submit(self.function, argument).result()
+        return self.function(argument)
+
+
+class Pipeline:
+    """ Stages connected by bounded queues.
+
+    Every stage works on different items at the same time, so throughput is
+    bounded by the slowest stage instead of the sum of all of them. A full
+    queue blocks the stage feeding it, which keeps fast stages from running
+    ahead of slow ones and bounds memory use.
+    """
+
+    def __init__(self, stages):
+        self.stages = stages
+
+    def run(self, items, collect=True):
+        """ Pass items through every stage and return the results of the last one.
+
+        With collect=False the results are dropped and only counted, so a long
+        run, such as a backfill, does not keep them all.
+        """
+        for stage in self.stages:
+            stage.metrics = StageMetrics(stage.name)
+
+        queues = [queue.Queue(maxsize=stage.queue_size) for stage in self.stages]
+        # the last stage puts its results here
+        queues.append(queue.Queue())
+        remaining = [stage.workers for stage in self.stages]
+        lock = threading.Lock()
+
+        def worker(i):
+            stage, source, target = self.stages[i], queues[i], queues[i + 1]
+            while True:
+                batch, ended = self.take(stage, source)
+                if batch:
+                    self.process(stage, batch, source, target)
+                if ended:
+                    break
+
+            # the last worker to finish ends the next stage
+            with lock:
+                remaining[i] -= 1
+                last = remaining[i] == 0
+            if last:
+                for _ in range(self.stages[i + 1].workers if i + 1 < len(self.stages) else 1):
+                    target.put(END)
+
+        threads = [threading.Thread(target=worker, args=(i,), name=f'{stage.name}-{n}', daemon=True)
+                   for i, stage in enumerate(self.stages) for n in range(stage.workers)]
+        for thread in threads:
+            thread.start()
+
+        try:
+            for item in items:
+                queues[0].put(item)
+        finally:
+            # also when reading items fails, so the worker threads end before its error is raised
+            for _ in range(self.stages[0].workers):
+                queues[0].put(END)
+            results = self.results(queues[-1], collect)
+            for thread in threads:
+                thread.join()
+        return results
+
+    def results(self, source, collect):
+        """ Read the results of the last stage until it ends, returning them or, without collect, their count. """
+        results = []
+        count = 0
+        while True:
+            result = source.get()
+            if result is END:
+                break
+            count += 1
+            if collect:
+                results.append(result)
+        return results if collect else count
+
+    def take(self, stage, source):
+        """ Return the next items for stage and whether its input has ended. """
+        item = source.get()
+        if item is END:
+            return [], True
+        if not stage.batch_size:
+            return [item], False
+
+        batch = [item]
+        while len(batch) < stage.batch_size:
+            try:
+                item = source.get_nowait()
+            except queue.Empty:
+                break
+            if item is END:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def process(self, stage, batch, source, target):
+        queue_depth = source.qsize()
+        started_at = time.monotonic()
+        items_out = 0
+        try:
+            if stage.batch_size:
+                results = self.call_batch(stage, batch)
+            elif stage.many:
+                results = stage.call(batch[0])
+            else:
+                results = [stage.call(batch[0])]
+            # items of a generator are passed on as they are made, the full queue pausing it
+            for result in results:
+                if result is not None:
+                    target.put(result)
+                    items_out += 1
+        except Exception as e:
+            self.report_error(stage, e)
+
+        stage.metrics.add(len(batch), items_out, time.monotonic() - started_at, queue_depth)
+
+    def call_batch(self, stage, batch):
+        """ Results of a batch, or if it fails of each of its items, so an error only drops the item it happened on. """
+        try:
+            return stage.call(batch)
+        except Exception as e:
+            if len(batch) == 1:
+                raise
+            print(f'{datetime.now()} Error in pipeline stage {stage.name} for {len(batch)} items, '
+                  f'processing them one at a time: {e}')
+
+        results = []
+        for item in batch:
+            try:
+                results.extend(stage.call([item]))
+            except Exception as e:
+                self.report_error(stage, e)
+        return results
+
+    def report_error(self, stage, e):
+        print(f'{datetime.now()} Error in pipeline stage {stage.name}: {e}')
+        traceback.print_exc()
+        stage.metrics.add_error()
+
+    def metrics(self):
+        return {stage.name: stage.metrics for stage in self.stages}
+
+    def print_metrics(self):
+        for stage in self.stages:
+            print(f'{datetime.now()} {stage.metrics}')
@@ -0,0 +1,56 @@
+import hashlib
+import time
+from collections import OrderedDict
+
+
+class CachedResponse:
+    def __init__(self, version, body, headers):
+        self.version = version
+        self.body = body
+        self.headers = headers
+        self.etag = f'"{version}-{hashlib.sha1(body).hexdigest()[:16]}"'
+
+
+class ResponseCache:
+    """ Serialised API responses keyed by endpoint and query parameters.
+
+    Entries stay valid while the database DataVersion counter, bumped by
+    every loader commit, is unchanged. The counter itself is re-read at most
+    once every version_ttl_sec, so within that time a cached response costs
+    no database access at all.
+    """
+
+    def __init__(self, version_ttl_sec=1.0, max_items=1000):
+        self.version_ttl_sec = version_ttl_sec
+        self.max_items = max_items
+        self.entries = OrderedDict()
+        self.version = None
+        self.version_read_at = 0
+
+    def version_expired(self):
+        return time.monotonic() - self.version_read_at > self.version_ttl_sec
+
+    def set_version(self, version):
+        if version != self.version:
+            # every entry belongs to an older version
+            self.entries.clear()
+        self.version = version
+        self.version_read_at = time.monotonic()
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry and entry.version == self.version:
+            self.entries.move_to_end(key)
+            return entry
+
+    def put(self, key, body, headers, version):
+        """ Cache a response built from data of version, unless the version changed while it was built. """
+        entry = CachedResponse(version, body, headers)
+        if version != self.version:
+            # the body may predate the current version, it is served once but not cached
+            return entry
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_items:
+            self.entries.popitem(last=False)
+        return entry
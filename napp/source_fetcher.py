@@ -0,0 +1,69 @@
+import asyncio
+import collections.abc
+import inspect
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+MAX_CONCURRENCY = 4
+TIMEOUT_SEC = 30
+RETRIES = 2
+BACKOFF_SEC = 1.0
+
+
+def start(action, source):
+    """ Return action(source), with the first item read if it is an iterator, such as load_news_from_file.
+
+    Opening a lazily read source and its first read are then timed and
+    retried like any other call. Later reads happen as the news are used,
+    outside the timeout, and an error there ends the source without a retry.
+    """
+    result = action(source)
+    if not isinstance(result, collections.abc.Iterator):
+        return result
+    for first in result:
+        return itertools.chain([first], result)
+    return []
+
+
+async def call_action(action, source, executor=None):
+    """ Run action(source), awaiting it if async, otherwise started in executor. """
+    if inspect.iscoroutinefunction(action):
+        return await action(source)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, start, action, source)
+
+
+async def fetch_source(source, action, semaphore, executor=None, timeout_sec=TIMEOUT_SEC, retries=RETRIES, backoff_sec=BACKOFF_SEC):
+    """ Return the news loaded from source, or an empty list if every attempt failed. """
+    for attempt in range(retries + 1):
+        if attempt:
+            # exponential backoff between attempts, outside the semaphore
+            await asyncio.sleep(backoff_sec * 2 ** (attempt - 1))
+        try:
+            async with semaphore:
+                return await asyncio.wait_for(call_action(action, source, executor), timeout_sec)
+        except asyncio.TimeoutError:
+            print(f'{datetime.now()} Timed out loading news from {source} after {timeout_sec}s (attempt {attempt + 1})')
+        except Exception as e:
+            print(f'{datetime.now()} Error loading news from {source}: {e} (attempt {attempt + 1})')
+    return []
+
+
+async def fetch_all(sources, action, max_concurrency=MAX_CONCURRENCY, retries=RETRIES, **kwargs):
+    """ Load news from all sources concurrently, returning one list per source in source order.
+
+    Blocking actions run in threads, so slow HTTP sources overlap and a cycle
+    takes as long as the slowest source instead of the sum of all of them.
+    Abandoned calls are left to finish in the background. kwargs are passed
+    to fetch_source.
+    """
+    semaphore = asyncio.Semaphore(max_concurrency)
+    # a timed out call cannot be interrupted and keeps its thread, so there is one
+    # thread per possible attempt; the semaphore limits how many are active
+    executor = ThreadPoolExecutor(max_workers=max(1, len(sources) * (retries + 1)), thread_name_prefix='source')
+    try:
+        return await asyncio.gather(
+            *(fetch_source(source, action, semaphore, executor, retries=retries, **kwargs) for source in sources))
+    finally:
+        executor.shutdown(wait=False)
@@ -0,0 +1,194 @@
+import hashlib
+import heapq
+import re
+from collections import defaultdict
+from datetime import datetime, date, time, timedelta
+from functools import lru_cache
+import numpy as np
+
+NUM_PERM = 128
+SHINGLE_SIZE = 3
+THRESHOLD = 0.2
+SEED = 1
+
+MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+MAX_HASH = np.uint64((1 << 32) - 1)
+
+
+def shingles(text, size=SHINGLE_SIZE):
+    """ Set of the overlapping size word sequences of text, or its words if it is shorter. """
+    words = re.findall(r'\w+', text.casefold())
+    if len(words) < size:
+        return set(words)
+    return set(' '.join(words[i:i + size]) for i in range(len(words) - size + 1))
+
+
+def lsh_params(num_perm, threshold):
+    """ Return (bands, rows) with bands * rows == num_perm whose LSH threshold is closest to threshold. """
+    # documents of similarity s share a band with probability 1 - (1 - s^rows)^bands,
+    # which rises steepest around (1 / bands)^(1 / rows)
+    return min(((bands, num_perm // bands) for bands in range(1, num_perm + 1) if num_perm % bands == 0),
+               key=lambda params: abs((1 / params[0]) ** (1 / params[1]) - threshold))
+
+
+class MinHasher:
+    """ MinHash signatures of shingle sets, num_perm universal hash functions (a * h + b) mod p. """
+
+    def __init__(self, num_perm=NUM_PERM, seed=SEED):
+        random = np.random.RandomState(seed)
+        # 31 bit parameters and 32 bit hashes keep a * h + b within 64 bits
+        self.a = random.randint(1, 1 << 31, size=num_perm).astype(np.uint64)
+        self.b = random.randint(0, 1 << 31, size=num_perm).astype(np.uint64)
+
+    def signature(self, shingles):
+        if not shingles:
+            return np.full(len(self.a), MAX_HASH, dtype=np.uint32)
+        hashes = np.array([int.from_bytes(hashlib.blake2b(s.encode('utf-8'), digest_size=4).digest(), 'little')
+                           for s in shingles], dtype=np.uint64)
+        values = (np.outer(hashes, self.a) + self.b) % MERSENNE_PRIME & MAX_HASH
+        return values.min(axis=0).astype(np.uint32)
+
+
+@lru_cache(maxsize=None)
+def min_hasher(num_perm=NUM_PERM, seed=SEED):
+    return MinHasher(num_perm, seed)
+
+
+def signature(text, num_perm=NUM_PERM, shingle_size=SHINGLE_SIZE, seed=SEED):
+    """ MinHash signature of text, the same in every process for the same parameters. """
+    return min_hasher(num_perm, seed).signature(shingles(text, shingle_size))
+
+
+def similarity(signature1, signature2):
+    """ Estimated Jaccard similarity of the shingle sets of two signatures. """
+    return float(np.mean(signature1 == signature2))
+
+
+class StoryClusters:
+    """ Incremental clustering of documents into stories with MinHash LSH.
+
+    Each document is added with its story id (an event id) and its MinHash
+    signature, cut into bands. A new document is only compared with the
+    documents sharing at least one band with it, so lookups do not scan
+    every document. match() returns the story of the most similar of them
+    if its estimated Jaccard similarity reaches threshold.
+    """
+
+    def __init__(self, threshold=THRESHOLD, num_perm=NUM_PERM, shingle_size=SHINGLE_SIZE, seed=SEED):
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+        self.seed = seed
+        self.bands, self.rows = lsh_params(num_perm, threshold)
+        # one dictionary per band, from band bytes to document keys
+        self.buckets = [defaultdict(set) for _ in range(self.bands)]
+        self.signatures = {}
+        self.stories = {}
+        # (added at, key) heap used to expire the oldest documents first
+        self.by_age = []
+        self.added_at = {}
+
+    def __len__(self):
+        return len(self.signatures)
+
+    def __contains__(self, key):
+        return key in self.signatures
+
+    def signature(self, text):
+        return signature(text, self.num_perm, self.shingle_size, self.seed)
+
+    def band_keys(self, signature):
+        return [signature[band * self.rows:(band + 1) * self.rows].tobytes() for band in range(self.bands)]
+
+    def add(self, key, story_id, signature, added_at=None):
+        """ Add a document or move it to another story. """
+        self.remove(key)
+        for bucket, band_key in zip(self.buckets, self.band_keys(signature)):
+            bucket[band_key].add(key)
+        self.signatures[key] = signature
+        self.stories[key] = story_id
+
+        added_at = added_at or datetime.utcnow()
+        self.added_at[key] = added_at
+        heapq.heappush(self.by_age, (added_at, key))
+
+    def remove(self, key):
+        signature = self.signatures.pop(key, None)
+        if signature is None:
+            return
+        for bucket, band_key in zip(self.buckets, self.band_keys(signature)):
+            keys = bucket[band_key]
+            keys.discard(key)
+            if not keys:
+                del bucket[band_key]
+        del self.stories[key]
+        del self.added_at[key]
+
+    def expire(self, start_date):
+        """ Remove documents added before start_date. """
+        if not isinstance(start_date, datetime):
+            start_date = datetime.combine(start_date, time())
+
+        while self.by_age and self.by_age[0][0] < start_date:
+            added_at, key = heapq.heappop(self.by_age)
+            # skip entries of documents since removed or added again
+            if self.added_at.get(key) == added_at:
+                self.remove(key)
+
+    def candidates(self, signature):
+        keys = set()
+        for bucket, band_key in zip(self.buckets, self.band_keys(signature)):
+            keys.update(bucket.get(band_key, ()))
+        return keys
+
+    def match(self, signature):
+        """ Return (story id, similarity) of the most similar document, or (None, 0) below threshold. """
+        best_story, best_similarity = None, 0
+        for key in self.candidates(signature):
+            value = similarity(signature, self.signatures[key])
+            if value > best_similarity or (value == best_similarity and best_story is not None
+                                            and self.stories[key] < best_story):
+                best_story, best_similarity = self.stories[key], value
+
+        if best_similarity < self.threshold:
+            return None, 0
+        return best_story, best_similarity
+
+
+def news_text(news):
+    return news.headline + ' ' + (news.text or '')
+
+
+class NewsStories(StoryClusters):
+    """ StoryClusters of the last few days of news, kept in sync with the database.
+
+    Documents are keyed by URL and clustered by event id. The first refresh()
+    loads every recent news, later ones only the news saved since, also by
+    other loader processes. Documents of the caller, such as twitter trends,
+    are added with add().
+    """
+
+    def __init__(self, db, days=3, **kwargs):
+        super().__init__(**kwargs)
+        self.db = db
+        self.days = days
+        self.last_news_id = None
+
+    def refresh(self):
+        start_date = date.today() - timedelta(days=self.days)
+
+        if self.last_news_id is None:
+            news_list = self.db.find_news_since(start_date)
+            self.last_news_id = 0
+        else:
+            news_list = self.db.find_news_added_since(self.last_news_id)
+
+        count = 0
+        for news in news_list:
+            self.last_news_id = max(self.last_news_id, news.id)
+            if news.event_id and news.url not in self:
+                self.add(news.url, news.event_id, self.signature(news_text(news)), news.created_at)
+                count += 1
+
+        self.expire(start_date)
+        return count
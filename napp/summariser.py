@@ -0,0 +1,100 @@
+import numpy as np
+from scipy import sparse
+
+SUMMARY_CHARS = 500
+
+# parts of speech whose words count as the terms of a sentence
+CONTENT_POS = {'NOUN', 'VERB', 'PROPN'}
+
+
+def doc_sentences(doc):
+    """ Return [(sentence text, content terms)] of a parsed spaCy doc. """
+    return [(sent.text.strip(), [token.lower_ for token in sent if token.pos_ in CONTENT_POS])
+            for sent in doc.sents]
+
+
+def truncate(text, budget):
+    if len(text) <= budget:
+        return text
+    cut = text.rfind(' ', 0, budget + 1)
+    return text[:cut if cut > 0 else budget]
+
+
+def summarise(documents, budget=SUMMARY_CHARS):
+    """ Extractive summaries of documents, each a list of (sentence text, terms).
+
+    Terms used more than once in a document are its key words. A sentence
+    scores the number of times its document uses the key words it contains,
+    divided by the square root of its number of terms, so long sentences are
+    not favoured just for their length. The best sentences are kept, in
+    their original order, up to budget characters.
+
+    The term counts of all sentences of all documents are one sparse matrix,
+    so scoring a batch is a few sparse matrix operations.
+    """
+    vocabulary = {}
+    rows, columns = [], []
+    sentence_documents = []
+    for document_index, sentences in enumerate(documents):
+        for text, terms in sentences:
+            for term in terms:
+                rows.append(len(sentence_documents))
+                columns.append(vocabulary.setdefault(term, len(vocabulary)))
+            sentence_documents.append(document_index)
+
+    sentence_count = len(sentence_documents)
+    if not sentence_count:
+        return ['' for _ in documents]
+
+    # sentences x terms counts, and documents x sentences membership
+    counts = sparse.csr_matrix((np.ones(len(rows)), (rows, columns)), shape=(sentence_count, len(vocabulary)))
+    counts.sum_duplicates()
+    membership = sparse.csr_matrix(
+        (np.ones(sentence_count), (sentence_documents, np.arange(sentence_count))),
+        shape=(len(documents), sentence_count))
+
+    # documents x key word counts
+    document_counts = (membership @ counts).tocsr()
+    document_counts.data[document_counts.data < 2] = 0
+    document_counts.eliminate_zeros()
+
+    # each sentence against the key words of its own document only, so a batch stays linear in its size
+    present = counts.copy()
+    present.data[:] = 1
+    scores = np.asarray(present.multiply(document_counts[sentence_documents]).sum(axis=1)).ravel()
+    lengths = np.asarray(counts.sum(axis=1)).ravel()
+    scores = scores / np.sqrt(np.maximum(lengths, 1))
+
+    summaries = []
+    start = 0
+    for sentences in documents:
+        end = start + len(sentences)
+        summaries.append(select(sentences, scores[start:end], budget))
+        start = end
+    return summaries
+
+
+def select(sentences, scores, budget):
+    """ Join the best scoring sentences that fit in budget characters, in document order. """
+    if not sentences:
+        return ''
+
+    # sentences without key words only make it into summaries of documents without any
+    ranked = [i for i in np.argsort(-scores, kind='stable') if scores[i] > 0] or range(len(sentences))
+
+    chosen = []
+    used = 0
+    for i in ranked:
+        text = sentences[i][0]
+        if not text:
+            continue
+        length = len(text) + (1 if chosen else 0)
+        if used + length <= budget:
+            chosen.append(i)
+            used += length
+
+    if not chosen:
+        # no sentence fits whole, cut the best one
+        return truncate(sentences[ranked[0]][0], budget)
+
+    return ' '.join(sentences[i][0] for i in sorted(chosen))
@@ -0,0 +1,85 @@
+class TermMatcher:
+    """ Aho-Corasick automaton over word tokens for the keyword category overrides.
+
+    term_sets is a list of (category_id, terms) in priority order. Terms are
+    phrases of one or more space separated words. A single pass over the
+    words of a text finds every term it contains, whatever the number or
+    length of the terms.
+    """
+
+    def __init__(self, term_sets):
+        self.categories = [category_id for category_id, _ in term_sets]
+        # node 0 is the root, each node maps a word to the next node
+        self.goto = [{}]
+        self.fail = [0]
+        # best (lowest) priority of the terms ending at each node, or None
+        self.out = [None]
+        # all priorities ending at each node, following fail links
+        self.out_all = [frozenset()]
+
+        for priority, (_, terms) in enumerate(term_sets):
+            for term in terms:
+                self.add(term.split(' '), priority)
+
+        self.build()
+
+    def add(self, words, priority):
+        node = 0
+        for word in words:
+            next_node = self.goto[node].get(word)
+            if next_node is None:
+                next_node = len(self.goto)
+                self.goto[node][word] = next_node
+                self.goto.append({})
+                self.fail.append(0)
+                self.out.append(None)
+                self.out_all.append(frozenset())
+            node = next_node
+
+        if self.out[node] is None or priority < self.out[node]:
+            self.out[node] = priority
+        self.out_all[node] = self.out_all[node] | {priority}
+
+    def build(self):
+        # breadth first, so fail links always point to already finished nodes
+        queue = list(self.goto[0].values())
+        for node in queue:
+            for word, child in self.goto[node].items():
+                queue.append(child)
+                fallback = self.fail[node]
+                while fallback and word not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                target = self.goto[fallback].get(word, 0)
+                self.fail[child] = target if target != child else 0
+
+                inherited = self.out[self.fail[child]]
+                if inherited is not None and (self.out[child] is None or inherited < self.out[child]):
+                    self.out[child] = inherited
+                self.out_all[child] = self.out_all[child] | self.out_all[self.fail[child]]
+
+    def step(self, node, word):
+        while node and word not in self.goto[node]:
+            node = self.fail[node]
+        return self.goto[node].get(word, 0)
+
+    def scan(self, words):
+        """ Return the set of category ids with at least one term in words. """
+        found = set()
+        node = 0
+        for word in words:
+            node = self.step(node, word)
+            found |= self.out_all[node]
+        return set(self.categories[p] for p in found)
+
+    def match(self, words):
+        """ Return the highest priority category id with a term in words, or None. """
+        best = None
+        node = 0
+        for word in words:
+            node = self.step(node, word)
+            priority = self.out[node]
+            if priority is not None and (best is None or priority < best):
+                best = priority
+                if best == 0:
+                    break
+        return self.categories[best] if best is not None else None
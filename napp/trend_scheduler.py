@@ -0,0 +1,88 @@
+import threading
+import time
+import nlp_worker
+from pipeline import Pipeline, Stage
+
+# standard search API limit for user authentication
+SEARCH_RATE_LIMIT = 180
+SEARCH_RATE_WINDOW_SEC = 15 * 60
+SEARCH_WORKERS = 8
+
+SEARCH = 'search'
+ANALYSE = 'analyse'
+WRITE = 'write'
+
+
+class TokenBucket:
+    """ Thread safe token bucket holding up to capacity tokens, refilled at rate tokens per second. """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def try_acquire(self):
+        """ Take a token and return 0, or return the seconds until one is available. """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self):
+        """ Block until a token is taken. """
+        while True:
+            wait_sec = self.try_acquire()
+            if not wait_sec:
+                return
+            time.sleep(wait_sec)
+
+
+def analyse_trend(searched):
+    """ Add the named entities of all tweets and the category of each tweet to a searched trend. """
+    trend, tweets = searched
+    texts = [tweet.text for tweet in tweets]
+    keywords = set()
+    for entities in nlp_worker.classifier.get_named_entities_many(texts):
+        keywords.update(entities)
+    return trend, tweets, keywords, nlp_worker.classifier.predict_categories(texts)
+
+
+class TrendScheduler(Pipeline):
+    """ Pipeline processing a batch of twitter trends in three overlapping stages.
+
+    search:  GetSearch requests run concurrently in threads, each one waiting
+             for a token of the shared rate limit bucket.
+    analyse: NER and classification of a trend's tweets run in executor,
+             normally a process pool initialised with nlp_worker.init, or in
+             the current process with the nlp_worker classifier.
+    write:   process_tweets(trend, tweets, keywords, categories) runs on a
+             single thread, the only user of the database and events.
+    """
+
+    def __init__(self, api, fetch_tweets, process_tweets, bucket,
+                 executor=None, search_workers=SEARCH_WORKERS, cpu_workers=1):
+        self.api = api
+        self.fetch_tweets = fetch_tweets
+        self.process_tweets = process_tweets
+        self.bucket = bucket
+        super().__init__([
+            Stage(SEARCH, self.search, workers=search_workers),
+            Stage(ANALYSE, analyse_trend, workers=cpu_workers, executor=executor),
+            Stage(WRITE, self.write),
+        ])
+
+    def search(self, trend):
+        self.bucket.acquire()
+        tweets = self.fetch_tweets(self.api, trend)
+        print(f'Loaded {len(tweets)} tweets for twitter trend: {trend.name}')
+        return (trend, tweets) if tweets else None
+
+    def write(self, analysed):
+        self.process_tweets(*analysed)
+        return analysed[0]
@@ -1,17 +1,31 @@
 import os
 import json
-import traceback
-import sqlite3
 import twitter
 import time
+import functools
+import nlp_worker
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, date, timedelta
 from classifier import Classifier
-from database import NappDatabase
+from classifier_cache import CachedClassifier, SharedCounts
+from database import NappDatabase, connect
 from models import *
+from event_index import EventWorkingSet
+from trend_scheduler import TrendScheduler, TokenBucket, SEARCH_RATE_LIMIT, SEARCH_RATE_WINDOW_SEC
+from twitter_replay import RecordedTwitterApi
+from story_clustering import NewsStories, THRESHOLD
 
 MIN_KEYWORDS_COUNT = 5
 COUNTRY_CODE = 'gb'
 PAUSE_SEC = 60
+CACHE_FILE = 'database/classifier_cache.db'
+FEED_HISTORY_DAYS = 3
+NLP_PROCESSES = int(os.getenv('NLP_PROCESSES', os.cpu_count()))
+SEARCH_RATE_LIMIT = int(os.getenv('TWITTER_SEARCH_RATE_LIMIT', SEARCH_RATE_LIMIT))
+# replay recorded responses from this directory instead of calling twitter
+REPLAY_DIR = os.getenv('TWITTER_REPLAY_DIR')
+# estimated Jaccard similarity of shingles for a trend to join a story
+STORY_SIMILARITY = float(os.getenv('STORY_SIMILARITY', THRESHOLD))
 
 woeid = {
     "gb": 23424975,
@@ -35,8 +49,10 @@ def get_popular_tweets(api, keyword):
 
 def get_keywords(tweets, classifier):
     keywords = set()
-    for tweet in tweets:
-        keywords = keywords.union(classifier.get_named_entities(tweet.text))
+    texts = (tweet.text for tweet in tweets)
+    # one process, a trend has at most 100 tweets and runs in an NLP worker process already
+    for entities in classifier.get_named_entities_many(texts, n_process=1):
+        keywords.update(entities)
     return keywords
 
 
@@ -55,30 +71,45 @@ def tweet_from_api(api_tweet):
     )
 
 
-def match_event(trend, keywords, events):
-    """ Match existing or create new event based on twitter trend. """
+def match_event(trend, keywords, events, stories=None, signature=None):
+    """ Match existing or create new event based on twitter trend.
+
+    With stories, the event is the one of the most similar recent news or
+    trend according to the MinHash signature of the trend's tweets.
+    Otherwise, or if nothing is similar enough, it is the one sharing most,
+    and at least MIN_KEYWORDS_COUNT, keywords, then the one named after the
+    trend.
+    """
 
     event = None
 
-    # search for an exising event with similar keywords
-    max_similarity = 0
-    for existing_event in events:
-        similarity = len(existing_event.keywords.intersection(keywords))
-        if similarity > max_similarity:
-            max_similarity = similarity
-            if max_similarity >= MIN_KEYWORDS_COUNT:
-                event = existing_event
+    if stories is not None:
+        event_id, similarity = stories.match(signature)
+        event = events.get(event_id) if event_id else None
+        if event:
+            print(f'Found exisitng event {event.name} by similarity {similarity:.2f}')
 
-    if event:
-        print(f'Found exisitng event {event.name} by matching {max_similarity} keywords')
+    if event is None:
+        # search for an exising event with similar keywords
+        candidates = events.candidates(keywords)
+        if candidates and candidates[0][1] >= MIN_KEYWORDS_COUNT:
+            event, max_similarity = candidates[0]
+
+        if event:
+            print(f'Found exisitng event {event.name} by matching {max_similarity} keywords')
+
+    if event is None:
+        # a returning trend whose tweets changed
+        event = events.find_name(trend.name)
 
     if event:
         # update event name
-        event.name = event.name + ' ' + trend.name 
+        if trend.name not in event.name:
+            event.name = event.name + ' ' + trend.name
         # and keywords if new keywords are found
         new_keywords = keywords.union(event.keywords)
         if len(new_keywords) > len(event.keywords):
-            event.keywords = new_keywords
+            event.keywords = intern_keywords(new_keywords)
     else:
         # create event from this trend if no existing events matches
         event = Event(name=trend.name, keywords=keywords)
@@ -87,59 +118,74 @@ def match_event(trend, keywords, events):
     return event
 
 
-def process_trend(db, api, classifier, trend):
-    try: 
-        # load recent events from database (added in the last 3 days)
-        start_date = date.today() - timedelta(days=3)
-        events = list(db.find_events_since(start_date))
-        print(f'Loaded {len(events)} existing recent events')
-
-        # load popular tweets of the trend
-        tweets = [tweet_from_api(t) for t in get_popular_tweets(api, trend.query)]
-        print(f'Loaded {len(tweets)} tweets')
-        if not tweets:
-            return
-
-        # form trend keywords
-        keywords = get_keywords(tweets, classifier)
-        print(f'Formed {len(keywords)} keywords')
-        if len(keywords) < MIN_KEYWORDS_COUNT:
-            return
-
-        event = match_event(trend, keywords, events)
-        assert event
-        event = db.save_event(event)
-        assert event.id
-        print(f'Saved event id: {event.id} name: {event.name} , keywords: {event.keywords}')
-
-        for tweet in tweets:
-            tweet.event_id = event.id
-            tweet.category_id = classifier.predict_category(tweet.text)
-            db.save_tweet(tweet)
-            #print(f'{trend.name} tweet saved: {tweet.text}')
-        
-        if not any(ev for ev in events if ev.id == event.id):
-            events.append(event)
-
-    except Exception as e:
-        print(f'Error processing twitter trend {trend.name}: {e}')
-        traceback.print_exc()
+def fetch_tweets(api, trend):
+    return [tweet_from_api(t) for t in get_popular_tweets(api, trend.query)]
+
+
+def save_trend(db, trend, tweets, keywords, categories, events, stories=None):
+    """ Match the trend to an event and save it with its classified tweets. """
+    print(f'Formed {len(keywords)} keywords for twitter trend: {trend.name}')
+    if len(keywords) < MIN_KEYWORDS_COUNT:
+        return
+
+    signature = None
+    if stories is not None:
+        signature = stories.signature(' '.join(tweet.text for tweet in tweets))
+
+    event = match_event(trend, keywords, events, stories, signature)
+    assert event
+    event = db.save_event(event)
+    assert event.id
+    print(f'Saved event id: {event.id} name: {event.name} , keywords: {event.keywords}')
+    if stories is not None:
+        stories.add('trend:' + trend.name, event.id, signature)
+
+    for tweet, category_id in zip(tweets, categories):
+        tweet.event_id = event.id
+        tweet.category_id = category_id
+    db.save_tweets_many(tweets)
+    print(f'Saved {len(tweets)} tweets')
+
+
+def load_classifier(shared_counts=None):
+    # called once in every NLP worker process
+    return CachedClassifier(Classifier(), filename=CACHE_FILE, shared_counts=shared_counts)
 
 
 def main():
-    conn = sqlite3.connect('database/napp.db', 
-            detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES)
+    # only the writer stage of the scheduler uses the connection while trends are processed
+    conn = connect('database/napp.db', check_same_thread=False)
 
     db = NappDatabase(conn)
 
-    # load NLP classifier
-    classifier = Classifier()
+    # recent events (added in the last 3 days), saved events are applied as they are written
+    events = EventWorkingSet(db, days=3)
+    # recent news and trends clustered into events by similarity
+    stories = NewsStories(db, days=3, threshold=STORY_SIMILARITY)
 
     # connect to twitter API
-    api = twitter.Api(consumer_key=os.environ['TWITTER_CONSUMER_KEY'],
-                      consumer_secret=os.environ['TWITTER_CONSUMER_SECRET'],
-                      access_token_key=os.environ['TWITTER_ACCESS_TOKEN'],
-                      access_token_secret=os.environ['TWITTER_ACCESS_TOKEN_SECRET'])
+    if REPLAY_DIR:
+        api = RecordedTwitterApi(REPLAY_DIR)
+    else:
+        api = twitter.Api(consumer_key=os.environ['TWITTER_CONSUMER_KEY'],
+                          consumer_secret=os.environ['TWITTER_CONSUMER_SECRET'],
+                          access_token_key=os.environ['TWITTER_ACCESS_TOKEN'],
+                          access_token_secret=os.environ['TWITTER_ACCESS_TOKEN_SECRET'])
+
+    # NLP runs in worker processes, each loading its own classifier and adding up cache hits in shared memory
+    classifier_counts = SharedCounts()
+    nlp_pool = ProcessPoolExecutor(max_workers=NLP_PROCESSES, initializer=nlp_worker.init,
+                                   initargs=(functools.partial(load_classifier, classifier_counts),))
+
+    # searches share the rate limit budget
+    scheduler = TrendScheduler(
+        api,
+        fetch_tweets=fetch_tweets,
+        process_tweets=lambda trend, tweets, keywords, categories:
+            save_trend(db, trend, tweets, keywords, categories, events, stories),
+        bucket=TokenBucket(rate=SEARCH_RATE_LIMIT / SEARCH_RATE_WINDOW_SEC, capacity=SEARCH_RATE_LIMIT),
+        executor=nlp_pool,
+        cpu_workers=NLP_PROCESSES)
 
     while True:
         # query regional trends from twitter
@@ -149,14 +195,25 @@ def main():
         #     l = [json.loads(i.AsJsonString()) for i in trends]
         #     json.dump(l, f, indent=2)
 
-        for trend in trends:
-            print(f'Processing twitter trend: {trend.name}')
-            process_trend(db, api, classifier, trend)
+        # pick up events changed by other loaders
+        changed = events.refresh()
+        print(f'Refreshed {changed} events, {len(events)} recent events in memory')
+        added = stories.refresh()
+        print(f'Added {added} news to stories, {len(stories)} recent news and trends in memory')
+
+        print(f'Processing {len(trends)} twitter trends')
+        scheduler.run(trends)
+        scheduler.print_metrics()
+        print(f'{datetime.now()} {classifier_counts}')
+
+        # live feed clients can resume from up to FEED_HISTORY_DAYS ago
+        db.prune_feed_changes(date.today() - timedelta(days=FEED_HISTORY_DAYS))
 
         # wait some time then repeat
         print(f'Pausing...')
         time.sleep(PAUSE_SEC) 
 
+    nlp_pool.shutdown()
     if conn:
         conn.close()
 
@@ -0,0 +1,35 @@
+import json
+import os
+import time
+import twitter
+from urllib.parse import parse_qs, unquote_plus
+
+
+class RecordedTwitterApi:
+    """ Offline stand-in for twitter.Api answering from recorded JSON files.
+
+    directory holds twitter_trends.json, the recorded GetTrendsWoeid result,
+    and twitter_trend_{i}.json, the GetSearch result for the i-th trend.
+    delay_sec simulates the latency of a real request.
+    """
+
+    def __init__(self, directory, delay_sec=0):
+        self.directory = directory
+        self.delay_sec = delay_sec
+        with open(os.path.join(directory, 'twitter_trends.json')) as f:
+            self.trends = json.load(f)
+        self.trend_index = {unquote_plus(trend['query']): i for i, trend in enumerate(self.trends)}
+
+    def GetTrendsWoeid(self, woeid):
+        return [twitter.Trend.NewFromJsonDict(trend) for trend in self.trends]
+
+    def GetSearch(self, raw_query):
+        time.sleep(self.delay_sec)
+        # trend queries are url encoded, compare them decoded
+        i = self.trend_index.get(parse_qs(raw_query)['q'][0])
+
+        filename = os.path.join(self.directory, f'twitter_trend_{i}.json')
+        if i is None or not os.path.exists(filename):
+            return []
+        with open(filename) as f:
+            return [twitter.Status.NewFromJsonDict(status) for status in json.load(f)]
@@ -1,5 +1,41 @@
+from datetime import date, datetime, timedelta
+import sqlite3
+import pickle
+import pytest
+import json
+import numpy
+import dataclasses
+import classifier
+import classifier_cache
+import database
+import db_pool
+import response_cache
+import live_feed
+import asyncio
+import threading
+import types
+import functools
+from concurrent.futures import ProcessPoolExecutor
+import time
+import os
+from database import NappDatabase, connect
 import models
 import news_loader
+from eventregistry_source import EventRegistrySource
+import twitter_loader
+from trend_scheduler import TrendScheduler, TokenBucket
+from pipeline import Pipeline, Stage
+import nlp_worker
+import dedup
+import story_clustering
+import summariser
+import online_training
+import model_export
+import hashing_model
+import json_stream
+from twitter_replay import RecordedTwitterApi
+import term_matcher
+from event_index import EventIndex, EventWorkingSet
 
 class MockClassifier:
     def __init__(self, named_entitiles=None):
@@ -12,8 +48,848 @@ class MockClassifier:
 def test_match_event_for_news():
     news = models.News(headline="Donald Trump")
     classifier = MockClassifier(named_entitiles=['Donald', 'Trump'])
-    events = [models.Event(id=1, keywords={'Trump'})]
+    events = EventIndex([models.Event(id=1, keywords={'Trump'})])
 
     event = news_loader.match_event(news, events, classifier)
-    assert event == events[0]
+    assert event == events.get(1)
 
+
+
+def baseline_predict_category(c, text):
+    """ predict_category before predict_categories: a cleaned text on its own, then the keyword overrides. """
+    y = c.model.predict(c.vectoriser.transform([classifier.clean_text(text)]))
+    if c.match(text, c.env_terms):
+        return 4
+    if c.match(text, c.lgbt_terms):
+        return 5
+    if c.match(text, c.youth_terms):
+        return 6
+    return int(y[0])
+
+
+def test_predict_categories_same_as_baseline_predict_category(monkeypatch):
+    monkeypatch.chdir(os.path.join(os.path.dirname(__file__), '..'))
+    c = classifier.Classifier(engine='pickle')
+    headlines = [article['title'] for article in news_articles()] + [
+        'Climate change protest blocks London bridges', 'Global  warming: the facts', 'Gay pride in London',
+        'Teens on climate', 'Gay teens march over climate change', "Teens' pride parade", 'Budget day - BBC News']
+
+    expected = [baseline_predict_category(c, text) for text in headlines]
+    assert c.predict_categories(iter(headlines)) == expected
+    assert expected[-7:] == [4, 4, 5, 6, 4, 5, expected[-1]] and expected[-1] not in (4, 5, 6)
+
+
+def test_term_matcher_priority_and_phrases():
+    matcher = term_matcher.TermMatcher([(4, {'climate change', 'global warming'}), (5, {'gay'}), (6, {'climate'})])
+
+    assert matcher.match('the climate is changing'.split(' ')) == 6
+    assert matcher.match('gay teens on climate change'.split(' ')) == 4
+    assert matcher.match('global climate change'.split(' ')) == 4
+    assert matcher.scan('gay teens on climate change'.split(' ')) == {4, 5, 6}
+    assert matcher.match('nothing to see'.split(' ')) is None
+
+
+class CountingClassifier:
+    version = '1'
+
+    def __init__(self):
+        self.calls = 0
+
+    def refresh_model(self):
+        return False
+
+    def predict_categories(self, texts):
+        self.calls += 1
+        return [len(text) % 4 for text in texts]
+
+
+def test_cached_classifier_hits_and_persists(tmp_path):
+    filename = str(tmp_path / 'cache.db')
+    cached = classifier_cache.CachedClassifier(CountingClassifier(), max_items=1, filename=filename)
+
+    assert cached.predict_categories(['a b', 'abc']) == [3, 3]
+    assert cached.predict_categories(['a  b ', 'abc', 'abcd']) == [3, 3, 0]
+    assert (cached.hits, cached.misses, cached.classifier.calls) == (2, 3, 2)
+
+    warm = classifier_cache.CachedClassifier(CountingClassifier(), filename=filename)
+    assert warm.predict_category('abcd') == 0
+    assert warm.classifier.calls == 0
+
+    # a new model version drops the rows of the old one, and only the newest max_rows are kept
+    retrained = CountingClassifier()
+    retrained.version = '2'
+    pruned = classifier_cache.CachedClassifier(retrained, filename=filename, max_rows=2)
+    pruned.predict_categories(['x', 'yy', 'zzz'])
+    rows = pruned.conn.execute("SELECT Version, Value FROM ClassifierCache ORDER BY rowid").fetchall()
+    assert rows == [('2', '2'), ('2', '3')]
+
+
+def cached_counting_classifier(shared_counts):
+    return classifier_cache.CachedClassifier(CountingClassifier(), shared_counts=shared_counts)
+
+
+def predict_in_worker(texts):
+    return nlp_worker.classifier.predict_categories(texts)
+
+
+def test_shared_counts_add_up_cache_hits_of_worker_processes():
+    counts = classifier_cache.SharedCounts()
+    with ProcessPoolExecutor(max_workers=2, initializer=nlp_worker.init,
+                             initargs=(functools.partial(cached_counting_classifier, counts),)) as pool:
+        assert list(pool.map(predict_in_worker, [['a', 'bb'], ['a', 'bb'], ['ccc']])) == [[1, 2], [1, 2], [3]]
+    # each worker has its own cache, so only the total is known
+    assert counts.hits + counts.misses == 5 and counts.misses >= 3
+    assert str(counts).startswith('CachedClassifier hits:')
+
+
+def test_event_index_ranks_updates_and_expires():
+    old = models.Event(id=1, keywords={'uk', 'brexit'}, created_at=datetime(2020, 1, 1))
+    new = models.Event(id=2, keywords={'uk', 'flood', 'york'}, created_at=datetime(2020, 1, 5))
+    index = EventIndex([old, new])
+
+    assert [(e.id, n) for e, n in index.candidates({'uk', 'york'})] == [(2, 2), (1, 1)]
+
+    old.keywords = {'brexit', 'eu'}
+    index.add(old)
+    assert [(e.id, n) for e, n in index.candidates({'uk', 'eu'})] == [(1, 1), (2, 1)]
+    assert [e.id for e, n in index.candidates({'uk'})] == [2]
+
+    index.expire(date(2020, 1, 3))
+    assert len(index) == 1 and 1 not in index
+    assert index.candidates({'eu'}) == []
+
+
+def test_event_working_set_applies_own_and_other_writes(tmp_path):
+    filename = str(tmp_path / 'napp.db')
+    db = NappDatabase(connect(filename))
+    other_db = NappDatabase(connect(filename))
+
+    first = other_db.save_event(models.Event(name='Flood', keywords={'york', 'flood'}))
+    events = EventWorkingSet(db)
+    assert events.refresh() == 1
+
+    own = db.save_event(models.Event(name='Brexit', keywords={'eu', 'uk'}))
+    assert [e.id for e, n in events.candidates({'uk'})] == [own.id]
+
+    first.keywords.add('uk')
+    other_db.save_event(first)
+    events.refresh()
+    assert [e.id for e, n in events.candidates({'uk'})] == [first.id, own.id]
+
+
+def test_save_many_sets_ids_in_one_transaction(tmp_path):
+    db = NappDatabase(connect(str(tmp_path / 'napp.db')))
+    db.save_news(models.News(headline='Old', country_code='gb', url='https://example.com/old'))
+
+    saved = db.save_news_many([models.News(headline=h, country_code='gb', url=f'https://example.com/{h}')
+                               for h in ['A', 'B', 'Old']])
+    assert [db.find_news_by_id(news.id).headline for news in saved] == ['A', 'B', 'Old']
+    # the replaced news' keys go with it
+    assert not db.news_key_exists(dedup.news_keys('https://example.com/old', None))
+    assert db.news_key_exists(dedup.news_keys('https://example.com/Old', None))
+    assert sorted(news_id for (news_id,) in db.conn.execute("SELECT NewsID FROM NewsKey")) == \
+        sorted(news.id for news in saved for _ in range(2))
+
+    events = db.save_events_many([models.Event(name='X', keywords={'x'}), models.Event(name='Y')])
+    events[0].name = 'X2'
+    db.save_events_many(events + [models.Event(name='Z')])
+    assert sorted((e.id, e.name) for e in db.find_events()) == [(events[0].id, 'X2'), (events[1].id, 'Y'), (events[1].id + 1, 'Z')]
+
+
+def test_database_upgrades_in_place(tmp_path):
+    conn = connect(str(tmp_path / 'napp.db'))
+    conn.execute("CREATE TABLE Event(EventID INTEGER PRIMARY KEY AUTOINCREMENT, Name TEXT NOT NULL UNIQUE, "
+                 "Summary TEXT, Keywords TEXT, CreatedAt TIMESTAMP DEFAULT CURRENT_TIMESTAMP)")
+    conn.execute("INSERT INTO Event(Name, Keywords) VALUES ('Old', 'a,b')")
+    conn.commit()
+
+    db = NappDatabase(conn)
+    event = next(db.find_events())
+    assert event.keywords == {'a', 'b'} and event.updated_at == event.created_at
+    assert db.save_event(models.Event(name='New')).id == event.id + 1
+    assert conn.execute("PRAGMA user_version").fetchone()[0] == len(database.MIGRATIONS)
+    assert conn.execute("PRAGMA journal_mode").fetchone()[0] == 'wal'
+    indexes = {row[1] for row in conn.execute("SELECT * FROM sqlite_master WHERE type='index'")}
+    assert {'NewsCreatedAt', 'EventUpdatedAt', 'TweetEventID'} <= indexes
+
+
+def test_loaders_starting_together_migrate_once(tmp_path, monkeypatch):
+    filename = str(tmp_path / 'napp.db')
+    NappDatabase(connect(filename))
+
+    def add_column_slowly(db):
+        # fails if applied twice
+        time.sleep(0.2)
+        db.conn.execute("ALTER TABLE News ADD COLUMN Extra TEXT")
+
+    monkeypatch.setattr(database, 'MIGRATIONS', database.MIGRATIONS + [add_column_slowly])
+    barrier = threading.Barrier(4)
+    errors = []
+
+    def start():
+        conn = connect(filename)
+        barrier.wait()
+        try:
+            NappDatabase(conn)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=start) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert connect(filename).execute("PRAGMA user_version").fetchone()[0] == len(database.MIGRATIONS)
+
+
+def test_find_events_by_keywords_ranks_in_sql(tmp_path):
+    db = NappDatabase(connect(str(tmp_path / 'napp.db')))
+    a, b, c = db.save_events_many([
+        models.Event(name='A', keywords={'uk', 'flood'}),
+        models.Event(name='B', keywords={'uk', 'flood', 'york'}),
+        models.Event(name='C', keywords={'brexit'}),
+    ])
+    b.keywords = {'york'}
+    db.save_event(b)
+
+    found = [(event.name, overlap) for event, overlap in db.find_events_by_keywords({'uk', 'flood', 'york'})]
+    assert found == [('A', 2), ('B', 1)]
+    assert next(db.find_events_since('2000-01-01')).keywords == {'uk', 'flood'}
+
+
+def test_keyset_pagination_walks_all_rows(tmp_path):
+    db = NappDatabase(connect(str(tmp_path / 'napp.db')))
+    db.save_news_many([models.News(headline=str(i), country_code='gb') for i in range(7)])
+
+    seen, cursor = [], None
+    while True:
+        items = list(db.find_news(3, cursor))
+        seen.extend(news.id for news in items)
+        cursor = database.next_cursor(items, 3, 'created_at')
+        if not cursor:
+            break
+    assert seen == sorted(seen, reverse=True) and len(set(seen)) == 7
+
+    first = list(db.find_news_since('2000-01-01', 4))
+    rest = list(db.find_news_since('2000-01-01', 4, database.next_cursor(first, 4, 'created_at')))
+    assert [news.id for news in first + rest] == sorted(seen)
+
+
+def test_read_pool_gives_each_thread_a_read_only_connection(tmp_path):
+    filename = str(tmp_path / 'napp.db')
+    pool = db_pool.ReadPool(filename)
+    NappDatabase(connect(filename)).save_news(models.News(headline='A', country_code='gb'))
+
+    found = []
+    thread = threading.Thread(target=lambda: found.append(pool.database()))
+    thread.start()
+    thread.join()
+
+    assert found[0] is not pool.database()
+    assert pool.database() is pool.database()
+    assert [news.headline for news in pool.database().find_news()] == ['A']
+    with pytest.raises(sqlite3.OperationalError):
+        pool.database().save_news(models.News(headline='B', country_code='gb'))
+    pool.close()
+
+
+def test_response_cache_invalidated_by_data_version(tmp_path):
+    db = NappDatabase(connect(str(tmp_path / 'napp.db')))
+    cache = response_cache.ResponseCache()
+    cache.set_version(db.find_data_version())
+
+    entry = cache.put(('/news', ()), b'[]', {}, cache.version)
+    assert cache.get(('/news', ())) is entry
+
+    # a write while a response is built, read by another request
+    version = cache.version
+    db.save_news(models.News(headline='A', country_code='gb'))
+    cache.set_version(db.find_data_version())
+    assert cache.get(('/news', ())) is None
+    assert cache.put(('/news', ()), b'[]', {}, version).etag == entry.etag
+    assert cache.get(('/news', ())) is None
+    assert cache.put(('/news', ()), b'[]', {}, cache.version).etag != entry.etag
+
+
+def as_json_value(item):
+    data = dataclasses.asdict(item)
+    for key, value in data.items():
+        if isinstance(value, datetime):
+            data[key] = value.isoformat()
+        elif isinstance(value, set):
+            data[key] = sorted(value)
+    return data
+
+
+def test_json_queries_match_model_queries(tmp_path):
+    db = NappDatabase(connect(str(tmp_path / 'napp.db')))
+    event = db.save_event(models.Event(name='Flood', keywords={'york', 'flood'}))
+    db.save_news(models.News(headline='A "quoted" one', source='BBC', country_code='gb', event_id=event.id,
+                             published_at=datetime(2020, 2, 1, 10, 30)))
+    db.save_tweets_many([models.Tweet(id=5, text='t', hashtags='', user='u', published_at=datetime(2020, 2, 1))])
+
+    for find, find_json in [(db.find_news, db.find_news_json), (db.find_events, db.find_events_json),
+                            (db.find_tweets, db.find_tweets_json)]:
+        rows = list(find_json(10))
+        assert json.loads(database.json_array(rows)) == [as_json_value(item) for item in find(10)]
+
+    assert json.loads(db.find_news_json_by_id(1))['headline'] == 'A "quoted" one'
+
+
+def test_feed_broker_fans_out_one_read_and_replays(tmp_path):
+    db = NappDatabase(connect(str(tmp_path / 'napp.db')))
+    reads = []
+
+    async def query(find):
+        reads.append(find)
+        return find(db)
+
+    async def scenario():
+        broker = live_feed.FeedBroker(query)
+        await broker.start()
+        first = db.save_news(models.News(headline='A', country_code='gb'))
+        await broker.poll()
+        subscriptions = [broker.subscribe() for _ in range(3)]
+
+        db.save_events_many([models.Event(name='E', keywords={'e'})])
+        reads.clear()
+        await broker.poll()
+        assert len(reads) == 1
+        for subscription in subscriptions:
+            assert subscription.queue.get_nowait().startswith('id: 2\nevent: event\n')
+
+        replayed = [message async for message in broker.replay(0, subscriptions[0])]
+        assert len(replayed) == 1 and json.loads(replayed[0].split('data: ')[1])['id'] == first.id
+        await broker.stop()
+
+    asyncio.run(scenario())
+
+
+class FakeSource:
+    def __init__(self, name, news, delay_sec=0, failures=0):
+        self.name = name
+        self.news = news
+        self.delay_sec = delay_sec
+        self.failures = failures
+
+    def __str__(self):
+        return self.name
+
+    def load_news_from_file(self):
+        time.sleep(self.delay_sec)
+        if self.failures:
+            self.failures -= 1
+            raise IOError('connection reset')
+        return self.news
+
+
+def test_load_news_fetches_sources_concurrently():
+    recorded = EventRegistrySource(
+        api_key=None,
+        record_response_file=os.path.join(os.path.dirname(__file__), 'data', 'event_registry_org3.json'))
+    replayed = list(recorded.load_news_from_file())
+    duplicate = models.News(headline='Duplicate', url=replayed[0].url)
+
+    sources = [
+        recorded,
+        FakeSource('slow1', [models.News(headline='Slow 1', url='u1')], delay_sec=0.3),
+        FakeSource('slow2', [duplicate], delay_sec=0.3),
+        FakeSource('flaky', [models.News(headline='Flaky', url='u2')], failures=1),
+        FakeSource('hung', [models.News(headline='Hung', url='u3')], delay_sec=2),
+    ]
+
+    started = time.monotonic()
+    news_list = list(news_loader.load_news(
+        sources, lambda source: source.load_news_from_file(), timeout_sec=0.5, retries=1, backoff_sec=0.01))
+    elapsed = time.monotonic() - started
+
+    by_url = {news.url: news for news in news_list}
+    # slow sources overlap, the hung one is abandoned after each timeout
+    assert elapsed < 1.5
+    assert len(by_url) == len({news.url for news in replayed}) + 2
+    assert by_url['u1'].headline == 'Slow 1' and by_url['u2'].headline == 'Flaky'
+    assert 'u3' not in by_url
+    # news of every source are kept in source order, the pipeline drops duplicate urls
+    assert [news.headline for news in news_list if news.url == replayed[0].url] == [replayed[0].headline, 'Duplicate']
+
+
+class WordClassifier:
+    """ Capitalised words are the named entities, every text is category 1, summaries are upper case. """
+
+    def get_named_entities_many(self, texts, **kwargs):
+        for text in texts:
+            yield set(word for word in text.split() if word[:1].isupper())
+
+    def predict_categories(self, texts):
+        return [1 for _ in texts]
+
+    def make_summaries(self, texts, budget):
+        return [text.upper()[:budget] for text in texts]
+
+
+def test_load_news_retries_the_first_read_of_lazy_sources():
+    attempts = []
+
+    def read(source):
+        # a generator, nothing is read until the first item is asked for
+        attempts.append(source)
+        if len(attempts) == 1:
+            raise IOError('connection reset')
+        yield models.News(headline=source + ' 1', url=source + '1')
+        if source == 'truncated':
+            raise ValueError('unexpected end of file')
+        yield models.News(headline=source + ' 2', url=source + '2')
+
+    news_list = list(news_loader.load_news(['lazy', 'truncated'], read, backoff_sec=0.01))
+    assert [news.url for news in news_list] == ['lazy1', 'lazy2', 'truncated1']
+    # the first read of one source failed and was retried, the later error of the other was not
+    assert len(attempts) == 3
+
+
+def test_token_bucket_limits_rate():
+    bucket = TokenBucket(rate=20, capacity=2)
+    started = time.monotonic()
+    for _ in range(4):
+        bucket.acquire()
+    # two tokens at once, then one every 50ms
+    assert 0.08 < time.monotonic() - started < 0.5
+
+
+def test_trend_scheduler_overlaps_searches_against_recorded_api(tmp_path):
+    db = NappDatabase(connect(str(tmp_path / 'napp.db'), check_same_thread=False))
+    events = EventWorkingSet(db)
+    api = RecordedTwitterApi(os.path.join(os.path.dirname(__file__), 'data', 'twitter'), delay_sec=0.05)
+    trends = api.GetTrendsWoeid(twitter_loader.woeid['gb'])
+    classifier = WordClassifier()
+    nlp_worker.init(WordClassifier)
+
+    scheduler = TrendScheduler(
+        api,
+        fetch_tweets=twitter_loader.fetch_tweets,
+        process_tweets=lambda trend, tweets, keywords, categories:
+            twitter_loader.save_trend(db, trend, tweets, keywords, categories, events),
+        bucket=TokenBucket(rate=1000, capacity=100),
+        search_workers=8)
+    started = time.monotonic()
+    scheduler.run(trends)
+    elapsed = time.monotonic() - started
+    metrics = scheduler.metrics()
+
+    # the same trends processed one at a time
+    expected = set()
+    for trend in trends:
+        tweets = twitter_loader.fetch_tweets(api, trend)
+        if len(twitter_loader.get_keywords(tweets, classifier)) >= twitter_loader.MIN_KEYWORDS_COUNT:
+            expected.update(tweet.id for tweet in tweets)
+
+    assert elapsed < len(trends) * api.delay_sec / 2
+    assert metrics['search'].items_in == len(trends)
+    assert metrics['write'].items_in == metrics['analyse'].items_out == metrics['search'].items_out
+    assert expected and set(tweet.id for tweet in db.find_tweets(limit=None)) == expected
+
+
+def test_pipeline_throughput_is_bounded_by_slowest_stage():
+    def slow(seconds, function=lambda item: item):
+        def call(item):
+            time.sleep(seconds)
+            return function(item)
+        return call
+
+    pipeline = Pipeline([
+        Stage('split', lambda item: [item, item + 100], many=True),
+        Stage('io', slow(0.02), workers=4, queue_size=2),
+        Stage('odd', slow(0.01, lambda item: item if item % 2 else None)),
+        Stage('fail', lambda batch: [item // (item != 7) for item in batch], batch_size=5),
+    ])
+
+    started = time.monotonic()
+    results = pipeline.run(range(20))
+    elapsed = time.monotonic() - started
+
+    metrics = pipeline.metrics()
+    # sequentially 40 * 0.02 + 40 * 0.01 seconds
+    assert elapsed < 0.9
+    assert metrics['split'].items_out == metrics['io'].items_in == 40
+    assert metrics['odd'].items_out == 20
+    assert metrics['io'].max_queue_depth <= 2
+    # only the failing item of its batch is dropped
+    assert metrics['fail'].errors == 1
+    assert sorted(results) == [item for item in list(range(20)) + list(range(100, 120)) if item % 2 and item != 7]
+
+
+def test_pipeline_ends_its_threads_when_reading_items_fails():
+    def items():
+        yield 1
+        yield 2
+        raise OSError('source closed')
+
+    pipeline = Pipeline([Stage('double', lambda item: item * 2, workers=3), Stage('batch', list, batch_size=2)])
+    with pytest.raises(OSError):
+        pipeline.run(items())
+    assert pipeline.metrics()['batch'].items_out == 2
+    assert not [thread for thread in threading.enumerate() if thread.name.startswith(('double-', 'batch-'))]
+
+
+def test_news_pipeline_saves_new_news_once(tmp_path):
+    filename = str(tmp_path / 'napp.db')
+    db = NappDatabase(connect(filename, check_same_thread=False))
+    reader = NappDatabase(connect(filename, read_only=True), create=False)
+    events = EventWorkingSet(db)
+    nlp_worker.init(WordClassifier)
+
+    db.save_news(models.News(headline='Saved before - BBC', url='u0'))
+    deduplicator = dedup.NewsDeduplicator(reader)
+    deduplicator.seed()
+    sources = [
+        FakeSource('a', [models.News(headline='Saved before - BBC', url='u0'),
+                         models.News(headline='Flood warning in York - BBC', url='u1', text='rivers rise')]),
+        FakeSource('b', [models.News(headline='Flood warning in York - Sky', url='u1'),
+                         models.News(headline='Storm Dennis hits Wales - ITV', url='u2')], delay_sec=0.1),
+    ]
+
+    events.refresh()
+    pipeline = news_loader.news_pipeline(db, deduplicator, events, lambda source: source.load_news_from_file())
+    saved = pipeline.run(sources)
+
+    assert sorted(news.url for news in saved) == ['u1', 'u2']
+    assert all(news.id and news.category_id == 1 and news.event_id for news in saved)
+    assert [news.summary for news in saved if news.url == 'u1'] == ['RIVERS RISE']
+    assert pipeline.metrics()['dedupe'].items_out == 2
+    assert len(list(db.find_news(limit=None))) == 3
+    assert deduplicator.database_checks == 0
+    assert deduplicator.is_duplicate(models.News(headline='Storm Dennis hits Wales - BBC News', url='u3'))
+
+
+def test_news_pipeline_error_drops_only_its_news(tmp_path, monkeypatch):
+    db = NappDatabase(connect(str(tmp_path / 'napp.db'), check_same_thread=False))
+    events = EventWorkingSet(db)
+    stories = story_clustering.NewsStories(db)
+    stories.refresh()
+    nlp_worker.init(WordClassifier)
+    match_event = news_loader.match_event
+
+    def failing_match_event(news, *args):
+        if news.url == 'u2':
+            raise ValueError('no event')
+        return match_event(news, *args)
+
+    def failing_make_summaries(texts, budget):
+        if 'unreadable' in texts:
+            raise ValueError('no sentences')
+        return WordClassifier.make_summaries(nlp_worker.classifier, texts, budget)
+
+    monkeypatch.setattr(news_loader, 'match_event', failing_match_event)
+    monkeypatch.setattr(nlp_worker.classifier, 'make_summaries', failing_make_summaries)
+    sources = [FakeSource('a', [models.News(headline='Flood warning in York - BBC', url='u1', text='rivers rise'),
+                                models.News(headline='Storm Dennis hits Wales - ITV', url='u2'),
+                                models.News(headline='Budget day in London - Sky', url='u3'),
+                                models.News(headline='Garbled page - Sky', url='u4', text='unreadable')])]
+    pipeline = news_loader.news_pipeline(
+        db, dedup.NewsDeduplicator(db), events, lambda source: source.load_news_from_file(), stories=stories)
+    saved = pipeline.run(sources)
+
+    # the other news of a failing NLP batch are processed one at a time
+    assert sorted(news.url for news in saved) == ['u1', 'u3']
+    assert pipeline.metrics()['summarise'].errors == 1
+    assert pipeline.metrics()['persist'].errors == 0
+    assert 'u1' in stories and 'u2' not in stories
+    assert len(list(db.find_events())) == 2
+
+
+def test_news_pipeline_saves_the_events_of_a_batch_together(tmp_path, monkeypatch):
+    db = NappDatabase(connect(str(tmp_path / 'napp.db'), check_same_thread=False))
+    db.save_event(models.Event(name='Storm Dennis', keywords={'storm', 'dennis'}))
+    events = EventWorkingSet(db)
+    events.refresh()
+    calls = []
+    save_events_many = db.save_events_many
+    monkeypatch.setattr(db, 'save_events_many', lambda batch: calls.append(len(batch)) or save_events_many(batch))
+
+    pipeline = news_loader.news_pipeline(db, dedup.NewsDeduplicator(db), events, None)
+    persist = {stage.name: stage for stage in pipeline.stages}['persist'].function
+    news_list = [models.News(headline='Flood warning in York - BBC', url='u1', category_id=1),
+                 models.News(headline='York flood defences fail - ITV', url='u2', category_id=1),
+                 models.News(headline='Storm Dennis hits Wales - Sky', url='u3', category_id=2)]
+    keywords = [{'flood', 'york'}, {'york', 'flood'}, {'storm', 'wales'}]
+    saved = persist([(news, news_keywords, None) for news, news_keywords in zip(news_list, keywords)])
+
+    # the second news joins the event the first one created, before either is saved
+    by_url = {news.url: news for news in saved}
+    assert by_url['u1'].event_id == by_url['u2'].event_id != by_url['u3'].event_id
+    assert calls == [2]
+    assert {event.name: event.keywords for event in db.find_events()}['Storm Dennis wales'] == {'storm', 'dennis', 'wales'}
+
+
+def test_pipeline_streams_generator_items_with_bounded_queues():
+    produced = []
+    in_flight = []
+
+    def generate(n):
+        for i in range(n):
+            produced.append(i)
+            yield i
+
+    def consume(i):
+        # items made by the generator but not consumed yet
+        in_flight.append(len(produced) - i)
+        return i
+
+    pipeline = Pipeline([Stage('generate', generate, many=True), Stage('consume', consume, queue_size=5)])
+    assert pipeline.run([1000], collect=False) == 1000
+    assert max(in_flight) <= 8
+    assert pipeline.metrics()['generate'].items_out == 1000
+
+
+def test_json_stream_reads_arrays_in_chunks(tmp_path):
+    items = [{'title': 'a' * 100, 'n': 1}, 12345678, -1.5e3, 'text, with ] and }', None, True, [1, [2]]]
+    filename = tmp_path / 'items.json'
+    filename.write_text(json.dumps({'page': 1, 'skip': {'results': [0]}, 'articles': {'results': items}}))
+
+    for chunk_size in [1, 3, 7, 1000]:
+        with open(filename) as f:
+            assert list(json_stream.iter_array(f, ('articles', 'results'), chunk_size)) == items
+
+    filename.write_text(' [ ] ')
+    with open(filename) as f:
+        assert list(json_stream.iter_array(f)) == []
+
+    recorded = os.path.join(os.path.dirname(__file__), 'data', 'event_registry_org3.json')
+    with open(recorded) as f:
+        expected = json.load(f)
+    with open(recorded) as f:
+        assert list(json_stream.iter_array(f)) == expected
+
+
+def test_bloom_filter_has_no_false_negatives():
+    bloom = dedup.BloomFilter(capacity=1000, error_rate=0.01)
+    for i in range(1000):
+        bloom.add(f'key {i}')
+
+    assert all(f'key {i}' in bloom for i in range(1000))
+    false_positives = sum(f'other {i}' in bloom for i in range(10000))
+    assert false_positives < 300
+
+
+def test_news_deduplicator_normalises_and_confirms_old_news(tmp_path):
+    db = NappDatabase(connect(str(tmp_path / 'napp.db')))
+    db.save_news(models.News(headline='Old story - BBC', url='https://www.bbc.co.uk/news/1/'))
+    db.save_news(models.News(headline='New story: flood - BBC', url='https://bbc.co.uk/news/2?utm_source=x'))
+    with db.conn:
+        db.conn.execute("UPDATE News SET CreatedAt = '2020-02-16 10:00:00' WHERE Headline = 'Old story - BBC'")
+
+    deduplicator = dedup.NewsDeduplicator(db)
+    assert deduplicator.seed() == 2
+
+    # recent news match on normalised keys without a query
+    assert deduplicator.is_duplicate(models.News(headline='New story flood - Sky News', url='u1'))
+    assert deduplicator.is_duplicate(models.News(headline='Other', url='http://bbc.co.uk/news/2'))
+    assert deduplicator.database_checks == 0
+    assert not deduplicator.is_duplicate(models.News(headline='Unrelated', url='u2'))
+
+    # older news are only in the Bloom filter, hits are confirmed by their normalised keys
+    assert deduplicator.is_duplicate(models.News(headline='Old story - BBC', url='u3'))
+    assert deduplicator.is_duplicate(models.News(headline='Old story - ITV', url='u4'))
+    assert deduplicator.is_duplicate(models.News(headline='Renamed', url='http://bbc.co.uk/news/1?utm_medium=y'))
+    deduplicator.bloom.add('url:u6')
+    assert not deduplicator.is_duplicate(models.News(headline='False positive', url='u6'))
+    assert deduplicator.database_checks == 4
+
+    news = models.News(headline='Added', url='u5')
+    deduplicator.add(news)
+    assert deduplicator.is_duplicate(news) and deduplicator.database_checks == 4
+
+
+def news_articles():
+    with open(os.path.join(os.path.dirname(__file__), '..', 'json', 'news.json')) as f:
+        return json.load(f)['articles']['results']
+
+
+def test_story_clusters_match_near_duplicates_only():
+    articles = news_articles()[:20]
+    stories = story_clustering.StoryClusters(threshold=0.5)
+    for i, article in enumerate(articles):
+        stories.add(article['url'], i, stories.signature(article['title'] + ' ' + article['body']))
+
+    assert stories.bands * stories.rows == stories.num_perm
+    # the second half of an article's body is another report of the same story
+    body = articles[3]['body']
+    rewrite = 'Updated: ' + articles[3]['title'] + ' ' + body[len(body) // 3:]
+    story_id, similarity = stories.match(stories.signature(rewrite))
+    assert story_id == 3 and 0.5 <= similarity < 1
+    assert stories.match(stories.signature('An unrelated report about nothing in particular')) == (None, 0)
+
+    stories.add(articles[3]['url'], 99, stories.signature(articles[3]['title'] + ' ' + body))
+    assert stories.match(stories.signature(rewrite))[0] == 99
+    stories.expire(datetime.utcnow() + timedelta(seconds=1))
+    assert len(stories) == 0 and not any(stories.buckets)
+
+
+def test_news_stories_refresh_from_database(tmp_path):
+    db = NappDatabase(connect(str(tmp_path / 'napp.db')))
+    article = news_articles()[5]
+    event = db.save_event(models.Event(name='Story', keywords={'story'}))
+    db.save_news(models.News(headline=article['title'], url=article['url'], text=article['body'], event_id=event.id))
+
+    stories = story_clustering.NewsStories(db)
+    assert stories.refresh() == 1
+    db.save_news(models.News(headline='Other', url='u2', text='other text', event_id=event.id))
+    assert stories.refresh() == 1 and stories.refresh() == 0
+
+    news = models.News(headline=article['title'] + ' - BBC', url='u3', text=article['body'][100:])
+    events = EventWorkingSet(db)
+    events.refresh()
+    assert news_loader.match_event(news, events, None, {'Unrelated'}, stories) is events.get(event.id)
+
+
+def test_returning_trend_and_reused_name_join_their_event(tmp_path):
+    db = NappDatabase(connect(str(tmp_path / 'napp.db')))
+    events = EventWorkingSet(db)
+    stories = story_clustering.NewsStories(db)
+    trend = types.SimpleNamespace(name='#Flood')
+    tweets = [models.Tweet(id=1, text='Rivers burst their banks across York')]
+    keywords = {'york', 'river', 'bank', 'rain', 'flood'}
+    twitter_loader.save_trend(db, trend, tweets, keywords, [0], events, stories)
+
+    # nothing similar, no keyword shared, found by name
+    tweets = [models.Tweet(id=2, text='Completely different words this hour')]
+    twitter_loader.save_trend(db, trend, tweets, {'a', 'b', 'c', 'd', 'e'}, [0], events, stories)
+    event, = db.find_events()
+    assert event.name == '#Flood' and {tweet.event_id for tweet in db.find_tweets()} == {event.id}
+
+    # outside the working set, saving a new event of the same name updates the saved one
+    other = db.save_event(models.Event(name='#Flood', keywords={'thames'}))
+    assert other.id == event.id and other.keywords == keywords | {'a', 'b', 'c', 'd', 'e', 'thames'}
+    assert len(list(db.find_events())) == 1
+
+
+def sentences_of(body):
+    # stands in for doc_sentences, every longer word is a term
+    return [(sentence, [word.lower() for word in sentence.split() if len(word) > 3])
+            for sentence in body.split('. ') if sentence]
+
+
+def test_summarise_keeps_key_sentences_within_budget():
+    documents = [sentences_of(article['body']) for article in news_articles()[:10]]
+    documents.append([('Flood hits York', ['flood', 'york']), ('Cats sleep', ['cats']),
+                      ('York flood defences fail', ['york', 'flood', 'defences'])])
+    documents.append([])
+
+    summaries = summariser.summarise(documents, budget=300)
+
+    assert summaries == [summariser.summarise([document], budget=300)[0] for document in documents]
+    assert all(0 < len(summary) <= 300 for summary in summaries[:-1]) and summaries[-1] == ''
+    assert summaries[-2] == 'Flood hits York York flood defences fail'
+    assert summariser.summarise(documents[-2:-1], budget=12) == ['Flood hits']
+
+
+def test_classifier_loads_exported_model_lazily(tmp_path, monkeypatch):
+    monkeypatch.chdir(os.path.join(os.path.dirname(__file__), '..'))
+    monkeypatch.setattr(classifier.spacy, 'load', lambda name: pytest.fail('spaCy loaded'), raising=False)
+    headlines = [article['title'] for article in news_articles()]
+
+    pickled = classifier.Classifier(engine='pickle')
+    exported = classifier.Classifier(export_directory=str(tmp_path / 'nb'))
+    assert 'model' not in vars(exported)
+
+    assert exported.predict_categories(headlines) == pickled.predict_categories(headlines)
+    assert isinstance(exported.model.feature_log_prob, numpy.memmap)
+    assert (exported.vectoriser.transform(headlines[:5]) != pickled.vectoriser.transform(headlines[:5])).nnz == 0
+
+    # other workers exporting the same models leave the files in use alone
+    directory = str(tmp_path / 'nb')
+    written = os.stat(os.path.join(directory, 'hashes.npy')).st_ino
+    model_export.write_arrays(directory, {}, {'digest': exported.digest})
+    assert os.stat(os.path.join(directory, 'hashes.npy')).st_ino == written
+    model_export.write_arrays(directory, {'classes': numpy.arange(3)}, {'digest': 'retrained'})
+    assert model_export.read_arrays(directory, ['classes'])[0] == {'digest': 'retrained'}
+
+    model, vectoriser = model_export.load_pickles(pickled.model_filename, pickled.vectoriser_filename)
+    vectoriser.ngram_range = (1, 2)
+    with pytest.raises(ValueError, match='ngram_range'):
+        model_export.export(model, vectoriser, str(tmp_path / 'bigrams'), 'digest')
+
+
+def test_hashing_classifier_agrees_with_pickled_model(tmp_path, monkeypatch):
+    monkeypatch.chdir(os.path.join(os.path.dirname(__file__), '..'))
+    articles = news_articles()
+    texts = [article['title'] for article in articles] + [article['body'] for article in articles]
+
+    pickled = classifier.Classifier(engine='pickle')
+    hashing = classifier.Classifier(engine='hashing', export_directory=str(tmp_path / 'nb-hashing'))
+    expected, predicted = pickled.predict_categories(texts), hashing.predict_categories(texts)
+
+    # only tokens sharing a hash bucket with a vocabulary term can change a prediction
+    agreement = sum(1 for a, b in zip(expected, predicted) if a == b) / len(texts)
+    assert agreement >= 0.97
+
+    rows, buckets, count = hashing.vectoriser.tokens(['Hello, WORLD', '', 'a hello'])
+    assert list(rows) == [0, 0, 2] and count == 3
+    assert buckets[0] == buckets[2] != buckets[1]
+
+    # chunks are cut between tokens, so their size does not change the buckets
+    all_rows, all_buckets, _ = hashing.vectoriser.tokens(texts)
+    monkeypatch.setattr(hashing_model, 'CHUNK_CHARS', 7)
+    rows, buckets, _ = hashing.vectoriser.tokens(texts)
+    assert numpy.array_equal(rows, all_rows) and numpy.array_equal(buckets, all_buckets)
+
+
+def test_online_training_checkpoints_and_hot_swaps(tmp_path, monkeypatch):
+    monkeypatch.chdir(os.path.join(os.path.dirname(__file__), '..'))
+    directory = str(tmp_path / 'nb-online')
+    db = NappDatabase(connect(str(tmp_path / 'napp.db')))
+    headlines = [article['title'] for article in news_articles()]
+
+    online = classifier.Classifier(engine='online', export_directory=directory)
+    pickled = classifier.Classifier(engine='pickle')
+    expected = pickled.predict_categories(headlines)
+    assert sum(1 for a, b in zip(expected, online.predict_categories(headlines)) if a == b) >= 0.97 * len(headlines)
+    assert online.model_version == 'v0001'
+    first_version = online.model_version
+
+    # a word never seen, in news labelled with a category the pickled model does not have
+    for i in range(20):
+        db.save_news(models.News(headline=f'Zorblax report {i}', url=f'u{i}', category_id=4))
+    assert online_training.train(db, online, directory, json_filenames=[], chunk_size=7) == 'v0002'
+    assert online_training.train(db, online, directory, json_filenames=[]) is None
+    cached = classifier_cache.CachedClassifier(online, filename=str(tmp_path / 'cache.db'))
+    texts = ['zorblax zorblax zorblax', 'Zorblax report']
+    old_version = online.version
+    assert cached.predict_categories(texts)[0] != 4
+    assert cached.predict_categories(texts)[0] != 4 and cached.hits == 2
+
+    # a batch of cached texts still swaps to the new checkpoint, whose results are stored under its version
+    monkeypatch.setattr(classifier, 'MODEL_CHECK_SEC', 0)
+    assert cached.predict_categories(texts)[0] == 4
+    assert online.model_version == 'v0002' != first_version
+    assert online.version != old_version and cached.misses == 4
+    rows = cached.conn.execute("SELECT Key, Version FROM ClassifierCache").fetchall()
+    assert sorted(rows) == sorted([(cached.key(version, classifier_cache.CATEGORY, text), version)
+                                   for version in (old_version, online.version) for text in texts])
+    assert online.predict_category('zorblax zorblax zorblax') == 4
+
+    db.save_news(models.News(headline='Zorblax again', url='u20', category_id=4))
+    assert online_training.train(db, online, directory, json_filenames=[]) == 'v0003'
+    db.save_news(models.News(headline='Zorblax once more', url='u21', category_id=4))
+    assert online_training.train(db, online, directory, json_filenames=[]) == 'v0004'
+    assert online_training.list_versions(directory) == ['v0002', 'v0003', 'v0004']
+
+
+def test_models_are_slotted_and_built_from_rows(tmp_path):
+    db = NappDatabase(connect(str(tmp_path / 'napp.db')))
+    first, second = models.Event(), models.Event()
+    assert not hasattr(first, '__dict__')
+    assert first.created_at is not second.created_at and first.keywords is not second.keywords
+
+    db.save_events_many([models.Event(name=f'Flood {i}', keywords={f'york{i}', 'flood'}) for i in range(2)])
+    a, b = db.find_events()
+    assert next(k for k in a.keywords if k == 'flood') is next(k for k in b.keywords if k == 'flood')
+
+    news = db.save_news(models.News(headline='h', url='u', event_id=a.id, published_at=datetime(2020, 2, 1)))
+    found = next(db.find_news())
+    assert (found.id, found.headline, found.event_id, found.published_at) == (news.id, 'h', a.id, datetime(2020, 2, 1))
+    db.save_tweets_many([models.Tweet(id=5, text='t', user='u', url='l', published_at=datetime(2020, 2, 1))])
+    tweet = next(db.find_tweets())
+    assert (tweet.user, tweet.url) == ('u', 'l')
+    assert pickle.loads(pickle.dumps(tweet)) == tweet